@@ -1,14 +1,42 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header, Depends, Response, Query, Request
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pymongo import MongoClient
+from starlette.datastructures import Headers
+from pymongo import MongoClient, UpdateOne, ReplaceOne, ReadPreference
 from pydantic import BaseModel
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple, Callable
+from collections import OrderedDict
 import os
 import httpx
 import json
+import copy
+import time
+import asyncio
 from datetime import datetime, timedelta
 import uuid
 import random
+import re
+import zlib
+import io
+import csv
+import hashlib
+import heapq
+import math
+import contextvars
+import threading
+from contextlib import asynccontextmanager
+import ast
+import sys
+import cProfile
+import pstats
+import tracemalloc
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.compute as pc
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from tenacity import AsyncRetrying, stop_after_attempt, wait_exponential, retry_if_exception
 
 app = FastAPI()
 
@@ -26,12 +54,238 @@ MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017/')
 client = MongoClient(MONGO_URL)
 db = client.genbi_manufacturing
 
+# Plant sharding: PLANT_SHARDS maps plant ids to the database holding that plant's fact
+# collections, either a database name on MONGO_URL or a full URI with a database path
+# (e.g. "plant-1=genbi_plant_1,plant-2=mongodb://plant2-db:27017/genbi_plant_2").
+# Unset keeps every plant in genbi_manufacturing. Metadata collections always stay there.
+PLANT_SHARDS = {
+    plant.strip(): target.strip()
+    for plant, target in (
+        entry.split('=', 1) for entry in os.environ.get('PLANT_SHARDS', '').split(',') if '=' in entry
+    )
+}
+PLANT_IDS = list(PLANT_SHARDS) or [os.environ.get('DEFAULT_PLANT_ID', 'plant-1')]
+# Partial results up to this many documents are merged with $documents, larger ones via a temp collection
+SHARD_MERGE_DOCUMENTS_LIMIT = int(os.environ.get('SHARD_MERGE_DOCUMENTS_LIMIT', '20000'))
+
+def open_shard_database(target: str):
+    if "://" in target:
+        return MongoClient(target).get_default_database()
+    return client[target]
+
+shard_databases = {plant: open_shard_database(target) for plant, target in PLANT_SHARDS.items()}
+shard_executor = ThreadPoolExecutor(max_workers=len(shard_databases) + 1, thread_name_prefix="shard")
+
 # LMStudio configuration
-LMSTUDIO_URL = "http://localhost:1234"
+LMSTUDIO_URL = os.environ.get('LMSTUDIO_URL', "http://localhost:1234")
+# Comma-separated OpenAI-compatible backends; every backend is expected to serve both model tiers
+LLM_BACKENDS = [url.strip().rstrip('/') for url in os.environ.get('LLM_BACKENDS', LMSTUDIO_URL).split(',') if url.strip()]
+LLM_FAST_MODEL = os.environ.get('LLM_FAST_MODEL', 'llama-3-8b-instruct')
+LLM_LARGE_MODEL = os.environ.get('LLM_LARGE_MODEL', LLM_FAST_MODEL)
+# Queries longer than this, or with multi-part wording, go straight to the large model
+LLM_FAST_MODEL_MAX_WORDS = int(os.environ.get('LLM_FAST_MODEL_MAX_WORDS', '14'))
+LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', '4'))
+LLM_TIMEOUT_SECONDS = float(os.environ.get('LLM_TIMEOUT_SECONDS', '30'))
+LLM_RETRY_ATTEMPTS = int(os.environ.get('LLM_RETRY_ATTEMPTS', '3'))
+# Constrain generation to PIPELINE_RESPONSE_SCHEMA via response_format; max_tokens is
+# derived from the schema (stages x tokens per stage + the JSON envelope)
+LLM_STRUCTURED_OUTPUT = os.environ.get('LLM_STRUCTURED_OUTPUT', 'true').lower() in ('1', 'true', 'yes')
+LLM_PIPELINE_MAX_STAGES = int(os.environ.get('LLM_PIPELINE_MAX_STAGES', '8'))
+LLM_TOKENS_PER_STAGE = int(os.environ.get('LLM_TOKENS_PER_STAGE', '64'))
+LLM_ENVELOPE_TOKENS = int(os.environ.get('LLM_ENVELOPE_TOKENS', '32'))
+LLM_UNSTRUCTURED_MAX_TOKENS = int(os.environ.get('LLM_UNSTRUCTURED_MAX_TOKENS', '1000'))
+# Time a request waits for the LLM before answering from the cache/rules/fallback instead
+LLM_LATENCY_BUDGET_SECONDS = float(os.environ.get('LLM_LATENCY_BUDGET_SECONDS', '8'))
+# Rule matches below RULE_CONFIDENCE_THRESHOLD are still preferred over the
+# fixed fallback pipeline when the LLM is unavailable
+RULE_DEGRADED_MIN_CONFIDENCE = float(os.environ.get('RULE_DEGRADED_MIN_CONFIDENCE', '0.4'))
+
+# Per-tenant fairness: tenants are identified by X-Tenant-ID (e.g. a plant) or the client address.
+# TENANT_WEIGHTS is a comma-separated list of tenant=weight; unlisted tenants weigh 1
+TENANT_WEIGHTS = {
+    tenant.strip(): float(weight)
+    for tenant, weight in (
+        entry.split('=', 1) for entry in os.environ.get('TENANT_WEIGHTS', '').split(',') if '=' in entry
+    )
+}
+TENANT_RATE_LIMIT_PER_MINUTE = float(os.environ.get('TENANT_RATE_LIMIT_PER_MINUTE', '60'))
+TENANT_RATE_LIMIT_BURST = float(os.environ.get('TENANT_RATE_LIMIT_BURST', '20'))
+TENANT_RATE_LIMIT_MAX_TRACKED = int(os.environ.get('TENANT_RATE_LIMIT_MAX_TRACKED', '10000'))
+DB_MAX_CONCURRENCY = int(os.environ.get('DB_MAX_CONCURRENCY', '8'))
+current_tenant: contextvars.ContextVar = contextvars.ContextVar('current_tenant', default='system')
+
+# LLM circuit breaker
+LLM_BREAKER_WINDOW_SECONDS = float(os.environ.get('LLM_BREAKER_WINDOW_SECONDS', '60'))
+LLM_BREAKER_MIN_CALLS = int(os.environ.get('LLM_BREAKER_MIN_CALLS', '5'))
+LLM_BREAKER_FAILURE_RATE = float(os.environ.get('LLM_BREAKER_FAILURE_RATE', '0.5'))
+LLM_BREAKER_SLOW_CALL_SECONDS = float(os.environ.get('LLM_BREAKER_SLOW_CALL_SECONDS', '10'))
+LLM_BREAKER_SLOW_CALL_RATE = float(os.environ.get('LLM_BREAKER_SLOW_CALL_RATE', '0.8'))
+LLM_BREAKER_OPEN_SECONDS = float(os.environ.get('LLM_BREAKER_OPEN_SECONDS', '30'))
+
+# NL query translation cache (normalized query text -> pipeline)
+QUERY_CACHE_TTL_SECONDS = int(os.environ.get('QUERY_CACHE_TTL_SECONDS', '900'))
+QUERY_CACHE_MAX_ENTRIES = int(os.environ.get('QUERY_CACHE_MAX_ENTRIES', '512'))
+query_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+inflight_translations: Dict[str, asyncio.Task] = {}
+
+# Collections tried, in order, when executing an NL query pipeline
+QUERY_COLLECTIONS = ["production_data", "quality_metrics", "equipment_downtime"]
+MAX_BATCH_QUERIES = int(os.environ.get('MAX_BATCH_QUERIES', '50'))
+
+# Embedding index used for prompt retrieval and near-duplicate cache lookups
+EMBEDDING_DIMENSIONS = int(os.environ.get('EMBEDDING_DIMENSIONS', '512'))
+RETRIEVAL_TOP_K = int(os.environ.get('RETRIEVAL_TOP_K', '6'))
+RETRIEVAL_MIN_SCORE = float(os.environ.get('RETRIEVAL_MIN_SCORE', '0.2'))
+NEAR_DUPLICATE_MIN_SCORE = float(os.environ.get('NEAR_DUPLICATE_MIN_SCORE', '0.85'))
+
+# Schema discovery: sampled per-collection statistics
+SCHEMA_SAMPLE_SIZE = int(os.environ.get('SCHEMA_SAMPLE_SIZE', '1000'))
+SCHEMA_STATS_MAX_AGE_SECONDS = int(os.environ.get('SCHEMA_STATS_MAX_AGE_SECONDS', '3600'))
+# Re-sample a collection early when its document count drifts by more than this fraction
+SCHEMA_STATS_DRIFT_RATIO = float(os.environ.get('SCHEMA_STATS_DRIFT_RATIO', '0.1'))
+SCHEMA_STATS_REFRESH_INTERVAL_SECONDS = int(os.environ.get('SCHEMA_STATS_REFRESH_INTERVAL_SECONDS', '600'))
+collection_stats_cache: Dict[str, Dict[str, Any]] = {}
+
+# Query plan sampling and slow-query log
+EXPLAIN_SAMPLE_RATE = float(os.environ.get('EXPLAIN_SAMPLE_RATE', '0.05'))
+SLOW_QUERY_THRESHOLD_MS = float(os.environ.get('SLOW_QUERY_THRESHOLD_MS', '500'))
+SLOW_QUERY_LOG_SIZE_BYTES = int(os.environ.get('SLOW_QUERY_LOG_SIZE_BYTES', str(32 * 1024 * 1024)))
+
+# Retention: raw fact records older than RETENTION_DAYS are rolled up into <collection>_daily,
+# archived to Parquet under ARCHIVE_DIR and deleted from Mongo in batches
+RETENTION_DAYS = int(os.environ.get('RETENTION_DAYS', '365'))
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive'))
+RETENTION_BATCH_SIZE = int(os.environ.get('RETENTION_BATCH_SIZE', '5000'))
+RETENTION_INTERVAL_SECONDS = int(os.environ.get('RETENTION_INTERVAL_SECONDS', '86400'))
+archive_watermarks: Dict[str, str] = {}
+retention_lock = threading.Lock()
+
+# Approximate mode: sample size across all shards, minimum sampled rows per group
+# (below it the query runs exactly) and the confidence level of reported intervals
+APPROX_SAMPLE_SIZE = int(os.environ.get('APPROX_SAMPLE_SIZE', '10000'))
+# $sample only uses a random cursor when it takes under 5% of a collection; above that it
+# scans and sorts the whole collection (slower than exact), so smaller collections run exactly
+APPROX_MIN_POPULATION_RATIO = 20
+APPROX_MIN_GROUP_ROWS = int(os.environ.get('APPROX_MIN_GROUP_ROWS', '30'))
+APPROX_CONFIDENCE = 0.95
+APPROX_CONFIDENCE_Z = 1.96
+
+# Join planning: dimension tables (the "one" side of a many-to-one relationship) up to
+# HASH_JOIN_MAX_ROWS documents are joined in process from a map that is rebuilt when the
+# table's version changes; the TTL bounds staleness from writes made outside the API
+HASH_JOIN_MAX_ROWS = int(os.environ.get('HASH_JOIN_MAX_ROWS', '5000'))
+DIMENSION_CACHE_TTL_SECONDS = int(os.environ.get('DIMENSION_CACHE_TTL_SECONDS', '300'))
+
+# KPI engine: planned time per shift for availability, and days of partials kept in memory
+# for sliding windows (the longest window /api/kpi serves without reading Mongo)
+KPI_SHIFT_MINUTES = int(os.environ.get('KPI_SHIFT_MINUTES', '720'))
+KPI_WINDOW_DAYS = int(os.environ.get('KPI_WINDOW_DAYS', '30'))
+kpi_lock = threading.Lock()
+INGEST_MAX_RECORDS = int(os.environ.get('INGEST_MAX_RECORDS', '10000'))
+# Ingested records per database scheduler slot, so large ingests queue behind their share
+INGEST_RECORDS_PER_SLOT = int(os.environ.get('INGEST_RECORDS_PER_SLOT', '1000'))
+
+# Streaming anomaly detection: per plant and line/machine EWMA and streaming median/MAD, updated per
+# ingested record; a value is flagged when its robust z-score exceeds ANOMALY_Z_THRESHOLD
+ANOMALY_EWMA_ALPHA = float(os.environ.get('ANOMALY_EWMA_ALPHA', '0.1'))
+ANOMALY_QUANTILE_RATE = float(os.environ.get('ANOMALY_QUANTILE_RATE', '0.05'))
+ANOMALY_Z_THRESHOLD = float(os.environ.get('ANOMALY_Z_THRESHOLD', '3.5'))
+ANOMALY_MIN_SAMPLES = int(os.environ.get('ANOMALY_MIN_SAMPLES', '20'))
+ANOMALY_STREAM_QUEUE_SIZE = int(os.environ.get('ANOMALY_STREAM_QUEUE_SIZE', '100'))
+ANOMALY_STREAM_KEEPALIVE_SECONDS = float(os.environ.get('ANOMALY_STREAM_KEEPALIVE_SECONDS', '15'))
+anomaly_lock = threading.Lock()
+
+# Streaming export: rows per cursor batch / file chunk, pause between batches, concurrent exports
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', '5000'))
+EXPORT_THROTTLE_SECONDS = float(os.environ.get('EXPORT_THROTTLE_SECONDS', '0.01'))
+EXPORT_MAX_CONCURRENCY = int(os.environ.get('EXPORT_MAX_CONCURRENCY', '2'))
+export_slots = threading.BoundedSemaphore(EXPORT_MAX_CONCURRENCY)
+
+# Rule-based fast path: questions matched with at least this confidence skip the LLM
+RULE_CONFIDENCE_THRESHOLD = float(os.environ.get('RULE_CONFIDENCE_THRESHOLD', '0.8'))
+
+# Admin endpoints require this token in the X-Admin-Token header when it is set;
+# request profiling (X-Profile) is refused unless it is set
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
+# Profiling: requests sent with X-Profile are stored in a capped collection; the sampling
+# profiler runs for at most PROFILE_SAMPLE_MAX_SECONDS and keeps the last PROFILE_SAMPLES_KEPT runs
+PROFILE_STORE_SIZE_BYTES = int(os.environ.get('PROFILE_STORE_SIZE_BYTES', str(16 * 1024 * 1024)))
+PROFILE_TOP_FUNCTIONS = int(os.environ.get('PROFILE_TOP_FUNCTIONS', '40'))
+PROFILE_SAMPLE_MAX_SECONDS = float(os.environ.get('PROFILE_SAMPLE_MAX_SECONDS', '120'))
+PROFILE_SAMPLES_KEPT = int(os.environ.get('PROFILE_SAMPLES_KEPT', '10'))
+
+# HTTP conditional caching: read endpoints send ETags built from per-collection write counters.
+# Counters live in this process, so BOOT_ID invalidates every ETag after a restart
+BOOT_ID = uuid.uuid4().hex[:12]
+HTTP_CACHE_MAX_AGE_SECONDS = int(os.environ.get('HTTP_CACHE_MAX_AGE_SECONDS', '0'))
+collection_versions: Dict[str, int] = {}
+
+# Executed NL query results (and the dashboard overview) are reused while the collections
+# they read are unchanged; the TTL bounds staleness from writes made outside the API
+RESULT_CACHE_TTL_SECONDS = int(os.environ.get('RESULT_CACHE_TTL_SECONDS', '600'))
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', '256'))
+RESULT_CACHE_MAX_ROWS = int(os.environ.get('RESULT_CACHE_MAX_ROWS', '10000'))
+result_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+dashboard_cache: Dict[str, Any] = {}
+
+# Cache warm-up: the top WARMUP_TOP_QUERIES questions in query_log, ranked by frequency decayed
+# by recency, are pre-translated and pre-executed shortly after startup and then periodically.
+# Each step waits until live traffic leaves at least half of the LLM and database slots free
+WARMUP_TOP_QUERIES = int(os.environ.get('WARMUP_TOP_QUERIES', '20'))
+WARMUP_INTERVAL_SECONDS = int(os.environ.get('WARMUP_INTERVAL_SECONDS', '1800'))
+WARMUP_STARTUP_DELAY_SECONDS = float(os.environ.get('WARMUP_STARTUP_DELAY_SECONDS', '5'))
+WARMUP_PAUSE_SECONDS = float(os.environ.get('WARMUP_PAUSE_SECONDS', '0.5'))
+WARMUP_RECENCY_HALF_LIFE_HOURS = float(os.environ.get('WARMUP_RECENCY_HALF_LIFE_HOURS', '72'))
+QUERY_LOG_RETENTION_DAYS = int(os.environ.get('QUERY_LOG_RETENTION_DAYS', '30'))
+WARMUP_TENANT = "warmup"
+warmup_status: Dict[str, Any] = {"running": False}
+
+# Saved query materialization scheduler
+SAVED_QUERY_SCHEDULER_INTERVAL_SECONDS = int(os.environ.get('SAVED_QUERY_SCHEDULER_INTERVAL_SECONDS', '30'))
+
+# ERD layout updates are coalesced for this long before being written in one bulk_write
+LAYOUT_FLUSH_DELAY_SECONDS = float(os.environ.get('LAYOUT_FLUSH_DELAY_SECONDS', '0.5'))
+pending_layout_updates: Dict[str, Dict[str, float]] = {}
+layout_flush_task: Optional[asyncio.Task] = None
+
+# Async NL query jobs: separate worker pools per priority lane so interactive
+# dashboard queries never wait behind batch reports
+JOB_LANE_WORKERS = {
+    "interactive": int(os.environ.get('JOB_INTERACTIVE_WORKERS', '4')),
+    "batch": int(os.environ.get('JOB_BATCH_WORKERS', '2'))
+}
+JOB_QUEUE_MAX_SIZE = int(os.environ.get('JOB_QUEUE_MAX_SIZE', '200'))
+JOB_RESULT_TTL_SECONDS = int(os.environ.get('JOB_RESULT_TTL_SECONDS', '3600'))
+jobs: Dict[str, Dict[str, Any]] = {}
+job_queues: Dict[str, asyncio.Queue] = {}
+running_job_tasks: Dict[str, asyncio.Task] = {}
+
+# Stages that are not allowed inside a $facet sub-pipeline
+FACET_INCOMPATIBLE_STAGES = {
+    "$out", "$merge", "$facet", "$collStats", "$indexStats", "$geoNear",
+    "$planCacheStats", "$search", "$searchMeta", "$changeStream", "$currentOp", "$listSessions"
+}
 
 # Pydantic models
 class NLQuery(BaseModel):
     query: str
+    explain: bool = False  # return the execution plan summary with the results
+    approximate: bool = False  # estimate group-bys from a sample, with confidence intervals
+
+class BatchNLQuery(BaseModel):
+    queries: List[str]
+
+class PipelineRun(BaseModel):
+    collection: str
+    pipeline: List[Dict[str, Any]]
+    plan: bool = True  # False runs the pipeline as written, without the join planner or hash joins
+
+class SavedQuery(BaseModel):
+    name: str
+    query: str
+    refresh_interval_minutes: Optional[int] = None  # None = materialize on demand only
+    description: Optional[str] = None
 
 class SemanticMapping(BaseModel):
     business_term: str
@@ -45,6 +299,13 @@ class TableSchema(BaseModel):
     position: Optional[Dict[str, float]] = None
     description: Optional[str] = None
 
+class TablePosition(BaseModel):
+    table_name: str
+    position: Dict[str, float]
+
+class TableLayoutUpdate(BaseModel):
+    positions: List[TablePosition]
+
 class TableRelationship(BaseModel):
     from_table: str
     to_table: str
@@ -59,18 +320,28 @@ class ERDConfiguration(BaseModel):
     relationships: List[TableRelationship]
     description: Optional[str] = None
 
+class ERDConfigurationUpdate(BaseModel):
+    add_tables: List[str] = []  # table names
+    remove_tables: List[str] = []
+    add_relationships: List[str] = []  # relationship ids
+    remove_relationships: List[str] = []
+    description: Optional[str] = None
+    expected_version: Optional[int] = None
+
 # Initialize sample data
 def init_sample_data():
     """Initialize sample tyre manufacturing data"""
     
     # Clear existing data
-    db.production_data.delete_many({})
-    db.quality_metrics.delete_many({})
-    db.equipment_downtime.delete_many({})
+    for collection_name in QUERY_COLLECTIONS:
+        for collection in fact_collections(collection_name):
+            collection.delete_many({})
     db.semantic_mappings.delete_many({})
     db.table_schemas.delete_many({})
     db.table_relationships.delete_many({})
     db.erd_configurations.delete_many({})
+    db.operators.delete_many({})
+    db.tyre_specifications.delete_many({})
     
     # Production lines and tyre types
     production_lines = ["Line-A-Radial", "Line-B-Bias", "Line-C-HeavyDuty"]
@@ -90,6 +361,7 @@ def init_sample_data():
                 for tyre_type in random.sample(tyre_types, 3):
                     production_data.append({
                         "_id": str(uuid.uuid4()),
+                        "plant_id": random.choice(PLANT_IDS),
                         "date": current_date.strftime("%Y-%m-%d"),
                         "production_line": line,
                         "shift": shift,
@@ -113,6 +385,7 @@ def init_sample_data():
             for defect_type in defect_types:
                 quality_metrics.append({
                     "_id": str(uuid.uuid4()),
+                    "plant_id": random.choice(PLANT_IDS),
                     "date": current_date.strftime("%Y-%m-%d"),
                     "production_line": line,
                     "defect_type": defect_type,
@@ -134,6 +407,7 @@ def init_sample_data():
             if random.random() < 0.3:  # 30% chance of downtime per day
                 equipment_downtime.append({
                     "_id": str(uuid.uuid4()),
+                    "plant_id": random.choice(PLANT_IDS),
                     "date": current_date.strftime("%Y-%m-%d"),
                     "equipment_type": equipment,
                     "equipment_id": f"{equipment}_{random.randint(1, 5)}",
@@ -145,6 +419,30 @@ def init_sample_data():
                     "production_line": random.choice(production_lines)
                 })
     
+    # Dimension tables referenced by production data
+    operators = [
+        {
+            "_id": f"OP{number}",
+            "operator_id": f"OP{number}",
+            "name": f"Operator {number}",
+            "shift_preference": random.choice(["Day", "Night", None]),
+            "skill_level": random.choice(["Trainee", "Skilled", "Senior"]),
+            "certification_date": (base_date - timedelta(days=random.randint(30, 2000))).strftime("%Y-%m-%d")
+        }
+        for number in range(100, 1000)
+    ]
+    tyre_specifications = [
+        {
+            "_id": tyre_type,
+            "tyre_type": tyre_type,
+            "category": "Truck/Bus" if tyre_type.endswith(".5") else "Passenger",
+            "target_pressure": 8.5 if tyre_type.endswith(".5") else 2.3,
+            "weight_kg": round(random.uniform(55, 70), 1) if tyre_type.endswith(".5") else round(random.uniform(7, 13), 1),
+            "material_cost": round(random.uniform(180, 260), 2) if tyre_type.endswith(".5") else round(random.uniform(25, 60), 2)
+        }
+        for tyre_type in tyre_types
+    ]
+    
     # Semantic mappings for business context
     semantic_mappings = [
         {
@@ -181,6 +479,34 @@ def init_sample_data():
             "database_field": "defect_count",
             "description": "Total number of quality defects",
             "table_name": "quality_metrics"
+        },
+        {
+            "_id": str(uuid.uuid4()),
+            "business_term": "oee",
+            "database_field": "effective_good_count / planned_production",
+            "description": "Overall equipment effectiveness (availability x performance x quality)",
+            "table_name": "kpi_oee"
+        },
+        {
+            "_id": str(uuid.uuid4()),
+            "business_term": "availability",
+            "database_field": "run_minutes / planned_minutes",
+            "description": "Share of planned time the line was running (OEE availability)",
+            "table_name": "kpi_oee"
+        },
+        {
+            "_id": str(uuid.uuid4()),
+            "business_term": "performance",
+            "database_field": "actual_production / planned_production",
+            "description": "Actual vs planned output (OEE performance)",
+            "table_name": "kpi_oee"
+        },
+        {
+            "_id": str(uuid.uuid4()),
+            "business_term": "quality rate",
+            "database_field": "good_count / actual_production",
+            "description": "Share of produced tyres without defects (OEE quality)",
+            "table_name": "kpi_oee"
         }
     ]
     
@@ -191,6 +517,7 @@ def init_sample_data():
             "table_name": "production_data",
             "columns": [
                 {"name": "_id", "type": "string", "primary_key": True},
+                {"name": "plant_id", "type": "string", "nullable": False},
                 {"name": "date", "type": "string", "nullable": False},
                 {"name": "production_line", "type": "string", "nullable": False},
                 {"name": "shift", "type": "string", "nullable": False},
@@ -211,6 +538,7 @@ def init_sample_data():
             "table_name": "quality_metrics",
             "columns": [
                 {"name": "_id", "type": "string", "primary_key": True},
+                {"name": "plant_id", "type": "string", "nullable": False},
                 {"name": "date", "type": "string", "nullable": False},
                 {"name": "production_line", "type": "string", "nullable": False},
                 {"name": "defect_type", "type": "string", "nullable": False},
@@ -226,6 +554,7 @@ def init_sample_data():
             "table_name": "equipment_downtime",
             "columns": [
                 {"name": "_id", "type": "string", "primary_key": True},
+                {"name": "plant_id", "type": "string", "nullable": False},
                 {"name": "date", "type": "string", "nullable": False},
                 {"name": "equipment_type", "type": "string", "nullable": False},
                 {"name": "equipment_id", "type": "string", "nullable": False},
@@ -261,6 +590,29 @@ def init_sample_data():
             ],
             "position": {"x": 400, "y": 350},
             "description": "Tyre type specifications and costs"
+        },
+        {
+            "_id": str(uuid.uuid4()),
+            "table_name": "kpi_oee",
+            "columns": [
+                {"name": "plant_id", "type": "string", "nullable": False},
+                {"name": "date", "type": "string", "nullable": False},
+                {"name": "production_line", "type": "string", "nullable": False},
+                {"name": "planned_minutes", "type": "integer", "nullable": False},
+                {"name": "downtime_minutes", "type": "integer", "nullable": False},
+                {"name": "run_minutes", "type": "integer", "nullable": False},
+                {"name": "planned_production", "type": "integer", "nullable": False},
+                {"name": "actual_production", "type": "integer", "nullable": False},
+                {"name": "rejected_count", "type": "integer", "nullable": False},
+                {"name": "good_count", "type": "integer", "nullable": False},
+                {"name": "availability", "type": "float", "nullable": True},
+                {"name": "performance", "type": "float", "nullable": True},
+                {"name": "quality", "type": "float", "nullable": True},
+                {"name": "oee", "type": "float", "nullable": True},
+                {"name": "effective_good_count", "type": "float", "nullable": False}
+            ],
+            "position": {"x": 700, "y": 350},
+            "description": "Daily OEE per plant and production line, maintained from production, quality and downtime records"
         }
     ]
     
@@ -304,26 +656,34 @@ def init_sample_data():
         }
     ]
     
+    # Schemas and relationships are versioned so ERDs can reference them
+    for document in table_schemas + table_relationships:
+        document["version"] = 1
+    
     # Create sample ERD configuration
     erd_configurations = [
         {
             "_id": str(uuid.uuid4()),
             "name": "Tyre Manufacturing ERD",
             "description": "Complete entity relationship diagram for tyre manufacturing operations",
-            "tables": table_schemas,
-            "relationships": table_relationships,
+            "table_refs": [erd_table_ref(schema) for schema in table_schemas],
+            "relationship_refs": [erd_relationship_ref(relationship) for relationship in table_relationships],
+            "version": 1,
             "created_date": datetime.now().isoformat()
         }
     ]
     
     # Insert sample data
-    db.production_data.insert_many(production_data)
-    db.quality_metrics.insert_many(quality_metrics)
-    db.equipment_downtime.insert_many(equipment_downtime)
+    insert_fact_documents("production_data", production_data)
+    insert_fact_documents("quality_metrics", quality_metrics)
+    insert_fact_documents("equipment_downtime", equipment_downtime)
+    db.operators.insert_many(operators)
+    db.tyre_specifications.insert_many(tyre_specifications)
     db.semantic_mappings.insert_many(semantic_mappings)
     db.table_schemas.insert_many(table_schemas)
     db.table_relationships.insert_many(table_relationships)
     db.erd_configurations.insert_many(erd_configurations)
+    invalidate_rule_vocabulary()
     
     print(f"Initialized {len(production_data)} production records")
     print(f"Initialized {len(quality_metrics)} quality records")
@@ -333,23 +693,358 @@ def init_sample_data():
     print(f"Initialized {len(table_relationships)} table relationships")
     print(f"Initialized {len(erd_configurations)} ERD configurations")
 
-async def query_lmstudio(prompt: str) -> str:
-    """Query LMStudio for natural language processing"""
-    try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(
-                f"{LMSTUDIO_URL}/v1/chat/completions",
-                json={
-                    "model": "llama-3-8b-instruct",
-                    "messages": [
-                        {
-                            "role": "system",
-                            "content": """You are a GenBI expert for tyre manufacturing. Convert natural language queries to MongoDB aggregation pipelines.
+# Fallback pipeline for demo, returned when LMStudio is unavailable
+FALLBACK_LLM_RESPONSE = """[
+            {"$match": {"date": {"$gte": "2024-12-01"}}},
+            {"$group": {"_id": "$production_line", "total_production": {"$sum": "$actual_production"}, "total_defects": {"$sum": "$defect_count"}}},
+            {"$addFields": {"defect_rate": {"$divide": ["$total_defects", "$total_production"]}}},
+            {"$sort": {"total_production": -1}}
+        ]"""
+
+class CircuitBreaker:
+    """Rolling-window circuit breaker for an unreliable dependency (one per LLM backend).
+
+    Opens when the failure rate or slow-call rate over the last window exceeds its
+    threshold, rejects calls while open, and lets a single probe call through once
+    the open period has elapsed (half-open) to decide whether to close again.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = "closed"
+        self.calls: deque = deque()  # (timestamp, succeeded, latency_seconds)
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.transitions = {"open": 0, "half_open": 0, "closed": 0}
+        self.rejected_calls = 0
+        self.last_state_change = datetime.now().isoformat()
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            self.state = state
+            self.transitions[state] += 1
+            self.last_state_change = datetime.now().isoformat()
+            print(f"Circuit breaker {self.name}: {state}")
+
+    def _prune(self):
+        cutoff = time.monotonic() - LLM_BREAKER_WINDOW_SECONDS
+        while self.calls and self.calls[0][0] < cutoff:
+            self.calls.popleft()
+
+    def current_state(self) -> str:
+        if self.state == "open" and time.monotonic() - self.opened_at >= LLM_BREAKER_OPEN_SECONDS:
+            self._set_state("half_open")
+        return self.state
+
+    def allow_request(self) -> bool:
+        state = self.current_state()
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.probe_in_flight:
+            self.probe_in_flight = True
+            return True
+        self.rejected_calls += 1
+        return False
+
+    def record(self, succeeded: bool, latency: float):
+        self.calls.append((time.monotonic(), succeeded, latency))
+        self._prune()
+        if self.state == "half_open":
+            self.probe_in_flight = False
+            if succeeded and latency < LLM_BREAKER_SLOW_CALL_SECONDS:
+                self.calls.clear()
+                self._set_state("closed")
+            else:
+                self._trip()
+            return
+        if len(self.calls) >= LLM_BREAKER_MIN_CALLS:
+            failure_rate = sum(1 for _, ok, _ in self.calls if not ok) / len(self.calls)
+            slow_rate = sum(1 for _, _, latency in self.calls if latency >= LLM_BREAKER_SLOW_CALL_SECONDS) / len(self.calls)
+            if failure_rate >= LLM_BREAKER_FAILURE_RATE or slow_rate >= LLM_BREAKER_SLOW_CALL_RATE:
+                self._trip()
+
+    def _trip(self):
+        self.opened_at = time.monotonic()
+        self._set_state("open")
+
+    def snapshot(self) -> Dict[str, Any]:
+        self._prune()
+        latencies = sorted(latency for _, _, latency in self.calls)
+        calls = len(self.calls)
+        return {
+            "name": self.name,
+            "state": self.current_state(),
+            "window_seconds": LLM_BREAKER_WINDOW_SECONDS,
+            "window_calls": calls,
+            "failure_rate": round(sum(1 for _, ok, _ in self.calls if not ok) / calls, 3) if calls else 0.0,
+            "slow_call_rate": round(sum(1 for latency in latencies if latency >= LLM_BREAKER_SLOW_CALL_SECONDS) / calls, 3) if calls else 0.0,
+            "p50_latency_seconds": round(latencies[calls // 2], 3) if calls else None,
+            "p95_latency_seconds": round(latencies[min(calls - 1, int(calls * 0.95))], 3) if calls else None,
+            "rejected_calls": self.rejected_calls,
+            "transitions": dict(self.transitions),
+            "last_state_change": self.last_state_change
+        }
+
+class LLMBackend:
+    """An OpenAI-compatible inference backend with its own breaker and load stats"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.breaker = CircuitBreaker(url)
+        self.outstanding = 0
+        self.total_requests = 0
+        self.failed_requests = 0
+        self.ewma_latency = 0.0
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "url": self.url,
+            "outstanding_requests": self.outstanding,
+            "total_requests": self.total_requests,
+            "failed_requests": self.failed_requests,
+            "ewma_latency_seconds": round(self.ewma_latency, 3),
+            "circuit_breaker": self.breaker.snapshot()
+        }
+
+class LLMRouter:
+    """Least-outstanding-requests load balancer over LLM backends.
+
+    Ties are broken by EWMA latency; backends whose breaker is open are skipped.
+    """
+
+    def __init__(self, urls: List[str]):
+        self.backends = [LLMBackend(url) for url in urls]
+
+    def has_available_backend(self) -> bool:
+        return any(backend.breaker.current_state() != "open" for backend in self.backends)
+
+    def acquire(self, avoid: Optional[set] = None) -> Optional[LLMBackend]:
+        """Pick a backend, preferring ones not in avoid (e.g. already failed for this request)"""
+        avoid = avoid or set()
+        candidates = sorted(
+            (backend for backend in self.backends if backend.breaker.current_state() != "open"),
+            key=lambda backend: (backend.url in avoid, backend.outstanding, backend.ewma_latency)
+        )
+        for backend in candidates:
+            if backend.breaker.allow_request():
+                backend.outstanding += 1
+                backend.total_requests += 1
+                return backend
+        return None
+
+    def release(self, backend: LLMBackend, succeeded: bool, latency: float):
+        backend.outstanding -= 1
+        if not succeeded:
+            backend.failed_requests += 1
+        backend.ewma_latency = latency if backend.ewma_latency == 0 else 0.8 * backend.ewma_latency + 0.2 * latency
+        backend.breaker.record(succeeded, latency)
+
+llm_router = LLMRouter(LLM_BACKENDS)
+
+class TokenBucket:
+    """Token bucket refilled continuously at rate tokens/second up to burst"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_consume(self, cost: float = 1.0) -> float:
+        """Take cost tokens; returns 0 on success or the seconds until enough tokens are available"""
+        self._refill()
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (min(cost, self.burst) - self.tokens) / self.rate
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.burst
+
+rate_limit_buckets: Dict[str, TokenBucket] = {}
+
+def tenant_weight(tenant: str) -> float:
+    return max(TENANT_WEIGHTS.get(tenant, 1.0), 0.01)
+
+def check_tenant_rate_limit(tenant: str, cost: float = 1.0):
+    """Raise 429 with Retry-After when the tenant has used up its request budget"""
+    bucket = rate_limit_buckets.get(tenant)
+    if bucket is None:
+        if len(rate_limit_buckets) >= TENANT_RATE_LIMIT_MAX_TRACKED:
+            # Idle tenants have full buckets, so forgetting them loses nothing
+            for idle_tenant in [name for name, idle in rate_limit_buckets.items() if idle.is_full()]:
+                del rate_limit_buckets[idle_tenant]
+        weight = tenant_weight(tenant)
+        bucket = TokenBucket(TENANT_RATE_LIMIT_PER_MINUTE * weight / 60.0, TENANT_RATE_LIMIT_BURST * weight)
+        rate_limit_buckets[tenant] = bucket
+    retry_after = bucket.try_consume(cost)
+    if retry_after > 0:
+        raise HTTPException(
+            status_code=429,
+            detail=f"Rate limit exceeded for tenant {tenant}",
+            headers={"Retry-After": str(math.ceil(retry_after))}
+        )
+
+class FairScheduler:
+    """Weighted fair queueing over a fixed number of slots (LLM calls, aggregations).
+
+    Each request gets a virtual finish tag of max(virtual time, tenant's last tag) +
+    cost / weight, and free slots go to the smallest tag, so a tenant flooding the
+    queue only delays its own requests while others keep their share.
+    """
+
+    def __init__(self, name: str, capacity: int):
+        self.name = name
+        self.capacity = capacity
+        self.active = 0
+        self.virtual_time = 0.0
+        self.finish_tags: Dict[str, float] = {}
+        self.waiters: List[Tuple[float, int, float, str, asyncio.Future]] = []
+        self.sequence = 0
+        self.tenant_stats: Dict[str, Dict[str, float]] = {}
+
+    def _record_wait(self, tenant: str, waited: float):
+        stats = self.tenant_stats.setdefault(tenant, {"granted": 0, "total_wait_seconds": 0.0, "max_wait_seconds": 0.0})
+        stats["granted"] += 1
+        stats["total_wait_seconds"] += waited
+        stats["max_wait_seconds"] = max(stats["max_wait_seconds"], waited)
+
+    async def acquire(self, tenant: str, cost: float = 1.0):
+        start_tag = max(self.virtual_time, self.finish_tags.get(tenant, 0.0))
+        self.finish_tags[tenant] = start_tag + cost / tenant_weight(tenant)
+        if self.active < self.capacity and not self.waiters:
+            self.active += 1
+            self.virtual_time = start_tag
+            self._record_wait(tenant, 0.0)
+            return
+        
+        future = asyncio.get_running_loop().create_future()
+        self.sequence += 1
+        heapq.heappush(self.waiters, (self.finish_tags[tenant], self.sequence, start_tag, tenant, future))
+        queued_at = time.monotonic()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()  # the slot was handed over just as we were cancelled
+            raise
+        self._record_wait(tenant, time.monotonic() - queued_at)
+
+    def release(self):
+        # Hand the slot straight to the waiter with the smallest finish tag
+        while self.waiters:
+            _, _, start_tag, _, future = heapq.heappop(self.waiters)
+            if future.cancelled():
+                continue
+            self.virtual_time = max(self.virtual_time, start_tag)
+            future.set_result(None)
+            return
+        self.active -= 1
+        if self.active == 0:
+            # Idle: no tenant can be ahead of anyone else any more
+            self.finish_tags.clear()
+
+    @asynccontextmanager
+    async def slot(self, tenant: Optional[str] = None, cost: float = 1.0):
+        await self.acquire(tenant or current_tenant.get(), cost)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def snapshot(self) -> Dict[str, Any]:
+        queued: Dict[str, int] = {}
+        for _, _, _, tenant, future in self.waiters:
+            if not future.done():
+                queued[tenant] = queued.get(tenant, 0) + 1
+        return {
+            "name": self.name,
+            "capacity": self.capacity,
+            "active": self.active,
+            "queued": sum(queued.values()),
+            "tenants": {
+                tenant: {
+                    "weight": tenant_weight(tenant),
+                    "queued": queued.get(tenant, 0),
+                    "granted": int(stats["granted"]),
+                    "avg_wait_ms": round(stats["total_wait_seconds"] / stats["granted"] * 1000, 2),
+                    "max_wait_ms": round(stats["max_wait_seconds"] * 1000, 2)
+                }
+                for tenant, stats in self.tenant_stats.items()
+            }
+        }
+
+llm_scheduler = FairScheduler("llm", LLM_MAX_CONCURRENCY)
+db_scheduler = FairScheduler("database", DB_MAX_CONCURRENCY)
+
+class LLMUnavailableError(Exception):
+    pass
+
+def is_retryable_llm_error(error: BaseException) -> bool:
+    """Retry connection failures and 5xx responses; timeouts are not retried
+    because they already consumed the full timeout"""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return isinstance(error, (httpx.ConnectError, httpx.RemoteProtocolError))
+
+# Stages the LLM may emit; writes ($out, $merge) and server-side code are never allowed
+LLM_PIPELINE_STAGES = {
+    "$match": {"type": "object"},
+    "$group": {"type": "object"},
+    "$project": {"type": "object"},
+    "$addFields": {"type": "object"},
+    "$set": {"type": "object"},
+    "$unset": {"anyOf": [{"type": "string"}, {"type": "array", "items": {"type": "string"}}]},
+    "$sort": {"type": "object"},
+    "$limit": {"type": "integer"},
+    "$skip": {"type": "integer"},
+    "$unwind": {"anyOf": [{"type": "string"}, {"type": "object"}]},
+    "$lookup": {"type": "object"},
+    "$count": {"type": "string"},
+    "$bucket": {"type": "object"}
+}
+llm_parse_stats = {"responses": 0, "parsed": 0, "repaired": 0, "failed": 0, "truncated": 0, "completion_tokens": 0}
+schema_unsupported_backends: set = set()
+
+def pipeline_response_schema() -> Dict[str, Any]:
+    """JSON schema for a generated pipeline: the target collection and a list of allowed stages"""
+    return {
+        "type": "object",
+        "properties": {
+            "collection": {"type": "string", "enum": QUERY_COLLECTIONS + sorted(VIRTUAL_COLLECTIONS)},
+            "pipeline": {
+                "type": "array",
+                "minItems": 1,
+                "maxItems": LLM_PIPELINE_MAX_STAGES,
+                "items": {
+                    "anyOf": [
+                        {"type": "object", "properties": {stage: value_schema}, "required": [stage], "additionalProperties": False}
+                        for stage, value_schema in LLM_PIPELINE_STAGES.items()
+                    ]
+                }
+            }
+        },
+        "required": ["collection", "pipeline"],
+        "additionalProperties": False
+    }
+
+def schema_max_tokens(schema: Dict[str, Any]) -> int:
+    """Token budget for a response that fills the schema: every stage plus the envelope"""
+    return schema["properties"]["pipeline"]["maxItems"] * LLM_TOKENS_PER_STAGE + LLM_ENVELOPE_TOKENS
+
+LLM_SYSTEM_PROMPT = """You are a GenBI expert for tyre manufacturing. Convert natural language queries to MongoDB aggregation pipelines.
 
 Available Collections:
 - production_data: date, production_line, shift, tyre_type, planned_production, actual_production, defect_count, downtime_minutes
 - quality_metrics: date, production_line, defect_type, defect_count, severity, root_cause
 - equipment_downtime: date, equipment_type, equipment_id, downtime_minutes, reason, production_line
+- kpi_oee: date, shift, production_line, plant_id, availability, performance, quality_rate, oee
 
 Business Terms:
 - "efficiency" = actual_production / planned_production
@@ -359,225 +1054,4305 @@ Business Terms:
 - "this week" = current week
 - "production lines" = Line-A-Radial, Line-B-Bias, Line-C-HeavyDuty
 
-Return ONLY a valid MongoDB aggregation pipeline as JSON array. Include proper date filtering and grouping."""
-                        },
-                        {
-                            "role": "user",
-                            "content": prompt
-                        }
-                    ],
-                    "temperature": 0.1,
-                    "max_tokens": 1000
-                }
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                return result["choices"][0]["message"]["content"]
-            else:
-                return "[]"
-                
+Return ONLY a JSON object {"collection": <collection name>, "pipeline": [<aggregation stages>]}. Include proper date filtering and grouping."""
+
+def rejects_response_format(response: httpx.Response) -> bool:
+    """Whether an LLM backend's error is about the response_format rather than the request itself"""
+    body = response.text.lower()
+    return "response_format" in body or "json_schema" in body
+
+async def request_llm_completion(base_url: str, prompt: str, model: str) -> str:
+    """Send a single chat completion request to an LLM backend.
+
+    With LLM_STRUCTURED_OUTPUT the response is constrained to PIPELINE_RESPONSE_SCHEMA;
+    backends whose 400/422 errors name response_format or json_schema are remembered
+    and asked unconstrained. Other 400/422 errors (a prompt that is too long) are raised.
+    """
+    payload = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": LLM_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        "temperature": 0.1,
+        "max_tokens": LLM_UNSTRUCTURED_MAX_TOKENS
+    }
+    if LLM_STRUCTURED_OUTPUT and base_url not in schema_unsupported_backends:
+        schema = pipeline_response_schema()
+        payload["response_format"] = {
+            "type": "json_schema",
+            "json_schema": {"name": "aggregation_pipeline", "strict": True, "schema": schema}
+        }
+        payload["max_tokens"] = schema_max_tokens(schema)
+    async with httpx.AsyncClient(timeout=LLM_TIMEOUT_SECONDS) as client:
+        response = await client.post(f"{base_url}/v1/chat/completions", json=payload)
+        if response.status_code in (400, 422) and "response_format" in payload and rejects_response_format(response):
+            print(f"LLM backend {base_url} rejected response_format, falling back to unconstrained output")
+            schema_unsupported_backends.add(base_url)
+            payload.pop("response_format")
+            payload["max_tokens"] = LLM_UNSTRUCTURED_MAX_TOKENS
+            response = await client.post(f"{base_url}/v1/chat/completions", json=payload)
+
+        response.raise_for_status()
+        result = response.json()
+        choice = result["choices"][0]
+        if choice.get("finish_reason") == "length":
+            llm_parse_stats["truncated"] += 1
+        llm_parse_stats["completion_tokens"] += (result.get("usage") or {}).get("completion_tokens", 0)
+        return choice["message"]["content"]
+
+async def query_lmstudio(prompt: str, model: Optional[str] = None) -> str:
+    """Query LMStudio for natural language processing; raises LLMUnavailableError when no backend answers"""
+    model = model or LLM_FAST_MODEL
+    tried_backends: set = set()
+    try:
+        async for attempt in AsyncRetrying(
+            stop=stop_after_attempt(LLM_RETRY_ATTEMPTS),
+            wait=wait_exponential(multiplier=0.5, max=4),
+            retry=retry_if_exception(is_retryable_llm_error),
+            reraise=True
+        ):
+            with attempt:
+                backend = llm_router.acquire(avoid=tried_backends)
+                if backend is None:
+                    raise LLMUnavailableError("No LLM backend available")
+                tried_backends.add(backend.url)
+                started = time.monotonic()
+                try:
+                    content = await request_llm_completion(backend.url, prompt, model)
+                except Exception:
+                    llm_router.release(backend, False, time.monotonic() - started)
+                    raise
+                llm_router.release(backend, True, time.monotonic() - started)
+        return content
     except Exception as e:
         print(f"LMStudio error: {e}")
-        # Fallback pipeline for demo
-        return """[
-            {"$match": {"date": {"$gte": "2024-12-01"}}},
-            {"$group": {"_id": "$production_line", "total_production": {"$sum": "$actual_production"}, "total_defects": {"$sum": "$defect_count"}}},
-            {"$addFields": {"defect_rate": {"$divide": ["$total_defects", "$total_production"]}}},
-            {"$sort": {"total_production": -1}}
-        ]"""
+        raise LLMUnavailableError(str(e)) from e
+
+def is_valid_pipeline(pipeline: Any) -> bool:
+    """Check that a value looks like an aggregation pipeline: a list of single-operator stages"""
+    return isinstance(pipeline, list) and bool(pipeline) and all(
+        isinstance(stage, dict) and len(stage) == 1 and next(iter(stage)).startswith("$")
+        for stage in pipeline
+    )
+
+CODE_FENCE_PATTERN = re.compile(r"```(?:json)?\s*(.*?)(?:```|$)", re.DOTALL)
+UNQUOTED_KEY_PATTERN = re.compile(r'([{,]\s*)([A-Za-z_$][\w$.]*)\s*:')
+TRAILING_COMMA_PATTERN = re.compile(r",\s*([}\]])")
+DANGLING_MEMBER_PATTERN = re.compile(r'(,?\s*"[^"]*"\s*:|,)\s*$')
+
+def repair_json(text: str) -> str:
+    """Single cheap pass over near-valid JSON: drop code fences and surrounding prose,
+    quote bare keys, remove trailing commas and close whatever a truncated response left open"""
+    fenced = CODE_FENCE_PATTERN.search(text)
+    if fenced:
+        text = fenced.group(1)
+    starts = [index for index in (text.find("{"), text.find("[")) if index != -1]
+    if not starts:
+        return text
+    text = text[min(starts):]
+    text = UNQUOTED_KEY_PATTERN.sub(r'\1"\2":', text)
+    text = TRAILING_COMMA_PATTERN.sub(r"\1", text)
 
-def parse_pipeline_from_llm_response(llm_response: str) -> List[Dict]:
-    """Extract MongoDB pipeline from LLM response"""
+    closers = []
+    in_string = escaped = False
+    for index, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            closers.append("}" if char == "{" else "]")
+        elif char in "}]" and closers:
+            closers.pop()
+            if not closers:
+                return text[:index + 1]
+    if in_string:
+        text += '"'
+    text = DANGLING_MEMBER_PATTERN.sub("", text.rstrip())
+    return TRAILING_COMMA_PATTERN.sub(r"\1", text + "".join(reversed(closers)))
+
+def pipeline_from_document(document: Any) -> Tuple[Optional[List[Dict]], Optional[str]]:
+    """Accept the schema's {"collection", "pipeline"} object or a bare pipeline array,
+    keeping only pipelines made of allowed stages"""
+    collection = None
+    if isinstance(document, dict):
+        collection = document.get("collection")
+        document = document.get("pipeline")
+    if not is_valid_pipeline(document) or len(document) > LLM_PIPELINE_MAX_STAGES:
+        return None, None
+    if any(next(iter(stage)) not in LLM_PIPELINE_STAGES for stage in document):
+        return None, None
+    if collection not in QUERY_COLLECTIONS and collection not in VIRTUAL_COLLECTIONS:
+        collection = None
+    return document, collection
+
+def parse_llm_output(llm_response: str) -> Tuple[Optional[List[Dict]], Optional[str], str]:
+    """Parse a generated pipeline, repairing near-valid JSON once.
+
+    Returns (pipeline, collection, outcome) where outcome is "parsed", "repaired" or
+    "failed"; the pipeline is None when it failed.
+    """
     try:
-        # Try to find JSON array in the response
-        start_idx = llm_response.find('[')
-        end_idx = llm_response.rfind(']') + 1
-        
-        if start_idx != -1 and end_idx != -1:
-            pipeline_str = llm_response[start_idx:end_idx]
-            pipeline = json.loads(pipeline_str)
-            return pipeline
-        else:
-            # Fallback pipeline
-            return [
-                {"$group": {"_id": "$production_line", "total_production": {"$sum": "$actual_production"}}},
-                {"$sort": {"total_production": -1}}
-            ]
-    except Exception as e:
+        pipeline, collection = pipeline_from_document(json.loads(llm_response))
+        if pipeline is not None:
+            return pipeline, collection, "parsed"
+    except ValueError:
+        pass
+    try:
+        pipeline, collection = pipeline_from_document(json.loads(repair_json(llm_response)))
+    except ValueError as e:
         print(f"Pipeline parsing error: {e}")
-        return [{"$group": {"_id": "$production_line", "total_production": {"$sum": "$actual_production"}}}]
+        return None, None, "failed"
+    return pipeline, collection, "repaired" if pipeline is not None else "failed"
 
-@app.on_event("startup")
-async def startup_event():
-    """Initialize data on startup"""
-    init_sample_data()
+def record_llm_parse(outcome: str):
+    llm_parse_stats["responses"] += 1
+    llm_parse_stats[outcome] += 1
 
-@app.get("/api/health")
-async def health_check():
-    return {"status": "healthy", "timestamp": datetime.now().isoformat()}
+def llm_parse_snapshot() -> Dict[str, Any]:
+    responses = llm_parse_stats["responses"]
+    return {
+        **llm_parse_stats,
+        "structured_output": LLM_STRUCTURED_OUTPUT,
+        "max_tokens": schema_max_tokens(pipeline_response_schema()) if LLM_STRUCTURED_OUTPUT else LLM_UNSTRUCTURED_MAX_TOKENS,
+        "failure_rate": round(llm_parse_stats["failed"] / responses, 3) if responses else 0.0,
+        "repair_rate": round(llm_parse_stats["repaired"] / responses, 3) if responses else 0.0,
+        "unconstrained_backends": sorted(schema_unsupported_backends)
+    }
 
-@app.post("/api/query")
-async def process_natural_language_query(query: NLQuery):
-    """Process natural language query and return dashboard data"""
-    try:
-        # Get MongoDB pipeline from LMStudio
-        llm_response = await query_lmstudio(query.query)
-        pipeline = parse_pipeline_from_llm_response(llm_response)
-        
-        # Execute pipeline on production_data collection
-        results = list(db.production_data.aggregate(pipeline))
-        
-        # If no results from production_data, try quality_metrics
-        if not results:
-            results = list(db.quality_metrics.aggregate(pipeline))
-        
-        # If still no results, try equipment_downtime
-        if not results:
-            results = list(db.equipment_downtime.aggregate(pipeline))
-        
-        # Generate chart recommendations based on data structure
-        chart_type = "bar"
-        if len(results) > 0:
-            first_result = results[0]
-            if any(key for key in first_result.keys() if 'rate' in key.lower() or 'percentage' in key.lower()):
-                chart_type = "line"
-            elif len(results) > 10:
-                chart_type = "line"
-        
-        return {
-            "query": query.query,
-            "pipeline": pipeline,
-            "results": results,
-            "chart_type": chart_type,
-            "total_records": len(results),
-            "llm_response": llm_response
-        }
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Query processing error: {str(e)}")
+# Rule-based query translation
+DIMENSION_ALIASES = {
+    "line": "production_line",
+    "lines": "production_line",
+    "production line": "production_line",
+    "production lines": "production_line",
+    "shift": "shift",
+    "shifts": "shift",
+    "tyre": "tyre_type",
+    "tyres": "tyre_type",
+    "tyre type": "tyre_type",
+    "tire type": "tyre_type",
+    "operator": "operator_id",
+    "operators": "operator_id",
+    "equipment": "equipment_type",
+    "machine": "equipment_type",
+    "plant": "plant_id",
+    "plants": "plant_id",
+    "defect type": "defect_type",
+    "day": "date",
+    "date": "date",
+    "reason": "reason",
+    "severity": "severity",
+    "root cause": "root_cause"
+}
 
-@app.get("/api/semantic-mappings")
-async def get_semantic_mappings():
-    """Get all semantic mappings"""
-    mappings = list(db.semantic_mappings.find({}, {"_id": 0}))
-    return {"mappings": mappings}
+AVERAGE_WORDS = {"average", "avg", "mean"}
+TIME_WORDS = {"week", "weeks", "month", "months", "day", "days", "year", "since", "between", "before", "after", "ago", "quarter"}
+FILLER_WORDS = {
+    "show", "me", "what", "is", "are", "was", "were", "the", "a", "an", "of", "for", "each", "per", "by",
+    "in", "on", "across", "all", "total", "sum", "overall", "display", "give", "get", "list", "please",
+    "and", "our", "my", "to", "how", "much", "many", "did", "do", "we", "have", "has", "with", "top",
+    "breakdown", "compare", "trend", "trends", "chart", "plot", "s", "at", "plant", "plants"
+} | AVERAGE_WORDS
 
-@app.post("/api/semantic-mappings")
-async def create_semantic_mapping(mapping: SemanticMapping):
-    """Create new semantic mapping"""
-    mapping_doc = mapping.dict()
-    mapping_doc["_id"] = str(uuid.uuid4())
-    db.semantic_mappings.insert_one(mapping_doc)
-    return {"message": "Semantic mapping created", "id": mapping_doc["_id"]}
+rule_vocabulary_cache: Optional[Dict[str, Any]] = None
 
-@app.get("/api/dashboard/overview")
-async def dashboard_overview():
-    """Get dashboard overview data"""
-    try:
-        # Production summary
-        production_summary = list(db.production_data.aggregate([
-            {"$group": {
-                "_id": None,
-                "total_planned": {"$sum": "$planned_production"},
-                "total_actual": {"$sum": "$actual_production"},
-                "total_defects": {"$sum": "$defect_count"},
-                "total_downtime": {"$sum": "$downtime_minutes"}
-            }}
-        ]))
-        
-        # Production by line
-        production_by_line = list(db.production_data.aggregate([
-            {"$group": {
-                "_id": "$production_line",
-                "production": {"$sum": "$actual_production"},
-                "defects": {"$sum": "$defect_count"}
-            }},
-            {"$sort": {"production": -1}}
-        ]))
-        
-        # Defect trends (last 7 days)
-        defect_trends = list(db.quality_metrics.aggregate([
-            {"$group": {
-                "_id": "$date",
-                "total_defects": {"$sum": "$defect_count"}
-            }},
-            {"$sort": {"_id": -1}},
-            {"$limit": 7}
-        ]))
-        
-        # Equipment downtime
-        equipment_downtime = list(db.equipment_downtime.aggregate([
-            {"$group": {
-                "_id": "$equipment_type",
-                "total_downtime": {"$sum": "$downtime_minutes"}
-            }},
-            {"$sort": {"total_downtime": -1}}
-        ]))
-        
-        return {
-            "production_summary": production_summary[0] if production_summary else {},
-            "production_by_line": production_by_line,
-            "defect_trends": defect_trends,
-            "equipment_downtime": equipment_downtime
+def invalidate_rule_vocabulary():
+    global rule_vocabulary_cache
+    rule_vocabulary_cache = None
+
+def load_rule_vocabulary() -> Dict[str, Any]:
+    """Build the metric and dimension vocabulary from semantic_mappings and table_schemas"""
+    global rule_vocabulary_cache
+    if rule_vocabulary_cache is not None:
+        return rule_vocabulary_cache
+
+    table_columns: Dict[str, Dict[str, str]] = {}
+    for schema in db.table_schemas.find({}, {"_id": 0, "table_name": 1, "columns": 1}):
+        table_columns[schema["table_name"]] = {
+            column["name"]: column.get("type", "string") for column in schema.get("columns", [])
         }
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Dashboard error: {str(e)}")
 
-# ERD Management Endpoints
-@app.get("/api/table-schemas")
-async def get_table_schemas():
-    """Get all table schemas for ERD"""
-    try:
-        schemas = list(db.table_schemas.find({}, {"_id": 0}))
-        return {"schemas": schemas}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error fetching table schemas: {str(e)}")
+    metrics: Dict[str, Dict[str, Any]] = {}
+    # Numeric columns are metrics in their own right ("defect count", "energy consumption")
+    for table_name in QUERY_COLLECTIONS:
+        for column_name, column_type in table_columns.get(table_name, {}).items():
+            if column_type in ("integer", "float"):
+                metrics.setdefault(column_name.replace("_", " "), {
+                    "formula": column_name,
+                    "table_name": table_name,
+                    "from_mapping": False
+                })
+    # Semantic mappings take precedence over raw column names
+    for mapping in db.semantic_mappings.find({}, {"_id": 0}):
+        if mapping.get("table_name") in table_columns:
+            metrics[mapping["business_term"].lower()] = {
+                "formula": mapping["database_field"],
+                "table_name": mapping["table_name"],
+                "from_mapping": True
+            }
 
-@app.post("/api/table-schemas")
-async def create_table_schema(schema: TableSchema):
-    """Create new table schema"""
-    try:
-        schema_doc = schema.dict()
-        schema_doc["_id"] = str(uuid.uuid4())
-        db.table_schemas.insert_one(schema_doc)
-        return {"message": "Table schema created", "id": schema_doc["_id"]}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error creating table schema: {str(e)}")
+    rule_vocabulary_cache = {"metrics": metrics, "table_columns": table_columns}
+    return rule_vocabulary_cache
 
-@app.put("/api/table-schemas/{table_name}")
-async def update_table_schema(table_name: str, schema: TableSchema):
-    """Update table schema position and details"""
-    try:
-        schema_doc = schema.dict()
-        result = db.table_schemas.update_one(
-            {"table_name": table_name},
-            {"$set": schema_doc}
-        )
-        if result.modified_count > 0:
-            return {"message": "Table schema updated"}
-        else:
-            raise HTTPException(status_code=404, detail="Table schema not found")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error updating table schema: {str(e)}")
+# Derived metric formulas (semantic_mappings.database_field)
+class FormulaError(ValueError):
+    pass
 
-@app.get("/api/table-relationships")
-async def get_table_relationships():
-    """Get all table relationships for ERD"""
-    try:
-        relationships = list(db.table_relationships.find({}, {"_id": 0}))
-        return {"relationships": relationships}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error fetching table relationships: {str(e)}")
+FORMULA_OPERATORS = {
+    ast.Add: ("$add", np.add),
+    ast.Sub: ("$subtract", np.subtract),
+    ast.Mult: ("$multiply", np.multiply),
+    ast.Div: ("$divide", np.divide)
+}
 
-@app.post("/api/table-relationships")
-async def create_table_relationship(relationship: TableRelationship):
-    """Create new table relationship"""
+def check_formula_node(node: ast.AST) -> List[str]:
+    """Reject anything but numbers, field names, + - * / and unary minus; returns the fields used"""
+    if isinstance(node, ast.Name):
+        return [node.id]
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+        return []
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+        return check_formula_node(node.operand)
+    if isinstance(node, ast.BinOp) and type(node.op) in FORMULA_OPERATORS:
+        return check_formula_node(node.left) + check_formula_node(node.right)
+    raise FormulaError(f"Unsupported formula element: {ast.dump(node)[:60]}")
+
+def mongo_row_expression(node: ast.AST) -> Any:
+    """Per-document aggregation expression for a formula node"""
+    if isinstance(node, ast.Name):
+        return f"${node.id}"
+    if isinstance(node, ast.Constant):
+        return node.value
+    if isinstance(node, ast.UnaryOp):
+        operand = mongo_row_expression(node.operand)
+        return {"$multiply": [-1, operand]} if isinstance(node.op, ast.USub) else operand
+    left, right = mongo_row_expression(node.left), mongo_row_expression(node.right)
+    if isinstance(node.op, ast.Div):
+        return {"$cond": [{"$eq": [right, 0]}, None, {"$divide": [left, right]}]}
+    return {FORMULA_OPERATORS[type(node.op)][0]: [left, right]}
+
+def numpy_row_evaluator(node: ast.AST) -> Callable[[Dict[str, np.ndarray]], np.ndarray]:
+    """Vectorized per-row evaluator over a dict of column arrays"""
+    if isinstance(node, ast.Name):
+        return lambda columns: columns[node.id]
+    if isinstance(node, ast.Constant):
+        return lambda columns: np.float64(node.value)
+    if isinstance(node, ast.UnaryOp):
+        operand = numpy_row_evaluator(node.operand)
+        return (lambda columns: -operand(columns)) if isinstance(node.op, ast.USub) else operand
+    left, right = numpy_row_evaluator(node.left), numpy_row_evaluator(node.right)
+    operator = FORMULA_OPERATORS[type(node.op)][1]
+    return lambda columns: operator(left(columns), right(columns))
+
+def formula_constant(node: ast.AST) -> Optional[float]:
+    """Value of a formula node that uses no fields, else None"""
+    if check_formula_node(node):
+        return None
+    with np.errstate(divide="ignore", invalid="ignore"):
+        value = float(numpy_row_evaluator(node)({}))
+    return value if math.isfinite(value) else None
+
+def split_scaled_ratio(node: ast.AST) -> Optional[Tuple[ast.AST, ast.AST, float]]:
+    """(numerator, denominator, scale) of a division by a field expression, optionally multiplied
+    or divided by constants (defect_count / actual_production * 100), else None. A plain division
+    by a constant (downtime_minutes / 60) is not a ratio: it is summed like any other value"""
+    if isinstance(node, ast.UnaryOp):
+        inner = split_scaled_ratio(node.operand)
+        if inner and isinstance(node.op, ast.USub):
+            return inner[0], inner[1], -inner[2]
+        return inner
+    if not isinstance(node, ast.BinOp) or not isinstance(node.op, (ast.Mult, ast.Div)):
+        return None
+    right_constant = formula_constant(node.right)
+    if right_constant is not None and (isinstance(node.op, ast.Mult) or right_constant != 0):
+        inner = split_scaled_ratio(node.left)
+        if inner:
+            factor = right_constant if isinstance(node.op, ast.Mult) else 1 / right_constant
+            return inner[0], inner[1], inner[2] * factor
+    if isinstance(node.op, ast.Mult):
+        left_constant = formula_constant(node.left)
+        inner = split_scaled_ratio(node.right) if left_constant is not None else None
+        return (inner[0], inner[1], inner[2] * left_constant) if inner else None
+    return None if right_constant is not None else (node.left, node.right, 1.0)
+
+class CompiledFormula:
+    """A metric formula compiled for Mongo and NumPy.
+
+    Aggregated over a group, a formula whose top-level operator is a division by fields,
+    possibly scaled by constants (a percentage), is a ratio of sums (scale *
+    sum(numerator) / sum(denominator)); anything else, including a unit conversion like
+    downtime_minutes / 60, is summed (or averaged). Per-row ratios are never averaged,
+    which is what the LLM tends to do.
+    """
+
+    def __init__(self, formula: str):
+        try:
+            tree = ast.parse(formula.strip(), mode="eval").body
+        except SyntaxError as e:
+            raise FormulaError(f"Invalid formula {formula!r}: {e.msg}")
+        self.formula = formula
+        self.fields = sorted(set(check_formula_node(tree)))
+        ratio = split_scaled_ratio(tree)
+        self.is_ratio = ratio is not None
+        self.scale = ratio[2] if ratio else 1.0
+        if self.is_ratio:
+            self.parts = {"numerator": ratio[0], "denominator": ratio[1]}
+        else:
+            self.parts = {"value": tree}
+        self.row_expression = mongo_row_expression(tree)
+        self.part_evaluators = {name: numpy_row_evaluator(part) for name, part in self.parts.items()}
+
+    def group_accumulators(self, average: bool = False) -> Tuple[Dict[str, Any], Any]:
+        """$group accumulators and the $project expression computing the metric from them"""
+        if self.is_ratio:
+            accumulators = {name: {"$sum": mongo_row_expression(part)} for name, part in self.parts.items()}
+            ratio = {"$divide": ["$numerator", "$denominator"]}
+            if self.scale != 1:
+                ratio = {"$multiply": [self.scale, ratio]}
+            return accumulators, {"$cond": [{"$eq": ["$denominator", 0]}, None, ratio]}
+        return {"value": {"$avg" if average else "$sum": self.row_expression}}, "$value"
+
+    def evaluate(self, columns: Dict[str, np.ndarray], groups: Optional[np.ndarray] = None,
+                 average: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+        """Aggregate the metric over fetched columns, per distinct value of groups (or overall).
+
+        Returns (group keys, metric values); rows with a missing field are skipped like
+        Mongo's $sum skips non-numeric values.
+        """
+        length = len(next(iter(columns.values()))) if columns else 0
+        if groups is None:
+            groups = np.zeros(length, dtype=np.int64)
+        keys, inverse = np.unique(groups, return_inverse=True)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            sums = {}
+            for name, evaluator in self.part_evaluators.items():
+                values = np.broadcast_to(np.asarray(evaluator(columns), dtype=np.float64), (length,))
+                present = ~np.isnan(values)
+                sums[name] = np.bincount(inverse[present], weights=values[present], minlength=len(keys))
+                if name == "value" and average:
+                    sums[name] = sums[name] / np.bincount(inverse[present], minlength=len(keys))
+            if self.is_ratio:
+                metric = np.where(sums["denominator"] == 0, np.nan, self.scale * sums["numerator"] / sums["denominator"])
+            else:
+                metric = sums["value"]
+        return keys, metric
+
+    def describe(self) -> str:
+        accumulators, expression = self.group_accumulators()
+        return f"$group {json.dumps(accumulators)} then $project {json.dumps(expression)}"
+
+compiled_formulas: Dict[str, CompiledFormula] = {}
+
+def compile_formula(formula: str) -> CompiledFormula:
+    """Compile a formula once; compiled formulas are cached by their text"""
+    key = formula.strip()
+    if key not in compiled_formulas:
+        compiled_formulas[key] = CompiledFormula(key)
+    return compiled_formulas[key]
+
+def formula_columns(collection_name: str, compiled: CompiledFormula, group_by: Optional[str] = None,
+                    match: Optional[Dict[str, Any]] = None) -> Tuple[Dict[str, np.ndarray], Optional[np.ndarray]]:
+    """Fetch only the columns a formula needs as float arrays (NaN where missing), plus the group keys"""
+    projection = {field: 1 for field in compiled.fields + ([group_by] if group_by else [])}
+    projection["_id"] = 0
+    if collection_name in VIRTUAL_COLLECTIONS:
+        documents = aggregate_collection(collection_name, [{"$match": match or {}}, {"$project": projection}])
+    else:
+        documents = [
+            document for collection in fact_collections(collection_name)
+            for document in collection.find(match or {}, projection)
+        ]
+    columns = {
+        field: np.array([
+            float(document[field]) if isinstance(document.get(field), (int, float)) and not isinstance(document.get(field), bool)
+            else np.nan
+            for document in documents
+        ], dtype=np.float64)
+        for field in compiled.fields
+    }
+    if not columns:
+        columns = {"__rows": np.zeros(len(documents))}
+    groups = np.array([str(document.get(group_by)) for document in documents]) if group_by else None
+    return columns, groups
+
+def compile_metric_accumulators(formula: str, average: bool = False) -> Optional[Tuple[Dict[str, Any], Any]]:
+    """$group accumulators and final expression for a metric formula, or None if it can't be compiled"""
+    try:
+        return compile_formula(formula).group_accumulators(average)
+    except FormulaError:
+        return None
+
+def parse_time_range(text: str, today: Optional[datetime] = None) -> Tuple[Optional[Tuple[str, str]], Optional[str]]:
+    """Parse a relative time range from query text.
+
+    Returns ((start_date, end_date), matched_phrase) or (None, None).
+    """
+    today = today or datetime.now()
+    date_format = "%Y-%m-%d"
+    end = today.strftime(date_format)
+
+    match = re.search(r"\b(?:last|past|previous)\s+(\d+)\s+(day|week|month)s?\b", text)
+    if match:
+        days = int(match.group(1)) * {"day": 1, "week": 7, "month": 30}[match.group(2)]
+        return ((today - timedelta(days=days)).strftime(date_format), end), match.group(0)
+
+    fixed_ranges = [
+        (r"\btoday\b", today, today),
+        (r"\byesterday\b", today - timedelta(days=1), today - timedelta(days=1)),
+        (r"\b(?:last|past|previous)\s+week\b", today - timedelta(days=7), today),
+        (r"\bthis\s+week\b", today - timedelta(days=today.weekday()), today),
+        (r"\b(?:last|past|previous)\s+month\b", today - timedelta(days=30), today),
+        (r"\bthis\s+month\b", today.replace(day=1), today),
+    ]
+    for pattern, start_date, end_date in fixed_ranges:
+        match = re.search(pattern, text)
+        if match:
+            return (start_date.strftime(date_format), end_date.strftime(date_format)), match.group(0)
+    return None, None
+
+def match_rule_based_query(query_text: str) -> Optional[Dict[str, Any]]:
+    """Compile "<metric> by <dimension> <time range>" questions straight into a pipeline.
+
+    Returns the translation with a confidence score in [0, 1], or None when no
+    metric is recognised.
+    """
+    text = normalize_query(re.sub(r"[^\w\s/-]", " ", query_text))
+    vocabulary = load_rule_vocabulary()
+
+    # Longest matching metric term wins ("defect rate" over "defect count")
+    metric_term = None
+    for term in sorted(vocabulary["metrics"], key=len, reverse=True):
+        if re.search(rf"\b{re.escape(term)}s?\b", text):
+            metric_term = term
+            break
+    if not metric_term:
+        return None
+    metric = vocabulary["metrics"][metric_term]
+    table_columns = vocabulary["table_columns"].get(metric["table_name"], {})
+    remaining = re.sub(rf"\b{re.escape(metric_term)}s?\b", " ", text, count=1)
+    confidence = 0.5 if metric["from_mapping"] else 0.4
+
+    average = any(word in remaining.split() for word in AVERAGE_WORDS)
+    compiled = compile_metric_accumulators(metric["formula"], average=average)
+    if not compiled:
+        return None
+    accumulators, metric_expression = compiled
+
+    date_range, time_phrase = parse_time_range(remaining)
+    if date_range:
+        remaining = remaining.replace(time_phrase, " ")
+
+    # Named plants become a leading plant_id filter, which also prunes the shards queried
+    plants = []
+    for plant in sorted(PLANT_IDS, key=len, reverse=True):
+        plant_pattern = rf"(?<![\w-]){re.escape(plant.lower())}(?![\w-])"
+        if re.search(plant_pattern, remaining):
+            plants.append(plant)
+            remaining = re.sub(plant_pattern, " ", remaining)
+
+    dimension = None
+    by_match = re.search(r"\b(?:by|per|for each|across)\s+(.+)", remaining)
+    if by_match:
+        candidate = by_match.group(1)
+        for alias in sorted(DIMENSION_ALIASES, key=len, reverse=True):
+            if re.match(rf"{re.escape(alias)}\b", candidate) and DIMENSION_ALIASES[alias] in table_columns:
+                dimension = DIMENSION_ALIASES[alias]
+                remaining = remaining.replace(by_match.group(0), " " + candidate[len(alias):], 1)
+                break
+        if dimension:
+            confidence += 0.3
+        else:
+            confidence -= 0.3
+    else:
+        confidence += 0.3
+
+    if date_range:
+        confidence += 0.2
+    elif TIME_WORDS & set(remaining.split()) or re.search(r"\b\d{4}\b", remaining):
+        # Mentions a time range we cannot parse
+        confidence -= 0.3
+    else:
+        confidence += 0.2
+
+    limit = None
+    top_match = re.search(r"\btop\s+(\d+)\b", remaining)
+    if top_match:
+        limit = int(top_match.group(1))
+        remaining = remaining.replace(top_match.group(0), " ")
+
+    # Unrecognised words suggest the question says more than the template captures
+    leftover = [word for word in remaining.split() if word not in FILLER_WORDS]
+    confidence -= 0.15 * len(leftover)
+    confidence = round(max(0.0, min(1.0, confidence)), 2)
+
+    metric_field = re.sub(r"\W+", "_", metric_term).strip("_")
+    pipeline: List[Dict[str, Any]] = []
+    match: Dict[str, Any] = {}
+    if plants:
+        match["plant_id"] = plants[0] if len(plants) == 1 else {"$in": plants}
+    if date_range:
+        match["date"] = {"$gte": date_range[0], "$lte": date_range[1]}
+    if match:
+        pipeline.append({"$match": match})
+    pipeline.append({"$group": {"_id": f"${dimension}" if dimension else None, **accumulators}})
+    pipeline.append({"$project": {metric_field: metric_expression}})
+    if dimension == "date":
+        pipeline.append({"$sort": {"_id": 1}})
+    else:
+        pipeline.append({"$sort": {metric_field: -1}})
+    if limit:
+        pipeline.append({"$limit": limit})
+
+    return {
+        "pipeline": pipeline,
+        "collection": metric["table_name"],
+        "confidence": confidence,
+        "unmatched_terms": leftover
+    }
+
+# Embedding index
+def embed_text(text: str) -> np.ndarray:
+    """Embed text as a normalized hashed bag of words and character trigrams.
+
+    Deterministic and CPU-only, so the index can be rebuilt at startup without a model.
+    """
+    vector = np.zeros(EMBEDDING_DIMENSIONS, dtype=np.float32)
+    for word in re.findall(r"[a-z0-9]+", text.lower().replace("_", " ")):
+        vector[zlib.crc32(word.encode()) % EMBEDDING_DIMENSIONS] += 1.0
+        padded = f"#{word}#"
+        for start in range(len(padded) - 2):
+            vector[zlib.crc32(padded[start:start + 3].encode()) % EMBEDDING_DIMENSIONS] += 0.5
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+class VectorIndex:
+    """Flat inner-product index over normalized embeddings with in-place updates"""
+
+    def __init__(self):
+        self.vectors = np.zeros((64, EMBEDDING_DIMENSIONS), dtype=np.float32)
+        self.keys: List[Optional[str]] = []
+        self.payloads: List[Any] = []
+        self.rows: Dict[str, int] = {}
+        self.free_rows: List[int] = []
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def add(self, key: str, text: str, payload: Any):
+        """Insert or replace the entry stored under key"""
+        if key in self.rows:
+            row = self.rows[key]
+        elif self.free_rows:
+            row = self.free_rows.pop()
+        else:
+            row = len(self.keys)
+            self.keys.append(None)
+            self.payloads.append(None)
+            if row >= len(self.vectors):
+                grown = np.zeros((len(self.vectors) * 2, EMBEDDING_DIMENSIONS), dtype=np.float32)
+                grown[:len(self.vectors)] = self.vectors
+                self.vectors = grown
+        self.vectors[row] = embed_text(text)
+        self.keys[row] = key
+        self.payloads[row] = payload
+        self.rows[key] = row
+
+    def remove(self, key: str):
+        row = self.rows.pop(key, None)
+        if row is not None:
+            self.vectors[row] = 0.0
+            self.keys[row] = None
+            self.payloads[row] = None
+            self.free_rows.append(row)
+
+    def clear(self):
+        self.__init__()
+
+    def search(self, text: str, k: int, min_score: float = 0.0) -> List[Tuple[float, str, Any]]:
+        """Return up to k (score, key, payload) entries by cosine similarity"""
+        if not self.rows:
+            return []
+        scores = self.vectors[:len(self.keys)] @ embed_text(text)
+        k = min(k, len(scores))
+        top_rows = np.argpartition(-scores, k - 1)[:k]
+        return [
+            (float(scores[row]), self.keys[row], self.payloads[row])
+            for row in top_rows[np.argsort(-scores[top_rows])]
+            if self.keys[row] is not None and scores[row] >= min_score
+        ]
+
+schema_index = VectorIndex()
+query_index = VectorIndex()
+
+def index_semantic_mapping(mapping: Dict[str, Any]):
+    payload = f"\"{mapping['business_term']}\" = {mapping['database_field']} in {mapping['table_name']} ({mapping.get('description', '')})"
+    try:
+        # Spell out the exact aggregation so the LLM doesn't average per-row ratios
+        payload = f"{payload}; aggregate as {compile_formula(mapping['database_field']).describe()}"
+    except FormulaError:
+        pass
+    schema_index.add(
+        f"mapping:{mapping['business_term']}",
+        f"{mapping['business_term']} {mapping.get('description', '')} {mapping['database_field']}",
+        payload
+    )
+
+def index_table_schema(schema: Dict[str, Any]):
+    for column in schema.get("columns", []):
+        if column["name"] == "_id":
+            continue
+        schema_index.add(
+            f"column:{schema['table_name']}.{column['name']}",
+            f"{column['name']} {schema['table_name']}",
+            f"{schema['table_name']}.{column['name']} ({column.get('type', 'string')})"
+        )
+
+def rebuild_schema_index():
+    """Index all semantic mappings and table schema columns"""
+    schema_index.clear()
+    for mapping in db.semantic_mappings.find({}, {"_id": 0}):
+        index_semantic_mapping(mapping)
+    for schema in db.table_schemas.find({}, {"_id": 0}):
+        index_table_schema(schema)
+
+def build_llm_prompt(query_text: str) -> str:
+    """Add the most relevant business terms and columns to the user's question"""
+    matches = schema_index.search(query_text, RETRIEVAL_TOP_K, RETRIEVAL_MIN_SCORE)
+    if not matches:
+        return query_text
+    lines = []
+    tables = set()
+    for _, key, payload in matches:
+        if key.startswith("column:"):
+            table_name, column_name = key[len("column:"):].split(".", 1)
+            tables.add(table_name)
+            column_stats = describe_column_stats(table_name, column_name)
+            if column_stats:
+                payload = f"{payload}: {column_stats}"
+        lines.append(f"- {payload}")
+    for relationship in db.table_relationships.find({"from_table": {"$in": sorted(tables)}}):
+        lines.append(
+            f"- join {relationship['from_table']}.{relationship['from_column']} -> "
+            f"{relationship['to_table']}.{relationship['to_column']} ({relationship.get('relationship_type', 'unknown')})"
+        )
+    context = "\n".join(lines)
+    return f"Relevant business terms and columns:\n{context}\n\nQuestion: {query_text}"
+
+def content_words(text: str) -> set:
+    """Meaningful words of a query, singularized, for near-duplicate checks"""
+    return {
+        word[:-1] if len(word) > 3 and word.endswith("s") else word
+        for word in re.findall(r"[a-z0-9]+", text.lower())
+        if word not in FILLER_WORDS
+    }
+
+def trigram_similarity(first: str, second: str) -> float:
+    first_grams = {first[i:i + 3] for i in range(len(first) - 2)} or {first}
+    second_grams = {second[i:i + 3] for i in range(len(second) - 2)} or {second}
+    return 2 * len(first_grams & second_grams) / (len(first_grams) + len(second_grams))
+
+def is_equivalent_query(first: str, second: str) -> bool:
+    """Queries are equivalent when their content words match up to typos/inflections
+    and their numbers are identical"""
+    first_words, second_words = content_words(first), content_words(second)
+    if {w for w in first_words if w.isdigit()} != {w for w in second_words if w.isdigit()}:
+        return False
+    only_first, only_second = first_words - second_words, second_words - first_words
+    if len(only_first) != len(only_second):
+        return False
+    return all(
+        any(word[0] == other[0] and trigram_similarity(word, other) >= 0.5 for other in only_second)
+        for word in only_first
+    )
+
+def find_near_duplicate_translation(cache_key: str) -> Optional[Dict[str, Any]]:
+    """Reuse the cached translation of a differently-worded but equivalent query.
+
+    The embedding search only proposes a candidate; is_equivalent_query decides,
+    so "last 7 days" never matches "last 14 days".
+    """
+    query_words = " ".join(sorted(content_words(cache_key)))
+    for score, candidate_key, _ in query_index.search(query_words, 3, NEAR_DUPLICATE_MIN_SCORE):
+        if candidate_key != cache_key and is_equivalent_query(candidate_key, cache_key):
+            translation = get_cached_translation(candidate_key)
+            if translation:
+                translation["matched_query"] = candidate_key
+                translation["similarity"] = round(score, 3)
+                return translation
+    return None
+
+def normalize_query(query_text: str) -> str:
+    """Normalize NL query text for cache lookups and deduplication"""
+    return " ".join(query_text.lower().split())
+
+def get_cached_translation(cache_key: str, allow_stale: bool = False) -> Optional[Dict[str, Any]]:
+    """Return a copy of a cached translation if present and not expired.
+
+    Expired entries are kept (until evicted) so they can still be served with
+    allow_stale when the LLM is unavailable.
+    """
+    entry = query_cache.get(cache_key)
+    if not entry:
+        return None
+    if not allow_stale and time.time() - entry["cached_at"] > QUERY_CACHE_TTL_SECONDS:
+        return None
+    query_cache.move_to_end(cache_key)
+    return copy.deepcopy(entry["translation"])
+
+def store_cached_translation(cache_key: str, translation: Dict[str, Any]):
+    """Store a translation, evicting the least recently used entries"""
+    query_cache[cache_key] = {"translation": copy.deepcopy(translation), "cached_at": time.time()}
+    query_cache.move_to_end(cache_key)
+    query_index.add(cache_key, " ".join(sorted(content_words(cache_key))), None)
+    while len(query_cache) > QUERY_CACHE_MAX_ENTRIES:
+        evicted_key, _ = query_cache.popitem(last=False)
+        query_index.remove(evicted_key)
+
+MULTI_PART_QUERY_PATTERN = re.compile(r"\b(and|compare|compared|versus|vs|between|correlat\w*|join|relative|ratio|trend)\b")
+
+def select_llm_model(query_text: str) -> str:
+    """Send short single-part questions to the fast model and the rest to the large one"""
+    text = normalize_query(query_text)
+    if len(text.split()) > LLM_FAST_MODEL_MAX_WORDS or MULTI_PART_QUERY_PATTERN.search(text):
+        return LLM_LARGE_MODEL
+    return LLM_FAST_MODEL
+
+async def _translate_with_llm(query_text: str, rule_translation: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    model = select_llm_model(query_text)
+    async with llm_scheduler.slot():
+        prompt = build_llm_prompt(query_text)
+        try:
+            llm_response = await query_lmstudio(prompt, model)
+            pipeline, collection, outcome = parse_llm_output(llm_response)
+            record_llm_parse(outcome)
+            # Escalate to the large model when the fast one produces an unusable pipeline
+            if pipeline is None and model != LLM_LARGE_MODEL:
+                model = LLM_LARGE_MODEL
+                llm_response = await query_lmstudio(prompt, model)
+                pipeline, collection, outcome = parse_llm_output(llm_response)
+                record_llm_parse(outcome)
+        except LLMUnavailableError:
+            return degraded_translation(query_text, rule_translation)
+    if pipeline is None:
+        translation = degraded_translation(query_text, rule_translation)
+        translation.update({"parse_error": True, "llm_response": llm_response, "model": model})
+        return translation
+    return {
+        "pipeline": pipeline,
+        "collection": collection or infer_pipeline_collection(pipeline),
+        "llm_response": llm_response,
+        "source": "llm",
+        "model": model,
+        "parse_outcome": outcome,
+        "degraded": False
+    }
+
+def degraded_translation(query_text: str, rule_translation: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Best answer available without the LLM: a stale cache entry, a lower-confidence
+    rule match, or the fixed fallback pipeline"""
+    stale = get_cached_translation(normalize_query(query_text), allow_stale=True)
+    if stale:
+        stale.update({"source": "stale_cache", "degraded": True})
+        return stale
+    if rule_translation and rule_translation["confidence"] >= RULE_DEGRADED_MIN_CONFIDENCE:
+        return {
+            "pipeline": rule_translation["pipeline"],
+            "collection": rule_translation["collection"],
+            "llm_response": None,
+            "source": "rules",
+            "confidence": rule_translation["confidence"],
+            "degraded": True
+        }
+    return {
+        "pipeline": json.loads(FALLBACK_LLM_RESPONSE),
+        "collection": None,
+        "llm_response": FALLBACK_LLM_RESPONSE,
+        "source": "fallback",
+        "degraded": True
+    }
+
+async def _translate_uncached(query_text: str) -> Dict[str, Any]:
+    try:
+        rule_translation = match_rule_based_query(query_text)
+    except Exception as e:
+        print(f"Rule-based translation error: {e}")
+        rule_translation = None
+    if rule_translation and rule_translation["confidence"] >= RULE_CONFIDENCE_THRESHOLD:
+        return {
+            "pipeline": rule_translation["pipeline"],
+            "collection": rule_translation["collection"],
+            "llm_response": None,
+            "source": "rules",
+            "confidence": rule_translation["confidence"]
+        }
+
+    # Don't queue behind backends that are known to be down
+    if not llm_router.has_available_backend():
+        return degraded_translation(query_text, rule_translation)
+
+    cache_key = normalize_query(query_text)
+    llm_task = asyncio.ensure_future(_translate_with_llm(query_text, rule_translation))
+    try:
+        return await asyncio.wait_for(asyncio.shield(llm_task), LLM_LATENCY_BUDGET_SECONDS)
+    except asyncio.TimeoutError:
+        # Let the LLM finish in the background so the next request hits the cache
+        def cache_late_translation(task: asyncio.Task):
+            if not task.cancelled() and not task.exception() and not task.result().get("degraded"):
+                store_cached_translation(cache_key, task.result())
+        llm_task.add_done_callback(cache_late_translation)
+        return degraded_translation(query_text, rule_translation)
+
+async def translate_query(query_text: str) -> Dict[str, Any]:
+    """Translate an NL query into a pipeline via the cache, the rule-based matcher or the LLM.
+
+    Identical queries that are already being translated share the same LLM call,
+    and all LLM calls go through the shared concurrency limit.
+    """
+    cache_key = normalize_query(query_text)
+    cached = get_cached_translation(cache_key) or find_near_duplicate_translation(cache_key)
+    if cached:
+        cached["cached"] = True
+        return cached
+
+    task = inflight_translations.get(cache_key)
+    if task is None:
+        task = asyncio.ensure_future(_translate_uncached(query_text))
+        inflight_translations[cache_key] = task
+        task.add_done_callback(lambda _: inflight_translations.pop(cache_key, None))
+        translation = await asyncio.shield(task)
+        if not translation.get("degraded"):
+            store_cached_translation(cache_key, translation)
+    else:
+        translation = await asyncio.shield(task)
+
+    translation = copy.deepcopy(translation)
+    translation["cached"] = False
+    return translation
+
+# Plant shards: fact collections (QUERY_COLLECTIONS) are partitioned by plant_id
+# Stages that only look at one document (or lookup into the same shard) run on each shard as-is
+SHARD_LOCAL_STAGES = {"$match", "$project", "$addFields", "$set", "$unset", "$unwind", "$replaceRoot", "$replaceWith"}
+
+# Daily rollups kept for archived fact collections: group-by dimensions and summed measures
+ROLLUP_SPECS = {
+    "production_data": {
+        "dimensions": ["plant_id", "production_line", "shift", "tyre_type"],
+        "measures": ["planned_production", "actual_production", "defect_count", "downtime_minutes",
+                     "raw_material_usage", "energy_consumption"]
+    },
+    "quality_metrics": {
+        "dimensions": ["plant_id", "production_line", "defect_type", "severity", "root_cause"],
+        "measures": ["defect_count"]
+    },
+    "equipment_downtime": {
+        "dimensions": ["plant_id", "equipment_type", "equipment_id", "production_line", "reason"],
+        "measures": ["downtime_minutes"]
+    }
+}
+
+def rollup_collection_name(collection_name: str) -> str:
+    return f"{collection_name}_daily"
+
+def is_sharded_collection(collection_name: str) -> bool:
+    return bool(shard_databases) and (
+        collection_name in QUERY_COLLECTIONS
+        or collection_name in {rollup_collection_name(name) for name in ROLLUP_SPECS}
+    )
+
+def fact_collections(collection_name: str, plants: Optional[List[str]] = None) -> List[Any]:
+    """Collections holding a fact collection's documents: one per plant shard, or the main one"""
+    if not is_sharded_collection(collection_name):
+        return [db[collection_name]]
+    return [shard_databases[plant][collection_name] for plant in (plants if plants is not None else shard_databases)]
+
+def insert_fact_documents(collection_name: str, documents: List[Dict[str, Any]]):
+    """Insert fact documents, routing each to its plant's shard"""
+    bump_collection_version(collection_name)
+    if not is_sharded_collection(collection_name):
+        if documents:
+            db[collection_name].insert_many(documents)
+        return
+    by_plant: Dict[str, List[Dict[str, Any]]] = {}
+    for document in documents:
+        if document.get("plant_id") not in shard_databases:
+            raise ValueError(f"Unknown plant_id {document.get('plant_id')!r} for {collection_name}")
+        by_plant.setdefault(document["plant_id"], []).append(document)
+    for plant, plant_documents in by_plant.items():
+        shard_databases[plant][collection_name].insert_many(plant_documents)
+
+def target_plants(pipeline: List[Dict]) -> List[str]:
+    """Plant shards a pipeline needs, pruned by a plant_id filter in its leading $match"""
+    plants = list(shard_databases)
+    if not pipeline or not isinstance(pipeline[0].get("$match"), dict):
+        return plants
+    condition = pipeline[0]["$match"].get("plant_id")
+    if isinstance(condition, str):
+        return [plant for plant in plants if plant == condition]
+    if isinstance(condition, dict) and set(condition) <= {"$eq", "$in"}:
+        wanted = set(condition.get("$in", [])) | ({condition["$eq"]} if "$eq" in condition else set())
+        return [plant for plant in plants if plant in wanted]
+    return plants
+
+def decompose_group(group: Dict[str, Any]) -> Optional[Tuple[Dict[str, Any], List[Dict]]]:
+    """Split a $group into a per-shard partial $group and the coordinator stages merging the partials.
+
+    $sum/$min/$max/$count merge with the same operator, $avg is carried as a sum and a
+    count of numeric values. Returns None for accumulators that can't be merged (e.g. $first).
+    """
+    partial: Dict[str, Any] = {"_id": group["_id"]}
+    merged: Dict[str, Any] = {"_id": "$_id"}
+    averages: Dict[str, Any] = {}
+    for field_name, accumulator in group.items():
+        if field_name == "_id":
+            continue
+        if not isinstance(accumulator, dict) or len(accumulator) != 1:
+            return None
+        operator, expression = next(iter(accumulator.items()))
+        if operator in ("$sum", "$min", "$max"):
+            partial[field_name] = {operator: expression}
+            merged[field_name] = {operator: f"${field_name}"}
+        elif operator == "$count":
+            partial[field_name] = {"$sum": 1}
+            merged[field_name] = {"$sum": f"${field_name}"}
+        elif operator == "$avg":
+            sum_field, count_field = f"__{field_name}_sum", f"__{field_name}_count"
+            partial[sum_field] = {"$sum": expression}
+            partial[count_field] = {"$sum": {"$cond": [{"$isNumber": expression}, 1, 0]}}
+            merged[sum_field] = {"$sum": f"${sum_field}"}
+            merged[count_field] = {"$sum": f"${count_field}"}
+            averages[field_name] = {"$cond": [
+                {"$eq": [f"${count_field}", 0]}, None, {"$divide": [f"${sum_field}", f"${count_field}"]}
+            ]}
+        else:
+            return None
+    merge_stages: List[Dict] = [{"$group": merged}]
+    if averages:
+        merge_stages.append({"$addFields": averages})
+        merge_stages.append({"$project": {
+            helper: 0 for field_name in averages for helper in (f"__{field_name}_sum", f"__{field_name}_count")
+        }})
+    return partial, merge_stages
+
+def split_pipeline_for_shards(pipeline: List[Dict], local_collections: set) -> Tuple[List[Dict], List[Dict]]:
+    """Split a pipeline into the part every shard runs and the part the coordinator runs on the union"""
+    index = 0
+    while index < len(pipeline):
+        stage = pipeline[index]
+        operator = next(iter(stage), None) if isinstance(stage, dict) and len(stage) == 1 else None
+        if operator in SHARD_LOCAL_STAGES or (
+                operator == "$lookup" and stage["$lookup"].get("from") in local_collections):
+            index += 1
+            continue
+        break
+    shard_pipeline, rest = list(pipeline[:index]), list(pipeline[index:])
+    if not rest:
+        return shard_pipeline, []
+
+    first = rest[0]
+    if "$group" in first and len(first) == 1:
+        decomposed = decompose_group(first["$group"])
+        if decomposed:
+            partial, merge_stages = decomposed
+            return shard_pipeline + [{"$group": partial}], merge_stages + rest[1:]
+    elif "$limit" in first:
+        return shard_pipeline + [first], rest
+    elif "$sort" in first and len(rest) > 1 and "$limit" in rest[1]:
+        # Top-k: each shard only needs to return its own top k
+        return shard_pipeline + rest[:2], rest
+    return shard_pipeline, rest
+
+def aggregate_documents(documents: List[Dict[str, Any]], pipeline: List[Dict]) -> List[Dict[str, Any]]:
+    """Run a pipeline over in-memory documents ($documents), without writing them anywhere"""
+    return list(db.aggregate([{"$documents": documents}] + pipeline))
+
+def merge_on_coordinator(documents: List[Dict[str, Any]], merge_pipeline: List[Dict]) -> List[Dict[str, Any]]:
+    """Run the coordinator part of a sharded pipeline over the shards' partial results"""
+    if not merge_pipeline:
+        return documents
+    if len(documents) <= SHARD_MERGE_DOCUMENTS_LIMIT:
+        return aggregate_documents(documents, merge_pipeline)
+    # Partial $group results from different shards share _id values, so wrap each document
+    merge_collection = f"shard_merge_{uuid.uuid4().hex}"
+    try:
+        db[merge_collection].insert_many([{"_id": index, "document": document} for index, document in enumerate(documents)])
+        return list(db[merge_collection].aggregate([{"$replaceRoot": {"newRoot": "$document"}}] + merge_pipeline))
+    finally:
+        db[merge_collection].drop()
+
+def aggregate_sharded(collection_name: str, pipeline: List[Dict], extra_collections: Optional[List[Any]] = None) -> List[Dict[str, Any]]:
+    """Scatter a pipeline to the plant shards (and any extra partitions) concurrently and gather the merged results"""
+    sources = [shard_databases[plant][collection_name] for plant in target_plants(pipeline)] + (extra_collections or [])
+    if len(sources) == 1:
+        return list(sources[0].aggregate(pipeline))
+    # $lookup only stays on the shards when every source holds the looked-up collection next to it
+    local_collections = set() if extra_collections else set(QUERY_COLLECTIONS)
+    shard_pipeline, merge_pipeline = split_pipeline_for_shards(pipeline, local_collections)
+    partials = shard_executor.map(lambda source: list(source.aggregate(shard_pipeline)), sources)
+    return merge_on_coordinator([document for partial in partials for document in partial], merge_pipeline)
+
+def aggregate_collection(collection_name: str, pipeline: List[Dict], plan: bool = True) -> List[Dict[str, Any]]:
+    """Run a pipeline on a collection, scatter-gathering across plant shards when sharded
+    and reading archived rows when its date range reaches past the retention watermark.
+
+    Pipelines with $lookup stages go through the join planner first unless plan is False.
+    """
+    if collection_name in VIRTUAL_COLLECTIONS:
+        collection_name, prefixer = VIRTUAL_COLLECTIONS[collection_name]
+        pipeline = prefixer(pipeline)
+    if plan and any(isinstance(stage, dict) and "$lookup" in stage for stage in pipeline):
+        return aggregate_with_joins(collection_name, pipeline)
+    if collection_name in archive_watermarks and reaches_archive(collection_name, pipeline):
+        return aggregate_with_archive(collection_name, pipeline)
+    if is_sharded_collection(collection_name):
+        return aggregate_sharded(collection_name, pipeline)
+    return list(db[collection_name].aggregate(pipeline))
+
+# Join planning for pipelines with $lookup stages, using table_relationships
+def lookup_block_at(pipeline: List[Dict], index: int) -> Optional[Dict[str, Any]]:
+    """A simple equality $lookup at index, with the $unwind of its output that follows it (if any)"""
+    stage = pipeline[index] if index < len(pipeline) else None
+    lookup = stage.get("$lookup") if isinstance(stage, dict) and len(stage) == 1 else None
+    if not isinstance(lookup, dict) or set(lookup) != {"from", "localField", "foreignField", "as"}:
+        return None
+    if not all(isinstance(value, str) for value in lookup.values()) or "." in lookup["as"]:
+        return None
+    unwind = pipeline[index + 1].get("$unwind") if index + 1 < len(pipeline) else None
+    unwind_path = unwind.get("path") if isinstance(unwind, dict) else unwind
+    has_unwind = unwind_path == f"${lookup['as']}"
+    return {
+        "lookup": lookup,
+        "unwind": pipeline[index + 1] if has_unwind else None,
+        "inner": has_unwind and not (isinstance(unwind, dict) and unwind.get("preserveNullAndEmptyArrays")),
+        "length": 2 if has_unwind else 1
+    }
+
+def references_field(value: Any, prefix: str) -> bool:
+    """Whether an expression references $prefix or $prefix.<sub-field>"""
+    if isinstance(value, str):
+        return value == f"${prefix}" or value.startswith(f"${prefix}.")
+    if isinstance(value, dict):
+        return any(references_field(key, prefix) or references_field(item, prefix) for key, item in value.items())
+    if isinstance(value, list):
+        return any(references_field(item, prefix) for item in value)
+    return False
+
+def relationship_type(from_table: str, from_column: str, to_table: str, to_column: str) -> str:
+    relationship = db.table_relationships.find_one({
+        "from_table": from_table, "from_column": from_column, "to_table": to_table, "to_column": to_column
+    })
+    if relationship:
+        return relationship.get("relationship_type", "unknown")
+    reverse = db.table_relationships.find_one({
+        "from_table": to_table, "from_column": to_column, "to_table": from_table, "to_column": from_column
+    })
+    if reverse:
+        return {"one-to-many": "many-to-one", "many-to-one": "one-to-many"}.get(reverse.get("relationship_type"), reverse.get("relationship_type", "unknown"))
+    return "unknown"
+
+def push_filters_before_lookups(pipeline: List[Dict]) -> List[Dict]:
+    """Move $match conditions on base fields ahead of the $lookup blocks preceding them"""
+    pipeline = list(pipeline)
+    moved = True
+    while moved:
+        moved = False
+        for index, stage in enumerate(pipeline):
+            if set(stage) != {"$match"} or not isinstance(stage["$match"], dict):
+                continue
+            for length in (2, 1):
+                block = lookup_block_at(pipeline, index - length) if index - length >= 0 else None
+                if block and block["length"] == length:
+                    break
+            else:
+                continue
+            joined_field = block["lookup"]["as"]
+            # Operators like $or/$expr may mix base and joined fields; only plain field conditions move
+            movable = {
+                key: condition for key, condition in stage["$match"].items()
+                if not key.startswith("$") and key != joined_field and not key.startswith(f"{joined_field}.")
+            }
+            if not movable:
+                continue
+            remaining = {key: condition for key, condition in stage["$match"].items() if key not in movable}
+            block_start = index - block["length"]
+            pipeline[index:index + 1] = [{"$match": remaining}] if remaining else []
+            pipeline.insert(block_start, {"$match": movable})
+            moved = True
+            break
+    return pipeline
+
+def estimate_match_selectivity(collection_name: str, conditions: Dict[str, Any], prefix: str = "") -> float:
+    """Estimated fraction of collection_name documents passing the $match conditions on prefix.<field>.
+
+    Equality and $in use sampled value frequencies; conditions without statistics count as 1.
+    """
+    selectivity = 1.0
+    for key, condition in conditions.items():
+        if prefix and not key.startswith(f"{prefix}."):
+            continue
+        field_name = key[len(prefix) + 1:] if prefix else key
+        if isinstance(condition, dict) and set(condition) == {"$eq"}:
+            condition = condition["$eq"]
+        if isinstance(condition, dict) and set(condition) == {"$in"} and isinstance(condition["$in"], list):
+            estimates = [estimate_selectivity(collection_name, field_name, value) for value in condition["$in"]]
+            estimate = None if None in estimates else min(sum(estimates), 1.0)
+        elif isinstance(condition, (str, int, float, bool)):
+            estimate = estimate_selectivity(collection_name, field_name, condition)
+        else:
+            estimate = None
+        if estimate is not None:
+            selectivity *= estimate
+    return selectivity
+
+def order_lookup_blocks(collection_name: str, pipeline: List[Dict]) -> List[Dict]:
+    """Reorder adjacent independent inner joins: filtered joins first (most selective filter
+    first, from collection statistics), then row-preserving (many-to-one) ones, so later
+    joins see as few rows as possible"""
+    index = 0
+    while index < len(pipeline):
+        segments = []
+        cursor = index
+        while True:
+            block = lookup_block_at(pipeline, cursor)
+            if not block or not block["inner"]:
+                break
+            end = cursor + block["length"]
+            joined_field = block["lookup"]["as"]
+            filtered = end < len(pipeline) and set(pipeline[end]) == {"$match"} and any(
+                key == joined_field or key.startswith(f"{joined_field}.") for key in pipeline[end]["$match"]
+            )
+            if filtered:
+                end += 1
+            segments.append((block, pipeline[cursor:end], filtered))
+            cursor = end
+        joined_fields = [block["lookup"]["as"] for block, _, _ in segments]
+        independent = all(
+            not any(references_field(f"${block['lookup']['localField']}", field) for field in joined_fields)
+            for block, _, _ in segments
+        )
+        if len(segments) > 1 and independent:
+            def rank(segment):
+                block, stages, filtered = segment
+                cardinality = relationship_type(
+                    collection_name, block["lookup"]["localField"], block["lookup"]["from"], block["lookup"]["foreignField"]
+                )
+                selectivity = estimate_match_selectivity(
+                    block["lookup"]["from"], stages[-1]["$match"], block["lookup"]["as"]
+                ) if filtered else 1.0
+                return (not filtered, selectivity, cardinality != "many-to-one")
+            ordered = sorted(segments, key=rank)
+            pipeline[index:cursor] = [stage for _, stages, _ in ordered for stage in stages]
+        index = max(cursor, index + 1)
+    return pipeline
+
+def push_group_before_lookup(pipeline: List[Dict]) -> List[Dict]:
+    """Pre-aggregate by the join key before a $lookup + $unwind that feeds a $group.
+
+    The joined side is then looked up once per key instead of once per row. The
+    final $group merges the partial accumulators (see decompose_group).
+    """
+    for index in range(len(pipeline)):
+        block = lookup_block_at(pipeline, index)
+        if not block or not block["unwind"]:
+            continue
+        group_index = index + block["length"]
+        group_stage = pipeline[group_index] if group_index < len(pipeline) else None
+        if not group_stage or set(group_stage) != {"$group"}:
+            continue
+        group = group_stage["$group"]
+        joined_field = block["lookup"]["as"]
+        if any(references_field(accumulator, joined_field) for field_name, accumulator in group.items() if field_name != "_id"):
+            continue
+        decomposed = decompose_group(group)
+        if not decomposed or joined_field in decomposed[0]:
+            continue
+        partial, merge_stages = decomposed
+
+        # Fields of the group key that come from the base rows are carried in the pre-group key
+        carried: Dict[str, str] = {}
+        def rewrite_key(value: Any) -> Any:
+            if isinstance(value, str) and value.startswith("$") and not value.startswith("$$"):
+                if references_field(value, joined_field):
+                    return value
+                carried.setdefault(value, f"k{len(carried)}")
+                return f"$_id.{carried[value]}"
+            if isinstance(value, dict):
+                return {key: rewrite_key(item) for key, item in value.items()}
+            if isinstance(value, list):
+                return [rewrite_key(item) for item in value]
+            return value
+        final_key = rewrite_key(group["_id"])
+
+        pre_group = dict(partial)
+        pre_group["_id"] = {"join_key": f"${block['lookup']['localField']}", **{name: path for path, name in carried.items()}}
+        lookup = dict(block["lookup"], localField="_id.join_key")
+        unwind = copy.deepcopy(block["unwind"])
+        merge_group = dict(merge_stages[0]["$group"], _id=final_key)
+        pipeline[index:group_index + 1] = [
+            {"$group": pre_group}, {"$lookup": lookup}, unwind, {"$group": merge_group}
+        ] + merge_stages[1:]
+        return pipeline
+    return pipeline
+
+def plan_joins(collection_name: str, pipeline: List[Dict]) -> List[Dict]:
+    pipeline = push_filters_before_lookups(pipeline)
+    pipeline = order_lookup_blocks(collection_name, pipeline)
+    return push_group_before_lookup(pipeline)
+
+ensured_join_indexes: set = set()
+
+def is_known_collection(collection_name: str) -> bool:
+    """Fact collections and tables registered in table_schemas (not whatever a pipeline names)"""
+    return collection_name in QUERY_COLLECTIONS or db.table_schemas.count_documents({"table_name": collection_name}, limit=1) > 0
+
+def ensure_join_index(collection_name: str, field_name: str):
+    """Index a $lookup foreignField once per process so joins aren't nested-loop scans"""
+    if (collection_name, field_name) in ensured_join_indexes or not is_known_collection(collection_name):
+        return
+    if field_name != "_id":
+        db[collection_name].create_index(field_name)
+    ensured_join_indexes.add((collection_name, field_name))
+
+dimension_maps: Dict[Tuple[str, str], Tuple[float, int, Dict[str, List[Dict[str, Any]]]]] = {}
+
+def is_dimension_target(collection_name: str, field_name: str) -> bool:
+    """Whether collection_name.field_name is the "one" side of a declared many-to-one relationship"""
+    return db.table_relationships.count_documents({"$or": [
+        {"to_table": collection_name, "to_column": field_name, "relationship_type": "many-to-one"},
+        {"from_table": collection_name, "from_column": field_name, "relationship_type": "one-to-many"}
+    ]}, limit=1) > 0
+
+def join_key(value: Any) -> str:
+    """Hashable key matching $lookup equality: numbers compare by value, so 1 and 1.0 are the same key"""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return json.dumps(value, sort_keys=True, default=str)
+
+def dimension_map(collection_name: str, field_name: str) -> Optional[Dict[str, List[Dict[str, Any]]]]:
+    """Cached field value -> documents map of a small dimension collection, or None if the
+    target isn't a dimension table or is too big"""
+    version = collection_versions.get(collection_name, 0)
+    cached = dimension_maps.get((collection_name, field_name))
+    if cached and cached[1] == version and time.time() - cached[0] < DIMENSION_CACHE_TTL_SECONDS:
+        return cached[2]
+    if is_sharded_collection(collection_name) or not is_dimension_target(collection_name, field_name):
+        return None
+    if db[collection_name].estimated_document_count() > HASH_JOIN_MAX_ROWS:
+        return None
+    documents_by_value: Dict[str, List[Dict[str, Any]]] = {}
+    for document in db[collection_name].find({}):
+        documents_by_value.setdefault(join_key(document.get(field_name)), []).append(document)
+    dimension_maps[(collection_name, field_name)] = (time.time(), version, documents_by_value)
+    return documents_by_value
+
+def field_value(document: Dict[str, Any], path: str) -> Any:
+    value: Any = document
+    for part in path.split("."):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+def hash_join(documents: List[Dict[str, Any]], lookup: Dict[str, str],
+              documents_by_value: Dict[str, List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """In-process equivalent of an equality $lookup against a dimension map"""
+    for document in documents:
+        value = field_value(document, lookup["localField"])
+        values = value if isinstance(value, list) else [value]
+        matches: List[Dict[str, Any]] = []
+        for item in values:
+            matches.extend(documents_by_value.get(join_key(item), []))
+        document[lookup["as"]] = matches
+    return documents
+
+def aggregate_with_joins(collection_name: str, pipeline: List[Dict]) -> List[Dict[str, Any]]:
+    """Plan a pipeline's $lookups, then run it with small dimension tables hash-joined in process"""
+    pipeline = plan_joins(collection_name, pipeline)
+    first_lookup = next(index for index, stage in enumerate(pipeline) if "$lookup" in stage)
+    prefix = pipeline[:first_lookup]
+    block = lookup_block_at(pipeline, first_lookup)
+    reduced = any(set(stage) & {"$match", "$group", "$limit"} for stage in prefix)
+    dimensions = block and dimension_map(block["lookup"]["from"], block["lookup"]["foreignField"])
+    # Hash join only when the prefix narrows the rows, or when the lookup can't run on the shards anyway
+    if not dimensions or not (reduced or is_sharded_collection(collection_name)):
+        for stage in pipeline:
+            if "$lookup" in stage and isinstance(stage["$lookup"].get("foreignField"), str):
+                ensure_join_index(stage["$lookup"]["from"], stage["$lookup"]["foreignField"])
+        return aggregate_collection(collection_name, pipeline, plan=False)
+
+    documents = aggregate_collection(collection_name, prefix, plan=False)
+    index = first_lookup
+    while index < len(pipeline):
+        block = lookup_block_at(pipeline, index)
+        dimensions = block and dimension_map(block["lookup"]["from"], block["lookup"]["foreignField"])
+        if dimensions:
+            documents = hash_join(documents, block["lookup"], dimensions)
+            index += 1
+            continue
+        # Run the stages up to the next hash-joinable $lookup on the coordinator
+        end = index + 1
+        while end < len(pipeline) and not (
+                lookup_block_at(pipeline, end)
+                and dimension_map(pipeline[end]["$lookup"]["from"], pipeline[end]["$lookup"]["foreignField"])):
+            end += 1
+        for stage in pipeline[index:end]:
+            if "$lookup" in stage and isinstance(stage["$lookup"].get("foreignField"), str):
+                ensure_join_index(stage["$lookup"]["from"], stage["$lookup"]["foreignField"])
+        documents = merge_on_coordinator(documents, pipeline[index:end])
+        index = end
+    return documents
+
+def execute_pipeline(pipeline: List[Dict], collection_name: Optional[str] = None) -> Tuple[List[Dict], str]:
+    """Run a pipeline on its target collection, or on the first collection in
+    QUERY_COLLECTIONS that returns results when the target is unknown"""
+    if collection_name:
+        return aggregate_collection(collection_name, pipeline), collection_name
+    for collection_name in QUERY_COLLECTIONS:
+        results = aggregate_collection(collection_name, pipeline)
+        if results:
+            return results, collection_name
+    return [], QUERY_COLLECTIONS[-1]
+
+def is_facet_compatible(pipeline: List[Dict]) -> bool:
+    """Check whether a pipeline can run as a $facet sub-pipeline"""
+    return bool(pipeline) and all(
+        isinstance(stage, dict) and not (set(stage.keys()) & FACET_INCOMPATIBLE_STAGES)
+        for stage in pipeline
+    )
+
+def run_pipelines_on_collection(collection_name: str, pipelines: Dict[str, List[Dict]]) -> Dict[str, Any]:
+    """Run several pipelines against one collection, sharing a single $facet scan where possible.
+
+    Returns a dict of key -> result list, or key -> Exception for pipelines that failed.
+    """
+    outcomes: Dict[str, Any] = {}
+    # A $facet can't be split into per-shard partials, so sharded collections run each pipeline on its own;
+    # virtual collections, pipelines reaching archived dates and $lookup pipelines (join planner) also
+    # need aggregate_collection's routing
+    facet_keys = [
+        key for key, pipeline in pipelines.items()
+        if is_facet_compatible(pipeline) and not is_sharded_collection(collection_name)
+        and collection_name not in VIRTUAL_COLLECTIONS
+        and not (collection_name in archive_watermarks and reaches_archive(collection_name, pipeline))
+        and not any(isinstance(stage, dict) and "$lookup" in stage for stage in pipeline)
+    ]
+    individual_keys = [key for key in pipelines if key not in facet_keys]
+
+    if len(facet_keys) > 1:
+        facet_names = {f"q{index}": key for index, key in enumerate(facet_keys)}
+        try:
+            facet_result = list(db[collection_name].aggregate([
+                {"$facet": {name: pipelines[key] for name, key in facet_names.items()}}
+            ]))
+            for name, key in facet_names.items():
+                outcomes[key] = facet_result[0].get(name, []) if facet_result else []
+        except Exception as e:
+            # One bad pipeline (or the 16MB $facet document limit) fails the whole
+            # facet, so isolate errors by running each pipeline on its own
+            print(f"Batch $facet error on {collection_name}: {e}")
+            individual_keys.extend(facet_keys)
+    else:
+        individual_keys.extend(facet_keys)
+
+    for key in individual_keys:
+        try:
+            outcomes[key] = aggregate_collection(collection_name, pipelines[key])
+        except Exception as e:
+            outcomes[key] = e
+    return outcomes
+
+def execute_pipelines_batched(pipelines: Dict[str, List[Dict]],
+                              targets: Optional[Dict[str, str]] = None) -> Dict[str, Dict[str, Any]]:
+    """Execute many pipelines grouped by target collection.
+
+    Pipelines without a known target use the same fallback order as execute_pipeline.
+    """
+    executed: Dict[str, Dict[str, Any]] = {}
+    targets = {key: target for key, target in (targets or {}).items() if target and key in pipelines}
+
+    by_collection: Dict[str, Dict[str, List[Dict]]] = {}
+    for key, target in targets.items():
+        by_collection.setdefault(target, {})[key] = pipelines[key]
+    for collection_name, collection_pipelines in by_collection.items():
+        outcomes = run_pipelines_on_collection(collection_name, collection_pipelines)
+        for key, outcome in outcomes.items():
+            if isinstance(outcome, Exception):
+                executed[key] = {"error": str(outcome)}
+            else:
+                executed[key] = {"results": outcome, "collection": collection_name}
+
+    pending = {key: pipeline for key, pipeline in pipelines.items() if key not in targets}
+    for collection_name in QUERY_COLLECTIONS:
+        if not pending:
+            break
+        outcomes = run_pipelines_on_collection(collection_name, pending)
+        for key, outcome in outcomes.items():
+            if isinstance(outcome, Exception):
+                executed[key] = {"error": str(outcome)}
+                pending.pop(key)
+            elif outcome:
+                executed[key] = {"results": outcome, "collection": collection_name}
+                pending.pop(key)
+    for key in pending:
+        executed[key] = {"results": [], "collection": QUERY_COLLECTIONS[-1]}
+    return executed
+
+# Approximate execution: $group pipelines estimated from a per-shard (stratified) $sample
+APPROXIMATE_ROW_STAGES = {"$match", "$addFields", "$set", "$project"}
+
+def approximate_group_plan(pipeline: List[Dict]) -> Optional[Tuple[List[Dict], Dict[str, Any], List[Dict], Dict[str, str]]]:
+    """Split a pipeline into row stages, a sampled partial $group and the stages after it.
+
+    Only pipelines whose first $group uses $sum, $avg and $count, preceded by row-wise
+    stages, can be estimated; returns None otherwise.
+    """
+    index = 0
+    while index < len(pipeline) and len(pipeline[index]) == 1 and next(iter(pipeline[index])) in APPROXIMATE_ROW_STAGES:
+        index += 1
+    if index >= len(pipeline) or set(pipeline[index]) != {"$group"}:
+        return None
+    group = pipeline[index]["$group"]
+    partial: Dict[str, Any] = {"_id": group["_id"], "__rows": {"$sum": 1}}
+    kinds: Dict[str, str] = {}
+    for field_name, accumulator in group.items():
+        if field_name == "_id":
+            continue
+        if not isinstance(accumulator, dict) or len(accumulator) != 1:
+            return None
+        operator, expression = next(iter(accumulator.items()))
+        if operator == "$count":
+            operator, expression = "$sum", 1
+        if operator not in ("$sum", "$avg"):
+            return None
+        kinds[field_name] = operator[1:]
+        partial[f"__{field_name}_sum"] = {"$sum": expression}
+        partial[f"__{field_name}_sumsq"] = {"$sum": {"$multiply": [expression, expression]}}
+        if operator == "$avg":
+            partial[f"__{field_name}_count"] = {"$sum": {"$cond": [{"$isNumber": expression}, 1, 0]}}
+    return pipeline[:index], partial, pipeline[index + 1:], kinds
+
+def execute_approximate(pipeline: List[Dict], collection_name: str) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """Estimate a $group pipeline from samples, with normal-approximation confidence intervals.
+
+    Each shard is a stratum sampled in proportion to its size. Returns the results and
+    an approximation summary; the summary has a fallback_reason (and the results are
+    empty) when the pipeline should run exactly instead.
+    """
+    plan = approximate_group_plan(pipeline)
+    if not plan:
+        return [], {"fallback_reason": "pipeline is not a $sum/$avg/$count group-by"}
+    if collection_name in archive_watermarks and reaches_archive(collection_name, pipeline):
+        return [], {"fallback_reason": "date range includes archived records"}
+    row_stages, partial, rest, kinds = plan
+
+    strata = [(collection, collection.estimated_document_count()) for collection in fact_collections(collection_name)]
+    population = sum(size for _, size in strata)
+    if population < APPROX_MIN_POPULATION_RATIO * APPROX_SAMPLE_SIZE:
+        return [], {"fallback_reason": f"collection has only {population} documents, "
+                                       f"too few for a random-cursor $sample of {APPROX_SAMPLE_SIZE}"}
+    strata = [
+        (collection, size, min(size, max(1, round(APPROX_SAMPLE_SIZE * size / population))))
+        for collection, size in strata if size
+    ]
+    partials = shard_executor.map(
+        lambda stratum: list(stratum[0].aggregate(
+            [{"$sample": {"size": stratum[2]}}] + row_stages + [{"$group": partial}]
+        )),
+        strata
+    )
+
+    # key -> per-stratum partial group documents (with the stratum's population and sample size)
+    groups: Dict[str, List[Tuple[Dict[str, Any], int, int]]] = {}
+    for (_, size, sample_size), documents in zip(strata, partials):
+        for document in documents:
+            groups.setdefault(json.dumps(document["_id"], sort_keys=True, default=str), []).append((document, size, sample_size))
+
+    estimates, intervals = [], []
+    for parts in groups.values():
+        sampled_rows = sum(document["__rows"] for document, _, _ in parts)
+        if sampled_rows < APPROX_MIN_GROUP_ROWS:
+            return [], {"fallback_reason": f"a group has only {sampled_rows} sampled rows"}
+        row = {"_id": parts[0][0]["_id"]}
+        interval = {"_id": row["_id"]}
+        for field_name, kind in kinds.items():
+            if kind == "sum":
+                # Stratified estimate of a total and its variance (finite population corrected)
+                estimate, variance = 0.0, 0.0
+                for document, size, sample_size in parts:
+                    total, squares = document[f"__{field_name}_sum"], document[f"__{field_name}_sumsq"]
+                    estimate += size / sample_size * total
+                    if sample_size > 1:
+                        sample_variance = max(squares - total * total / sample_size, 0.0) / (sample_size - 1)
+                        variance += size * size * (1 - sample_size / size) * sample_variance / sample_size
+            else:
+                weighted_sum = sum(size / sample_size * document[f"__{field_name}_sum"] for document, size, sample_size in parts)
+                weighted_count = sum(size / sample_size * document[f"__{field_name}_count"] for document, size, sample_size in parts)
+                total = sum(document[f"__{field_name}_sum"] for document, _, _ in parts)
+                squares = sum(document[f"__{field_name}_sumsq"] for document, _, _ in parts)
+                count = sum(document[f"__{field_name}_count"] for document, _, _ in parts)
+                estimate = weighted_sum / weighted_count if weighted_count else None
+                variance = 0.0
+                if count > 1:
+                    sampling_fraction = sum(sample_size for _, _, sample_size in parts) / sum(size for _, size, _ in parts)
+                    variance = max(squares - total * total / count, 0.0) / (count - 1) / count * (1 - sampling_fraction)
+            row[field_name] = estimate
+            margin = APPROX_CONFIDENCE_Z * math.sqrt(variance)
+            interval[field_name] = {
+                "estimate": estimate,
+                "low": None if estimate is None else estimate - margin,
+                "high": None if estimate is None else estimate + margin,
+                "relative_error": round(margin / abs(estimate), 4) if estimate else None
+            }
+        estimates.append(row)
+        intervals.append(interval)
+
+    results = merge_on_coordinator(estimates, rest) if rest else estimates
+    return results, {
+        "path": "random_cursor_sample",
+        "population": population,
+        "sample_size": sum(sample_size for _, _, sample_size in strata),
+        "confidence": APPROX_CONFIDENCE,
+        "intervals": intervals
+    }
+
+def recommend_chart_type(results: List[Dict]) -> str:
+    """Generate chart recommendation based on data structure"""
+    chart_type = "bar"
+    if len(results) > 0:
+        first_result = results[0]
+        if any(key for key in first_result.keys() if 'rate' in key.lower() or 'percentage' in key.lower()):
+            chart_type = "line"
+        elif len(results) > 10:
+            chart_type = "line"
+    return chart_type
+
+# Schema discovery and statistics
+def infer_value_type(value: Any) -> str:
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "boolean"
+    if isinstance(value, int):
+        return "integer"
+    if isinstance(value, float):
+        return "float"
+    if isinstance(value, str):
+        return "string"
+    if isinstance(value, datetime):
+        return "date"
+    if isinstance(value, list):
+        return "array"
+    if isinstance(value, dict):
+        return "object"
+    return type(value).__name__
+
+def infer_collection_stats(collection_name: str) -> Dict[str, Any]:
+    """Sample a collection and infer per-field type, cardinality, min/max and null ratio"""
+    collections = fact_collections(collection_name)
+    document_count = sum(collection.estimated_document_count() for collection in collections)
+    shard_sample_size = math.ceil(SCHEMA_SAMPLE_SIZE / len(collections))
+    sample = [
+        document for collection in collections
+        for document in collection.aggregate([{"$sample": {"size": shard_sample_size}}])
+    ]
+    sample_size = len(sample)
+
+    field_names: List[str] = []
+    for document in sample:
+        for field_name in document:
+            if field_name not in field_names:
+                field_names.append(field_name)
+
+    fields: Dict[str, Dict[str, Any]] = {}
+    for field_name in field_names:
+        values = [document.get(field_name) for document in sample]
+        present = [value for value in values if value is not None]
+        type_counts: Dict[str, int] = {}
+        for value in present:
+            value_type = infer_value_type(value)
+            type_counts[value_type] = type_counts.get(value_type, 0) + 1
+        field_type = max(type_counts, key=type_counts.get) if type_counts else "null"
+        if set(type_counts) == {"integer", "float"}:
+            field_type = "float"
+
+        hashable = [value for value in present if not isinstance(value, (list, dict))]
+        value_counts: Dict[Any, int] = {}
+        for value in hashable:
+            value_counts[value] = value_counts.get(value, 0) + 1
+        distinct = len(value_counts)
+        # Mostly-unique sampled values suggest a key, whose cardinality scales with the collection
+        unique_ratio = distinct / len(hashable) if hashable else 0.0
+        estimated_cardinality = distinct
+        if unique_ratio > 0.9 and sample_size:
+            estimated_cardinality = round(distinct * document_count / sample_size)
+
+        field_stats: Dict[str, Any] = {
+            "type": field_type,
+            "null_ratio": round(1 - len(present) / sample_size, 4) if sample_size else 0.0,
+            "distinct_in_sample": distinct,
+            "unique_ratio": round(unique_ratio, 4),
+            "estimated_cardinality": estimated_cardinality
+        }
+        comparable = [value for value in hashable if infer_value_type(value) == field_type]
+        if comparable and field_type in ("integer", "float", "string", "date"):
+            field_stats["min"] = min(comparable)
+            field_stats["max"] = max(comparable)
+        if field_type in ("integer", "float") and comparable:
+            field_stats["mean"] = round(sum(comparable) / len(comparable), 4)
+        if 0 < distinct <= 25:
+            # Stored as a list because values like "285/75R24.5" are not safe field names
+            field_stats["top_values"] = [
+                {"value": value, "frequency": round(count / sample_size, 4)}
+                for value, count in sorted(value_counts.items(), key=lambda item: -item[1])
+            ]
+        fields[field_name] = field_stats
+
+    return {
+        "_id": collection_name,
+        "document_count": document_count,
+        "sample_size": sample_size,
+        "fields": fields,
+        "sample_values": {
+            field_name: sorted({str(document[field_name]) for document in sample if field_name in document})[:500]
+            for field_name in field_names if fields[field_name]["type"] in ("string", "integer")
+        },
+        "refreshed_at": datetime.now().isoformat()
+    }
+
+def discover_candidate_relationships(stats_by_collection: Dict[str, Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Suggest joins between same-named fields whose sampled values overlap.
+
+    A key-like field on one side gives a many-to-one candidate; shared
+    low-cardinality dimensions (production_line, date) give many-to-many ones.
+    """
+    existing = {
+        (rel["from_table"], rel["from_column"], rel["to_table"], rel["to_column"])
+        for rel in db.table_relationships.find({}, {"_id": 0})
+    }
+    candidates = []
+    names = sorted(stats_by_collection)
+    for from_table in names:
+        for to_table in names:
+            if from_table == to_table:
+                continue
+            from_stats, to_stats = stats_by_collection[from_table], stats_by_collection[to_table]
+            for column, from_field in from_stats["fields"].items():
+                to_field = to_stats["fields"].get(column)
+                if column == "_id" or not to_field or from_field["type"] != to_field["type"]:
+                    continue
+                from_values = set(from_stats["sample_values"].get(column, []))
+                to_values = set(to_stats["sample_values"].get(column, []))
+                if not from_values or not to_values:
+                    continue
+                overlap = len(from_values & to_values) / len(from_values)
+                if overlap < 0.8:
+                    continue
+                if to_field["unique_ratio"] >= 0.95 and from_field["unique_ratio"] < 0.95:
+                    relationship_type = "many-to-one"
+                elif from_table < to_table and from_field["unique_ratio"] < 0.95 and to_field["unique_ratio"] < 0.95:
+                    relationship_type = "many-to-many"
+                else:
+                    continue
+                if (from_table, column, to_table, column) in existing or (to_table, column, from_table, column) in existing:
+                    continue
+                candidates.append({
+                    "from_table": from_table,
+                    "to_table": to_table,
+                    "from_column": column,
+                    "to_column": column,
+                    "relationship_type": relationship_type,
+                    "value_overlap": round(overlap, 3)
+                })
+    return candidates
+
+def discoverable_collections() -> List[str]:
+    existing = set(db.list_collection_names()) | ({*QUERY_COLLECTIONS} if shard_databases else set())
+    declared = {schema["table_name"] for schema in db.table_schemas.find({}, {"table_name": 1})}
+    return sorted((declared | set(QUERY_COLLECTIONS)) & existing)
+
+def sync_inferred_table_schema(stats: Dict[str, Any]):
+    """Replace a table schema's columns with the inferred ones, keeping its layout"""
+    columns = []
+    for field_name, field_stats in stats["fields"].items():
+        column = {"name": field_name, "type": field_stats["type"]}
+        if field_name == "_id":
+            column["primary_key"] = True
+        else:
+            column["nullable"] = field_stats["null_ratio"] > 0
+        columns.append(column)
+    db.table_schemas.update_one(
+        {"table_name": stats["_id"]},
+        {
+            "$set": {"columns": columns},
+            "$inc": {"version": 1},
+            "$setOnInsert": {"_id": str(uuid.uuid4()), "description": "Discovered from data"}
+        },
+        upsert=True
+    )
+    bump_collection_version("table_schemas")
+
+def refresh_collection_stats(force: bool = False, sync_schemas: bool = False) -> Dict[str, Any]:
+    """Re-sample collections whose stats are missing, old, or whose size drifted.
+
+    Drift is detected from estimated_document_count (collection metadata), so
+    unchanged collections cost no scan at all.
+    """
+    refreshed, skipped = [], []
+    for collection_name in discoverable_collections():
+        previous = get_collection_stats(collection_name)
+        if previous and not force:
+            document_count = sum(collection.estimated_document_count() for collection in fact_collections(collection_name))
+            drift = abs(document_count - previous["document_count"]) / max(previous["document_count"], 1)
+            age = (datetime.now() - datetime.fromisoformat(previous["refreshed_at"])).total_seconds()
+            if drift <= SCHEMA_STATS_DRIFT_RATIO and age <= SCHEMA_STATS_MAX_AGE_SECONDS:
+                skipped.append(collection_name)
+                continue
+        stats = infer_collection_stats(collection_name)
+        db.collection_stats.replace_one({"_id": collection_name}, stats, upsert=True)
+        collection_stats_cache[collection_name] = stats
+        if sync_schemas:
+            sync_inferred_table_schema(stats)
+        refreshed.append(collection_name)
+
+    if sync_schemas and refreshed:
+        invalidate_rule_vocabulary()
+        rebuild_schema_index()
+    candidates = discover_candidate_relationships({
+        name: stats for name in discoverable_collections()
+        if (stats := get_collection_stats(name))
+    })
+    db.collection_stats.update_one(
+        {"_id": "_candidate_relationships"},
+        {"$set": {"candidates": candidates, "refreshed_at": datetime.now().isoformat()}},
+        upsert=True
+    )
+    return {"refreshed": refreshed, "skipped": skipped, "candidate_relationships": candidates}
+
+def get_collection_stats(collection_name: str) -> Optional[Dict[str, Any]]:
+    """Cached statistics for a collection (None until discovery has run)"""
+    if collection_name not in collection_stats_cache:
+        stats = db.collection_stats.find_one({"_id": collection_name})
+        if not stats:
+            return None
+        collection_stats_cache[collection_name] = stats
+    return collection_stats_cache[collection_name]
+
+def estimate_selectivity(collection_name: str, field_name: str, value: Any = None) -> Optional[float]:
+    """Estimated fraction of documents matching field == value (1 / cardinality when value is unknown)"""
+    stats = get_collection_stats(collection_name)
+    field_stats = (stats or {}).get("fields", {}).get(field_name)
+    if not field_stats:
+        return None
+    top_values = field_stats.get("top_values")
+    if value is not None and top_values:
+        return next((entry["frequency"] for entry in top_values if entry["value"] == value), 0.0)
+    return 1 / max(field_stats["estimated_cardinality"], 1)
+
+def describe_column_stats(table_name: str, column_name: str) -> Optional[str]:
+    """Short description of observed values for the LLM prompt"""
+    field_stats = (get_collection_stats(table_name) or {}).get("fields", {}).get(column_name)
+    if not field_stats:
+        return None
+    if field_stats.get("top_values") and len(field_stats["top_values"]) <= 10:
+        return "values " + ", ".join(str(entry["value"]) for entry in field_stats["top_values"])
+    if "min" in field_stats:
+        return f"range {field_stats['min']} to {field_stats['max']}, ~{field_stats['estimated_cardinality']} distinct"
+    return None
+
+async def collection_stats_scheduler():
+    """Keep collection statistics fresh in the background"""
+    while True:
+        try:
+            await asyncio.to_thread(refresh_collection_stats)
+        except Exception as e:
+            print(f"Schema discovery error: {e}")
+        await asyncio.sleep(SCHEMA_STATS_REFRESH_INTERVAL_SECONDS)
+
+# Request profiling (X-Profile header) and the process-wide sampling profiler
+active_request_profile: contextvars.ContextVar = contextvars.ContextVar('active_request_profile', default=None)
+request_profile_lock = asyncio.Lock()
+sampling_profiles: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+def ensure_profile_store():
+    """Create the capped profiles collection if it does not exist"""
+    if "profiles" not in db.list_collection_names():
+        db.create_collection("profiles", capped=True, size=PROFILE_STORE_SIZE_BYTES)
+
+async def run_in_thread(function: Callable, *args) -> Any:
+    """asyncio.to_thread that also profiles the worker thread when the request is being profiled"""
+    worker_profiles = active_request_profile.get()
+    if worker_profiles is None:
+        return await asyncio.to_thread(function, *args)
+
+    def profiled():
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ profiles every thread from the request's own profiler
+            return function(*args)
+        try:
+            return function(*args)
+        finally:
+            profile.disable()
+            worker_profiles.append(profile)
+    return await asyncio.to_thread(profiled)
+
+def summarize_cpu_profile(profiles: List[cProfile.Profile]) -> Dict[str, Any]:
+    """Merge the event loop and worker thread profiles into the top functions by cumulative time"""
+    report = io.StringIO()
+    stats = pstats.Stats(profiles[0], stream=report)
+    for profile in profiles[1:]:
+        stats.add(profile)
+    stats.sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+    functions = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:PROFILE_TOP_FUNCTIONS]
+    return {
+        "total_calls": stats.total_calls,
+        "total_seconds": round(stats.total_tt, 4),
+        "top": [
+            {
+                "function": f"{os.path.basename(filename)}:{line}({name})",
+                "calls": calls,
+                "own_seconds": round(own_time, 4),
+                "cumulative_seconds": round(cumulative_time, 4)
+            }
+            for (filename, line, name), (_, calls, own_time, cumulative_time, _) in functions
+        ],
+        "report": report.getvalue()
+    }
+
+def summarize_memory_profile(before: tracemalloc.Snapshot, after: tracemalloc.Snapshot, peak_bytes: int) -> Dict[str, Any]:
+    """Top allocation sites by growth between the snapshots taken around the request"""
+    return {
+        "peak_bytes": peak_bytes,
+        "top": [
+            {
+                "location": f"{os.path.basename(difference.traceback[0].filename)}:{difference.traceback[0].lineno}",
+                "size_diff_bytes": difference.size_diff,
+                "count_diff": difference.count_diff
+            }
+            for difference in after.compare_to(before, "lineno")[:PROFILE_TOP_FUNCTIONS]
+        ]
+    }
+
+class RequestProfiler:
+    """ASGI middleware that runs a request under cProfile and/or tracemalloc when it sends
+    X-Profile: cpu, memory or all (with the admin token; refused when none is configured).
+
+    Requests without the header pass straight through, so streamed responses are
+    untouched. The profile is stored in the capped profiles collection once the
+    response has been sent, and its id returned in the X-Profile-Id header. cProfile
+    covers the event loop thread (routing, response serialization) and work sent to
+    threads through run_in_thread; other requests the loop serves in the meantime
+    show up in it too.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = Headers(scope=scope)
+        requested = headers.get("x-profile")
+        if not requested:
+            return await self.app(scope, receive, send)
+        if not ADMIN_TOKEN or headers.get("x-admin-token") != ADMIN_TOKEN:
+            return await JSONResponse(status_code=403, content={"detail": "Admin token required"})(scope, receive, send)
+        modes = {mode.strip() for mode in requested.lower().split(",")}
+        if "all" in modes:
+            modes = {"cpu", "memory"}
+        modes &= {"cpu", "memory"}
+        if not modes:
+            return await JSONResponse(status_code=400, content={"detail": "X-Profile must be cpu, memory or all"})(scope, receive, send)
+        if request_profile_lock.locked():
+            return await JSONResponse(status_code=429, content={"detail": "Another request is being profiled"},
+                                      headers={"Retry-After": "5"})(scope, receive, send)
+
+        async with request_profile_lock:
+            profile_id = str(uuid.uuid4())
+            status_codes: List[int] = []
+
+            async def send_with_profile_id(message):
+                if message["type"] == "http.response.start":
+                    status_codes.append(message["status"])
+                    message = dict(message, headers=list(message.get("headers", [])) + [(b"x-profile-id", profile_id.encode())])
+                await send(message)
+
+            worker_profiles: List[cProfile.Profile] = []
+            token = active_request_profile.set(worker_profiles)
+            loop_profile = cProfile.Profile() if "cpu" in modes else None
+            was_tracing = tracemalloc.is_tracing()
+            if "memory" in modes:
+                if not was_tracing:
+                    tracemalloc.start()
+                tracemalloc.reset_peak()
+                memory_before = tracemalloc.take_snapshot()
+            started = time.perf_counter()
+            if loop_profile:
+                loop_profile.enable()
+            try:
+                # The app returns once the last body chunk is sent, so serialization and streaming are counted
+                await self.app(scope, receive, send_with_profile_id)
+            finally:
+                if loop_profile:
+                    loop_profile.disable()
+                active_request_profile.reset(token)
+                if "memory" in modes:
+                    memory_after = tracemalloc.take_snapshot()
+                    _, peak_bytes = tracemalloc.get_traced_memory()
+                    if not was_tracing:
+                        tracemalloc.stop()
+            wall_time_ms = (time.perf_counter() - started) * 1000
+
+            profile_doc: Dict[str, Any] = {
+                "_id": profile_id,
+                "created_at": datetime.now().isoformat(),
+                "method": scope["method"],
+                "path": scope["path"],
+                "query_string": scope.get("query_string", b"").decode("latin-1"),
+                "status_code": status_codes[0] if status_codes else None,
+                "wall_time_ms": round(wall_time_ms, 2),
+                "modes": sorted(modes)
+            }
+            if loop_profile:
+                profile_doc["cpu"] = summarize_cpu_profile([loop_profile] + worker_profiles)
+            if "memory" in modes:
+                profile_doc["memory"] = summarize_memory_profile(memory_before, memory_after, peak_bytes)
+            try:
+                await asyncio.to_thread(db.profiles.insert_one, profile_doc)
+            except Exception as e:
+                print(f"Profile store error: {e}")
+
+app.add_middleware(RequestProfiler)
+
+def frame_label(frame) -> str:
+    return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}"
+
+def run_sampling_profiler(sample_id: str, seconds: float, interval_seconds: float):
+    """Sample every thread's stack each interval and count identical stacks in folded format"""
+    sampling = sampling_profiles[sample_id]
+    sampler_thread = threading.get_ident()
+    folded: Dict[str, int] = {}
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == sampler_thread:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame))
+                frame = frame.f_back
+            key = ";".join([thread_names.get(thread_id, str(thread_id))] + stack[::-1])
+            folded[key] = folded.get(key, 0) + 1
+        sampling["samples"] += 1
+        time.sleep(interval_seconds)
+    sampling["folded"] = "\n".join(f"{stack} {count}" for stack, count in sorted(folded.items()))
+    sampling["status"] = "completed"
+    sampling["completed_at"] = datetime.now().isoformat()
+
+def sampling_summary(sample_id: str, sampling: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "sample_id": sample_id,
+        **{key: value for key, value in sampling.items() if key != "folded"},
+        "stacks": sampling["folded"].count("\n") + 1 if sampling.get("folded") else 0,
+        "result_url": f"/api/admin/profiler/samples/{sample_id}"
+    }
+
+# Query plan inspection
+def ensure_slow_query_log():
+    """Create the capped slow_queries collection if it does not exist"""
+    if "slow_queries" not in db.list_collection_names():
+        db.create_collection("slow_queries", capped=True, size=SLOW_QUERY_LOG_SIZE_BYTES)
+
+def summarize_explain(explain_output: Dict[str, Any]) -> Dict[str, Any]:
+    """Pull docs/keys examined, returned count and indexes used out of an executionStats explain"""
+    summary = {"docs_examined": 0, "keys_examined": 0, "indexes_used": [], "collection_scan": False}
+
+    def walk(node: Any):
+        if isinstance(node, dict):
+            if "executionStats" in node and isinstance(node["executionStats"], dict):
+                stats = node["executionStats"]
+                summary["docs_examined"] += stats.get("totalDocsExamined", 0)
+                summary["keys_examined"] += stats.get("totalKeysExamined", 0)
+                summary.setdefault("plan_returned", stats.get("nReturned"))
+            if node.get("stage") == "COLLSCAN":
+                summary["collection_scan"] = True
+            if node.get("indexName") and node["indexName"] not in summary["indexes_used"]:
+                summary["indexes_used"].append(node["indexName"])
+            for value in node.values():
+                walk(value)
+        elif isinstance(node, list):
+            for value in node:
+                walk(value)
+
+    # Only walk the winning plan and its stats, not the rejected alternatives
+    walk({key: value for key, value in explain_output.items() if key != "rejectedPlans"})
+    return summary
+
+def explain_pipeline(collection_name: str, pipeline: List[Dict]) -> Dict[str, Any]:
+    if collection_name in VIRTUAL_COLLECTIONS:
+        collection_name, prefixer = VIRTUAL_COLLECTIONS[collection_name]
+        pipeline = prefixer(pipeline)
+    # Sharded collections are explained on the first shard the pipeline targets
+    collection = fact_collections(collection_name, (target_plants(pipeline) or list(shard_databases))[:1] if shard_databases else None)[0]
+    explain_output = collection.database.command(
+        "explain",
+        {"aggregate": collection_name, "pipeline": pipeline, "cursor": {}},
+        verbosity="executionStats"
+    )
+    return summarize_explain(explain_output)
+
+def log_query_execution(query_text: str, pipeline: List[Dict], collection_name: str,
+                        wall_time_ms: float, docs_returned: int, plan: Optional[Dict[str, Any]] = None,
+                        source: Optional[str] = None):
+    """Explain (if not already done) and record a slow or sampled query execution"""
+    if plan is None:
+        try:
+            plan = explain_pipeline(collection_name, pipeline)
+        except Exception as e:
+            plan = {"explain_error": str(e)}
+    db.slow_queries.insert_one({
+        "_id": str(uuid.uuid4()),
+        "timestamp": datetime.now().isoformat(),
+        "query": query_text,
+        "normalized_query": normalize_query(query_text),
+        # Stored as JSON text: stage operators are not valid field names
+        "pipeline": json.dumps(pipeline, default=str),
+        "collection": collection_name,
+        "wall_time_ms": round(wall_time_ms, 2),
+        "docs_returned": docs_returned,
+        "slow": wall_time_ms >= SLOW_QUERY_THRESHOLD_MS,
+        "source": source,
+        **plan
+    })
+
+def record_query_execution(query_text: str, pipeline: List[Dict], collection_name: str,
+                           wall_time_ms: float, docs_returned: int, plan: Optional[Dict[str, Any]] = None,
+                           source: Optional[str] = None):
+    """Log slow executions and a random sample of the rest, off the request path"""
+    if wall_time_ms < SLOW_QUERY_THRESHOLD_MS and random.random() >= EXPLAIN_SAMPLE_RATE:
+        return
+
+    async def log_in_background():
+        try:
+            await asyncio.to_thread(
+                log_query_execution, query_text, pipeline, collection_name,
+                wall_time_ms, docs_returned, plan, source
+            )
+        except Exception as e:
+            print(f"Slow query log error: {e}")
+    asyncio.create_task(log_in_background())
+
+# KPI engine: OEE partial sums per plant, line, shift and day, maintained as records are ingested
+# Measures each source collection adds to a KPI partial (partial field -> record field).
+# production_data.defect_count is not used: quality_metrics is the inspection log of the same rejects.
+# Downtime comes only from production_data, the line's own stoppage per shift: equipment_downtime
+# logs the same stops per machine (overlapping, without a shift), so adding it would count them twice
+KPI_SOURCES = {
+    "production_data": {
+        "planned_production": "planned_production",
+        "actual_production": "actual_production",
+        "downtime_minutes": "downtime_minutes"
+    },
+    "quality_metrics": {"rejected_count": "defect_count"},
+    "equipment_downtime": {}
+}
+KPI_MEASURES = ["planned_minutes", "downtime_minutes", "planned_production", "actual_production",
+                "rejected_count", "record_count"]
+KPI_KEY_FIELDS = ["plant_id", "production_line", "shift", "date"]
+# Fields only kpi_oee has; an LLM pipeline using them is run against it
+KPI_OEE_FIELDS = {"planned_minutes", "run_minutes", "rejected_count", "good_count", "availability",
+                  "performance", "quality", "oee", "effective_good_count"}
+
+class KpiRing:
+    """Daily KPI partial sums of one plant/line/shift for the last KPI_WINDOW_DAYS days.
+
+    Day d lives in slot d % size; a slot still holding an older day is reset when
+    its day comes round again, so a sliding window is a sum over at most size slots
+    and never touches Mongo.
+    """
+
+    def __init__(self, size: int):
+        self.days: List[Optional[int]] = [None] * size
+        self.sums: List[Dict[str, float]] = [{} for _ in range(size)]
+
+    def add(self, day: int, sums: Dict[str, float], today: int):
+        if not today - len(self.days) < day <= today:
+            return
+        slot = day % len(self.days)
+        if self.days[slot] != day:
+            self.days[slot] = day
+            self.sums[slot] = {}
+        merge_kpi_sums(self.sums[slot], sums)
+
+    def window(self, days: int, today: int) -> List[Tuple[int, Dict[str, float]]]:
+        return [
+            (day, sums) for day, sums in zip(self.days, self.sums)
+            if day is not None and today - days < day <= today
+        ]
+
+kpi_rings: Dict[Tuple[str, str, Optional[str]], KpiRing] = {}
+
+def merge_kpi_sums(target: Dict[str, float], sums: Dict[str, float]):
+    """Add partial sums; planned time is per shift, so repeated records of a shift don't add to it"""
+    for measure, value in sums.items():
+        if measure == "planned_minutes":
+            target[measure] = max(target.get(measure, 0), value)
+        else:
+            target[measure] = target.get(measure, 0) + value
+
+def sum_kpi_sums(target: Dict[str, float], sums: Dict[str, float]):
+    """Add the partial sums of different shifts, lines or days"""
+    for measure, value in sums.items():
+        target[measure] = target.get(measure, 0) + value
+
+def kpi_numeric(value: Any) -> float:
+    return float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else 0.0
+
+def kpi_partials_from_records(collection_name: str, records: List[Dict[str, Any]],
+                              counted_field: Optional[str] = None) -> Dict[Tuple, Dict[str, float]]:
+    """KPI partial sums per (plant_id, production_line, shift, date) of fact records (or rollups,
+    whose counted_field holds the number of raw records)"""
+    partials: Dict[Tuple, Dict[str, float]] = {}
+    if not KPI_SOURCES[collection_name]:
+        return partials
+    for record in records:
+        if not record.get("production_line") or not record.get("date"):
+            continue
+        key = tuple(record.get(field) for field in KPI_KEY_FIELDS)
+        sums = {measure: kpi_numeric(record.get(field)) for measure, field in KPI_SOURCES[collection_name].items()}
+        sums["record_count"] = kpi_numeric(record.get(counted_field)) if counted_field else 1.0
+        if collection_name == "production_data":
+            sums["planned_minutes"] = KPI_SHIFT_MINUTES
+        merge_kpi_sums(partials.setdefault(key, {}), sums)
+    return partials
+
+def kpi_partial_id(key: Tuple) -> str:
+    return "|".join(str(part) if part is not None else "" for part in key)
+
+def add_to_kpi_rings(partials: Dict[Tuple, Dict[str, float]]):
+    today = datetime.now().date().toordinal()
+    with kpi_lock:
+        for (plant_id, production_line, shift, date), sums in partials.items():
+            try:
+                day = datetime.strptime(date, "%Y-%m-%d").date().toordinal()
+            except (TypeError, ValueError):
+                continue
+            ring = kpi_rings.get((plant_id, production_line, shift))
+            if ring is None:
+                ring = kpi_rings[(plant_id, production_line, shift)] = KpiRing(KPI_WINDOW_DAYS)
+            ring.add(day, sums, today)
+
+def apply_kpi_partials(partials: Dict[Tuple, Dict[str, float]]):
+    """Upsert partial sums into kpi_partials ($inc, $max for planned time) and the in-memory windows"""
+    if not partials:
+        return
+    operations = []
+    for key, sums in partials.items():
+        update: Dict[str, Any] = {
+            "$inc": {measure: value for measure, value in sums.items() if measure != "planned_minutes"},
+            "$setOnInsert": dict(zip(KPI_KEY_FIELDS, key))
+        }
+        if "planned_minutes" in sums:
+            update["$max"] = {"planned_minutes": sums["planned_minutes"]}
+        operations.append(UpdateOne({"_id": kpi_partial_id(key)}, update, upsert=True))
+    db.kpi_partials.bulk_write(operations, ordered=False)
+    add_to_kpi_rings(partials)
+    bump_collection_version("kpi_partials", "kpi_oee")
+
+def load_kpi_rings():
+    """Fill the sliding-window rings from the stored partials of the last KPI_WINDOW_DAYS days"""
+    since = (datetime.now() - timedelta(days=KPI_WINDOW_DAYS)).strftime("%Y-%m-%d")
+    with kpi_lock:
+        kpi_rings.clear()
+    add_to_kpi_rings({
+        tuple(partial.get(field) for field in KPI_KEY_FIELDS): {measure: partial.get(measure, 0) for measure in KPI_MEASURES}
+        for partial in db.kpi_partials.find({"date": {"$gte": since}})
+    })
+
+def rebuild_kpi_partials() -> int:
+    """Recompute kpi_partials from the raw fact collections and the daily rollups of archived records"""
+    partials: Dict[Tuple, Dict[str, float]] = {}
+    for collection_name, measures in KPI_SOURCES.items():
+        if not measures:
+            continue
+        fields = {field: 1 for field in KPI_KEY_FIELDS + list(measures.values())}
+        for source, counted_field in ((collection_name, None), (rollup_collection_name(collection_name), "record_count")):
+            records = aggregate_collection(source, [{"$project": {**fields, **({counted_field: 1} if counted_field else {})}}])
+            for key, sums in kpi_partials_from_records(collection_name, records, counted_field).items():
+                merge_kpi_sums(partials.setdefault(key, {}), sums)
+
+    # Swap the rebuilt partials in with a rename, like saved query results
+    db.kpi_partials_staging.drop()
+    if partials:
+        db.kpi_partials_staging.insert_many([
+            {"_id": kpi_partial_id(key), **dict(zip(KPI_KEY_FIELDS, key)), **sums}
+            for key, sums in partials.items()
+        ])
+        db.kpi_partials_staging.rename("kpi_partials", dropTarget=True)
+    else:
+        db.kpi_partials.drop()
+    db.kpi_partials.create_index([("date", 1), ("production_line", 1)])
+    load_kpi_rings()
+    bump_collection_version("kpi_partials", "kpi_oee")
+    return len(partials)
+
+def ingest_fact_records(collection_name: str, records: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Insert fact records, fold them into the KPI partials and score them for anomalies"""
+    for record in records:
+        record.setdefault("_id", str(uuid.uuid4()))
+        if not is_sharded_collection(collection_name):
+            record.setdefault("plant_id", PLANT_IDS[0])
+    insert_fact_documents(collection_name, records)
+    partials = kpi_partials_from_records(collection_name, records)
+    apply_kpi_partials(partials)
+    anomalies = detect_anomalies(collection_name, records)
+    return {"inserted": len(records), "kpi_partials_updated": len(partials), "anomalies": len(anomalies)}
+
+def kpi_ratio(numerator: float, denominator: float) -> Optional[float]:
+    return round(numerator / denominator, 4) if denominator else None
+
+def kpi_metrics(sums: Dict[str, float]) -> Dict[str, Optional[float]]:
+    """Availability, performance and quality of summed partials"""
+    run_minutes = max(sums.get("planned_minutes", 0) - sums.get("downtime_minutes", 0), 0)
+    good_count = max(sums.get("actual_production", 0) - sums.get("rejected_count", 0), 0)
+    return {
+        "availability": kpi_ratio(run_minutes, sums.get("planned_minutes", 0)),
+        "performance": kpi_ratio(sums.get("actual_production", 0), sums.get("planned_production", 0)),
+        "quality": kpi_ratio(good_count, sums.get("actual_production", 0))
+    }
+
+def summarize_kpis(buckets: Dict[Tuple, Dict[str, float]], group_by: Optional[str]) -> List[Dict[str, Any]]:
+    """Roll KPI buckets up into groups.
+
+    OEE is availability x performance x quality of each bucket, and a group's OEE is
+    the bucket OEEs weighted by planned production, the same as kpi_oee's
+    effective_good_count / planned_production.
+    """
+    groups: Dict[Any, Dict[str, float]] = {}
+    for key, sums in buckets.items():
+        metrics = kpi_metrics(sums)
+        oee = (None if None in metrics.values()
+               else metrics["availability"] * metrics["performance"] * metrics["quality"])
+        group = groups.setdefault(dict(key).get(group_by) if group_by else None, {})
+        sum_kpi_sums(group, sums)
+        group["effective_good_count"] = group.get("effective_good_count", 0) + (oee or 0) * sums.get("planned_production", 0)
+    return [
+        {
+            "_id": group_value,
+            **{measure: round(value, 2) for measure, value in sums.items()},
+            **kpi_metrics(sums),
+            "oee": kpi_ratio(sums.get("effective_good_count", 0), sums.get("planned_production", 0))
+        }
+        for group_value, sums in sorted(groups.items(), key=lambda item: str(item[0]))
+    ]
+
+def kpi_bucket_key(partial: Dict[str, Any], by_shift: bool) -> Tuple:
+    """OEE is computed per line and day (and shift when grouping or filtering by it)"""
+    fields = ["plant_id", "production_line", "date"] + (["shift"] if by_shift else [])
+    return tuple((field, partial.get(field)) for field in fields)
+
+def kpi_buckets(partials: List[Tuple[Dict[str, Any], Dict[str, float]]], filters: Dict[str, str],
+                by_shift: bool) -> Dict[Tuple, Dict[str, float]]:
+    """Sum (key fields, sums) partials into line-day buckets, or line-day-shift buckets.
+
+    Rejects are only recorded per day (quality_metrics has no shift), so per-shift buckets
+    get the day's rejects apportioned by each shift's share of actual_production.
+    """
+    if by_shift:
+        daily_rejects: Dict[Tuple, float] = {}
+        daily_production: Dict[Tuple, float] = {}
+        for partial, sums in partials:
+            day = kpi_bucket_key(partial, False)
+            if partial.get("shift") is None:
+                daily_rejects[day] = daily_rejects.get(day, 0) + sums.get("rejected_count", 0)
+            else:
+                daily_production[day] = daily_production.get(day, 0) + sums.get("actual_production", 0)
+        apportioned = []
+        for partial, sums in partials:
+            day = kpi_bucket_key(partial, False)
+            production = daily_production.get(day, 0)
+            if partial.get("shift") is None:
+                if not production:
+                    apportioned.append((partial, sums))
+                continue
+            if daily_rejects.get(day):
+                share = sums.get("actual_production", 0) / production
+                sums = dict(sums, rejected_count=sums.get("rejected_count", 0) + daily_rejects[day] * share)
+            apportioned.append((partial, sums))
+        partials = apportioned
+
+    buckets: Dict[Tuple, Dict[str, float]] = {}
+    for partial, sums in partials:
+        if any(partial.get(field) != value for field, value in filters.items()):
+            continue
+        sum_kpi_sums(buckets.setdefault(kpi_bucket_key(partial, by_shift), {}), sums)
+    return buckets
+
+def kpi_window_buckets(days: int, filters: Dict[str, str], by_shift: bool) -> Dict[Tuple, Dict[str, float]]:
+    """Line-day buckets of the last days days, from the in-memory rings"""
+    today = datetime.now().date().toordinal()
+    partials = []
+    with kpi_lock:
+        for (plant_id, production_line, shift), ring in kpi_rings.items():
+            ring_key = {"plant_id": plant_id, "production_line": production_line, "shift": shift}
+            # Shift is filtered after apportioning the daily rejects
+            if any(ring_key[field] != value for field, value in filters.items() if field != "shift"):
+                continue
+            for day, sums in ring.window(days, today):
+                partials.append(({**ring_key, "date": datetime.fromordinal(day).strftime("%Y-%m-%d")}, dict(sums)))
+    return kpi_buckets(partials, filters, by_shift)
+
+def kpi_range_buckets(date_from: Optional[str], date_to: Optional[str], filters: Dict[str, str],
+                      by_shift: bool) -> Dict[Tuple, Dict[str, float]]:
+    """Line-day buckets of an arbitrary date range, from kpi_partials"""
+    match: Dict[str, Any] = {field: value for field, value in filters.items() if field != "shift"}
+    if date_from or date_to:
+        match["date"] = {**({"$gte": date_from} if date_from else {}), **({"$lte": date_to} if date_to else {})}
+    return kpi_buckets([
+        (partial, {measure: partial.get(measure, 0) for measure in KPI_MEASURES})
+        for partial in db.kpi_partials.find(match)
+    ], filters, by_shift)
+
+def kpi_oee_pipeline(pipeline: List[Dict]) -> List[Dict]:
+    """kpi_oee: one document per plant, line and day with OEE and its components, computed
+    from kpi_partials; a leading $match on plant_id/production_line/date runs before the $group"""
+    prefix: List[Dict] = []
+    if pipeline and isinstance(pipeline[0].get("$match"), dict) and \
+            set(pipeline[0]["$match"]) <= {"plant_id", "production_line", "date"}:
+        prefix, pipeline = [pipeline[0]], pipeline[1:]
+
+    def ratio(numerator: str, denominator: str) -> Dict[str, Any]:
+        return {"$cond": [{"$gt": [f"${denominator}", 0]}, {"$divide": [f"${numerator}", f"${denominator}"]}, None]}
+
+    return prefix + [
+        {"$group": {
+            "_id": {"plant_id": "$plant_id", "production_line": "$production_line", "date": "$date"},
+            **{measure: {"$sum": f"${measure}"} for measure in KPI_MEASURES}
+        }},
+        {"$addFields": {
+            "plant_id": "$_id.plant_id",
+            "production_line": "$_id.production_line",
+            "date": "$_id.date",
+            "run_minutes": {"$max": [0, {"$subtract": ["$planned_minutes", "$downtime_minutes"]}]},
+            "good_count": {"$max": [0, {"$subtract": ["$actual_production", "$rejected_count"]}]}
+        }},
+        {"$addFields": {
+            "availability": ratio("run_minutes", "planned_minutes"),
+            "performance": ratio("actual_production", "planned_production"),
+            "quality": ratio("good_count", "actual_production")
+        }},
+        {"$addFields": {"oee": {"$multiply": ["$availability", "$performance", "$quality"]}}},
+        {"$addFields": {"effective_good_count": {"$multiply": [{"$ifNull": ["$oee", 0]}, "$planned_production"]}}},
+        {"$project": {"_id": 0}}
+    ] + pipeline
+
+# Collections that are computed from another collection: name -> (source, pipeline prefixer)
+VIRTUAL_COLLECTIONS: Dict[str, Tuple[str, Callable[[List[Dict]], List[Dict]]]] = {
+    "kpi_oee": ("kpi_partials", kpi_oee_pipeline)
+}
+
+def infer_pipeline_collection(pipeline: List[Dict]) -> Optional[str]:
+    """kpi_oee for pipelines that use its OEE fields, else None (unknown)"""
+    referenced = set(re.findall(r'"\$([A-Za-z_]\w*)', json.dumps(pipeline, default=str)))
+    if pipeline and isinstance(pipeline[0], dict) and isinstance(pipeline[0].get("$match"), dict):
+        referenced |= set(pipeline[0]["$match"])
+    return "kpi_oee" if referenced & KPI_OEE_FIELDS else None
+
+# Streaming anomaly detection
+# Metrics watched per fact collection and the field identifying a series (line or machine)
+ANOMALY_SERIES = {
+    "production_data": ("production_line", ["defect_count", "downtime_minutes"]),
+    "quality_metrics": ("production_line", ["defect_count"]),
+    "equipment_downtime": ("equipment_id", ["downtime_minutes"])
+}
+ANOMALY_STATE_FIELDS = ["count", "mean", "variance", "median", "mad"]
+
+class AnomalyDetector:
+    """Rolling statistics of one metric of one line or machine, updated in O(1) per value.
+
+    Keeps an EWMA mean/variance and a streaming median and MAD (each nudged towards the
+    new value by a step proportional to the current spread), so a value can be scored
+    with a robust z-score without keeping or rescanning any history.
+    """
+
+    def __init__(self, state: Optional[Dict[str, float]] = None):
+        state = state or {}
+        self.count = int(state.get("count", 0))
+        self.mean = state.get("mean", 0.0)
+        self.variance = state.get("variance", 0.0)
+        self.median = state.get("median", 0.0)
+        self.mad = state.get("mad", 0.0)
+
+    def score(self, value: float) -> Tuple[Optional[float], Optional[float]]:
+        """(robust z, EWMA z) of a value against the statistics seen so far"""
+        robust_z = 0.6745 * (value - self.median) / self.mad if self.mad > 1e-9 else None
+        ewma_z = (value - self.mean) / math.sqrt(self.variance) if self.variance > 1e-9 else None
+        return robust_z, ewma_z
+
+    def update(self, value: float):
+        if self.count == 0:
+            self.mean = self.median = value
+        else:
+            delta = value - self.mean
+            self.mean += ANOMALY_EWMA_ALPHA * delta
+            self.variance = (1 - ANOMALY_EWMA_ALPHA) * (self.variance + ANOMALY_EWMA_ALPHA * delta * delta)
+            step = ANOMALY_QUANTILE_RATE * max(self.mad, math.sqrt(self.variance), 1e-6)
+            self.median += step if value > self.median else -step if value < self.median else 0
+            self.mad = max(self.mad + (step if abs(value - self.median) > self.mad else -step), 0.0)
+        self.count += 1
+
+    def state(self) -> Dict[str, float]:
+        return {field: getattr(self, field) for field in ANOMALY_STATE_FIELDS}
+
+# Detectors are keyed by (collection, plant_id, series, metric): line and machine ids repeat across plants
+ANOMALY_KEY_FIELDS = ["collection", "plant_id", "series", "metric"]
+anomaly_detectors: Dict[Tuple[str, str, str, str], AnomalyDetector] = {}
+anomaly_subscribers: set = set()
+
+def anomaly_detector_id(key: Tuple[str, str, str, str]) -> str:
+    return "|".join(key)
+
+def observe_records(collection_name: str, records: List[Dict[str, Any]], flag: bool = True) -> Tuple[List[Dict[str, Any]], set]:
+    """Score and fold records into their series' detectors.
+
+    Returns the anomalies (upward spikes) found and the keys of the detectors touched.
+    """
+    series_field, metrics = ANOMALY_SERIES[collection_name]
+    anomalies = []
+    touched = set()
+    with anomaly_lock:
+        for record in records:
+            series = record.get(series_field)
+            if not series:
+                continue
+            for metric in metrics:
+                value = record.get(metric)
+                if not isinstance(value, (int, float)) or isinstance(value, bool):
+                    continue
+                key = (collection_name, str(record.get("plant_id") or ""), str(series), metric)
+                detector = anomaly_detectors.get(key)
+                if detector is None:
+                    detector = anomaly_detectors[key] = AnomalyDetector()
+                robust_z, ewma_z = detector.score(value)
+                z = robust_z if robust_z is not None else ewma_z
+                if flag and detector.count >= ANOMALY_MIN_SAMPLES and z is not None and z >= ANOMALY_Z_THRESHOLD:
+                    anomalies.append({
+                        "_id": str(uuid.uuid4()),
+                        "collection": collection_name,
+                        "series_field": series_field,
+                        "series": str(series),
+                        "metric": metric,
+                        "value": value,
+                        "expected": round(detector.median, 3),
+                        "ewma": round(detector.mean, 3),
+                        "robust_z": round(robust_z, 2) if robust_z is not None else None,
+                        "ewma_z": round(ewma_z, 2) if ewma_z is not None else None,
+                        "severity": "high" if z >= 2 * ANOMALY_Z_THRESHOLD else "medium",
+                        "date": record.get("date"),
+                        "plant_id": record.get("plant_id"),
+                        "record_id": record.get("_id"),
+                        "detected_at": datetime.now().isoformat()
+                    })
+                detector.update(value)
+                touched.add(key)
+    return anomalies, touched
+
+def save_anomaly_detectors(keys: set):
+    with anomaly_lock:
+        operations = [
+            ReplaceOne({"_id": anomaly_detector_id(key)}, {
+                "_id": anomaly_detector_id(key), **dict(zip(ANOMALY_KEY_FIELDS, key)), **anomaly_detectors[key].state()
+            }, upsert=True)
+            for key in keys
+        ]
+    if operations:
+        db.anomaly_detectors.bulk_write(operations, ordered=False)
+
+def rebuild_anomaly_detectors() -> int:
+    """Replay each plant's series in date order to train fresh detectors (nothing is flagged)"""
+    with anomaly_lock:
+        anomaly_detectors.clear()
+    for collection_name, (series_field, metrics) in ANOMALY_SERIES.items():
+        fields = {field: 1 for field in ["date", "plant_id", series_field] + metrics}
+        records = aggregate_collection(collection_name, [
+            {"$project": fields}, {"$sort": {"plant_id": 1, series_field: 1, "date": 1}}
+        ])
+        observe_records(collection_name, records, flag=False)
+    db.anomaly_detectors.drop()
+    save_anomaly_detectors(set(anomaly_detectors))
+    return len(anomaly_detectors)
+
+def load_anomaly_detectors():
+    """Restore detector state saved by earlier ingests, training from history on first start"""
+    db.anomalies.create_index([("detected_at", -1)])
+    db.anomalies.create_index([("collection", 1), ("plant_id", 1), ("series", 1), ("metric", 1), ("date", -1)])
+    states = list(db.anomaly_detectors.find())
+    # States saved before detectors were keyed by plant are retrained
+    if not states or any("plant_id" not in state for state in states):
+        rebuild_anomaly_detectors()
+        return
+    with anomaly_lock:
+        anomaly_detectors.clear()
+        for state in states:
+            anomaly_detectors[tuple(state[field] for field in ANOMALY_KEY_FIELDS)] = AnomalyDetector(state)
+
+def publish_anomalies(anomalies: List[Dict[str, Any]]):
+    """Hand new anomalies to every open dashboard stream; slow readers lose their oldest events"""
+    def offer(queue: asyncio.Queue, anomaly: Dict[str, Any]):
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(anomaly)
+
+    for loop, queue in list(anomaly_subscribers):
+        for anomaly in anomalies:
+            loop.call_soon_threadsafe(offer, queue, anomaly)
+
+def detect_anomalies(collection_name: str, records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Score ingested records, store and publish the anomalies and persist detector state"""
+    anomalies, touched = observe_records(collection_name, records)
+    save_anomaly_detectors(touched)
+    if anomalies:
+        db.anomalies.insert_many([dict(anomaly) for anomaly in anomalies])
+        bump_collection_version("anomalies")
+        publish_anomalies(anomalies)
+    return anomalies
+
+# Retention and archival
+def fact_sources(collection_name: str) -> List[Tuple[Optional[str], Any]]:
+    """(plant, collection) pairs holding a fact collection: one per plant shard, or (None, main collection)"""
+    if not is_sharded_collection(collection_name):
+        return [(None, db[collection_name])]
+    return [(plant, shard_database[collection_name]) for plant, shard_database in shard_databases.items()]
+
+def archive_directory(collection_name: str) -> str:
+    return os.path.join(ARCHIVE_DIR, collection_name)
+
+def load_archive_watermarks():
+    archive_watermarks.clear()
+    for state in db.archive_state.find({}):
+        archive_watermarks[state["_id"]] = state["archived_before"]
+
+def rollup_pipeline(collection_name: str, match: Dict[str, Any]) -> List[Dict]:
+    """Add the matched raw records to <collection>_daily, one document per day and dimension values"""
+    spec = ROLLUP_SPECS[collection_name]
+    summed_fields = spec["measures"] + ["record_count"]
+    return [
+        {"$match": match},
+        {"$group": {
+            "_id": {"date": "$date", **{dimension: f"${dimension}" for dimension in spec["dimensions"]}},
+            **{measure: {"$sum": f"${measure}"} for measure in spec["measures"]},
+            "record_count": {"$sum": 1}
+        }},
+        # Flat copies of the key so rollups can be queried like the raw collection
+        {"$addFields": {"date": "$_id.date", **{dimension: f"$_id.{dimension}" for dimension in spec["dimensions"]}}},
+        {"$merge": {
+            "into": rollup_collection_name(collection_name),
+            "on": "_id",
+            "whenMatched": [{"$set": {
+                field: {"$add": [{"$ifNull": [f"${field}", 0]}, f"$$new.{field}"]} for field in summed_fields
+            }}],
+            "whenNotMatched": "insert"
+        }}
+    ]
+
+def write_archive_file(collection_name: str, batch_id: str, documents: List[Dict[str, Any]]) -> str:
+    directory = archive_directory(collection_name)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{batch_id}.parquet")
+    # Sorted by date so row group statistics let date-range reads skip most of the file
+    table = pa.Table.from_pylist(sorted(documents, key=lambda document: document.get("date") or ""))
+    pq.write_table(table, path + ".tmp", compression="zstd")
+    os.replace(path + ".tmp", path)
+    return path
+
+def complete_archive_batch(batch: Dict[str, Any]):
+    """Roll up and delete the raw records of a batch whose archive file is written.
+
+    Re-run for batches interrupted by a crash; only a crash between the rollup
+    $merge and its status update can count a batch twice in the rollup.
+    """
+    collection = db[batch["collection"]] if batch.get("plant") is None else shard_databases[batch["plant"]][batch["collection"]]
+    if batch["status"] == "archived":
+        list(collection.aggregate(rollup_pipeline(batch["collection"], {"_id": {"$in": batch["ids"]}})))
+        db.archive_batches.update_one({"_id": batch["_id"]}, {"$set": {"status": "rolled_up"}})
+    collection.delete_many({"_id": {"$in": batch["ids"]}})
+    bump_collection_version(batch["collection"], rollup_collection_name(batch["collection"]))
+    db.archive_batches.update_one(
+        {"_id": batch["_id"]},
+        {"$set": {"status": "done", "completed_at": datetime.now().isoformat()}, "$unset": {"ids": ""}}
+    )
+
+def recover_archive_batches():
+    for batch in db.archive_batches.find({"status": {"$in": ["pending", "archived", "rolled_up"]}}):
+        if batch["status"] == "pending":
+            # The archive file may be partial; the raw records are still in Mongo
+            for path in (batch["file"], batch["file"] + ".tmp"):
+                if os.path.exists(path):
+                    os.remove(path)
+            db.archive_batches.delete_one({"_id": batch["_id"]})
+        else:
+            complete_archive_batch(batch)
+
+def run_retention() -> Dict[str, Any]:
+    """Archive raw fact records older than RETENTION_DAYS to Parquet, in batches"""
+    # The scheduler and the admin endpoint must not archive the same records twice
+    with retention_lock:
+        return _run_retention()
+
+def _run_retention() -> Dict[str, Any]:
+    cutoff = (datetime.now() - timedelta(days=RETENTION_DAYS)).strftime("%Y-%m-%d")
+    recover_archive_batches()
+    summary = {}
+    for collection_name in ROLLUP_SPECS:
+        archived_records = 0
+        for plant, collection in fact_sources(collection_name):
+            collection.create_index("date")
+            while True:
+                documents = list(collection.find({"date": {"$lt": cutoff}}).limit(RETENTION_BATCH_SIZE))
+                if not documents:
+                    break
+                if collection_name not in archive_watermarks:
+                    # Publish the watermark first so reads of old ranges already union the archive
+                    archive_watermarks[collection_name] = cutoff
+                batch_id = str(uuid.uuid4())
+                batch = {
+                    "_id": batch_id,
+                    "collection": collection_name,
+                    "plant": plant,
+                    "ids": [document["_id"] for document in documents],
+                    "file": os.path.join(archive_directory(collection_name), f"{batch_id}.parquet"),
+                    "rows": len(documents),
+                    "status": "pending",
+                    "created_at": datetime.now().isoformat()
+                }
+                db.archive_batches.insert_one(batch)
+                write_archive_file(collection_name, batch_id, documents)
+                db.archive_batches.update_one({"_id": batch_id}, {"$set": {"status": "archived"}})
+                batch["status"] = "archived"
+                complete_archive_batch(batch)
+                archived_records += len(documents)
+        if collection_name in archive_watermarks:
+            db.archive_state.update_one({"_id": collection_name}, {"$max": {"archived_before": cutoff}}, upsert=True)
+            archive_watermarks[collection_name] = max(archive_watermarks[collection_name], cutoff)
+        summary[collection_name] = {
+            "archived_records": archived_records,
+            "archived_before": archive_watermarks.get(collection_name)
+        }
+    return summary
+
+def archive_date_bounds(pipeline: List[Dict]) -> Tuple[Optional[str], Optional[str]]:
+    """Inclusive (from, to) date bounds of a pipeline's leading $match; (None, None) is unbounded"""
+    match = pipeline[0].get("$match") if pipeline else None
+    if not isinstance(match, dict) or "date" not in match:
+        return None, None
+    condition = match["date"]
+    if isinstance(condition, str):
+        return condition, condition
+    if not isinstance(condition, dict):
+        return None, None
+    if "$eq" in condition:
+        return condition["$eq"], condition["$eq"]
+    if condition.get("$in"):
+        return min(condition["$in"]), max(condition["$in"])
+    return condition.get("$gte", condition.get("$gt")), condition.get("$lte", condition.get("$lt"))
+
+def reaches_archive(collection_name: str, pipeline: List[Dict]) -> bool:
+    """Whether the pipeline's date range (all time when it has no date filter) starts before the watermark"""
+    date_from, _ = archive_date_bounds(pipeline)
+    return date_from is None or date_from < archive_watermarks[collection_name]
+
+def archived_files(collection_name: str) -> List[str]:
+    # Files of unfinished batches duplicate records that are still in Mongo
+    in_flight = {batch["file"] for batch in db.archive_batches.find({"status": {"$in": ["pending", "archived"]}}, {"file": 1})}
+    directory = archive_directory(collection_name)
+    return [
+        os.path.join(directory, name) for name in sorted(os.listdir(directory))
+        if name.endswith(".parquet") and os.path.join(directory, name) not in in_flight
+    ] if os.path.isdir(directory) else []
+
+def iter_archived_batches(collection_name: str, pipeline: List[Dict], batch_size: int):
+    """Yield the collection's archived rows in the pipeline's date range and plants, batch_size
+    rows at a time, reading only the row groups whose date statistics overlap the range"""
+    date_from, date_to = archive_date_bounds(pipeline)
+    match = pipeline[0].get("$match") if pipeline and isinstance(pipeline[0].get("$match"), dict) else {}
+    plant_condition = match.get("plant_id")
+    if isinstance(plant_condition, str):
+        plants = [plant_condition]
+    elif isinstance(plant_condition, dict) and set(plant_condition) == {"$in"}:
+        plants = list(plant_condition["$in"])
+    else:
+        plants = None
+
+    for path in archived_files(collection_name):
+        parquet_file = pq.ParquetFile(path, memory_map=True)
+        date_column = parquet_file.schema_arrow.get_field_index("date")
+        row_groups = []
+        for index in range(parquet_file.metadata.num_row_groups):
+            statistics = parquet_file.metadata.row_group(index).column(date_column).statistics if date_column != -1 else None
+            if statistics is not None and statistics.has_min_max and (
+                    (date_from is not None and statistics.max < date_from)
+                    or (date_to is not None and statistics.min > date_to)):
+                continue
+            row_groups.append(index)
+        if not row_groups:
+            continue
+        for batch in parquet_file.iter_batches(batch_size=batch_size, row_groups=row_groups):
+            mask = None
+            for condition in (
+                pc.greater_equal(batch.column("date"), date_from) if date_from is not None and date_column != -1 else None,
+                pc.less_equal(batch.column("date"), date_to) if date_to is not None and date_column != -1 else None,
+                pc.is_in(batch.column("plant_id"), pa.array(plants)) if plants is not None and "plant_id" in batch.schema.names else None
+            ):
+                if condition is not None:
+                    mask = condition if mask is None else pc.and_(mask, condition)
+            if mask is not None:
+                batch = batch.filter(mask)
+            if batch.num_rows:
+                # Columns missing from a record come back as nulls; drop them like absent Mongo fields
+                yield [{key: value for key, value in row.items() if value is not None} for row in batch.to_pylist()]
+
+def field_roots(value: Any) -> set:
+    """Top-level fields an expression reads ($field or $field.sub)"""
+    if isinstance(value, str):
+        return {value[1:].split(".", 1)[0]} if value.startswith("$") and not value.startswith("$$") else set()
+    if isinstance(value, dict):
+        return set().union(*(field_roots(item) for item in value.values())) if value else set()
+    if isinstance(value, list):
+        return set().union(*(field_roots(item) for item in value)) if value else set()
+    return set()
+
+def rollup_group_plan(collection_name: str, pipeline: List[Dict]) -> Optional[Tuple[List[Dict], Dict, Dict, List[Dict]]]:
+    """(filters, raw partial $group, rollup partial $group, merge stages) for a pipeline that
+    only filters and groups on the rollup's dimensions and date, with sums of its measures
+    (and counts, from record_count) or min/max of its keys; None otherwise"""
+    spec = ROLLUP_SPECS.get(collection_name)
+    if not spec:
+        return None
+    keys = set(spec["dimensions"]) | {"date"}
+    measures = {f"${measure}" for measure in spec["measures"]}
+    index = 0
+    while index < len(pipeline) and set(pipeline[index]) == {"$match"}:
+        match = pipeline[index]["$match"]
+        if not isinstance(match, dict) or not set(match) <= keys:
+            return None
+        index += 1
+    if index == len(pipeline) or set(pipeline[index]) != {"$group"} or not field_roots(pipeline[index]["$group"]["_id"]) <= keys:
+        return None
+    decomposed = decompose_group(pipeline[index]["$group"])
+    if not decomposed:
+        return None
+    partial, merge_stages = decomposed
+    rollup_partial: Dict[str, Any] = {"_id": partial["_id"]}
+    for field_name, accumulator in partial.items():
+        if field_name == "_id":
+            continue
+        operator, expression = next(iter(accumulator.items()))
+        counted = expression == 1 or (
+            isinstance(expression, dict) and expression.get("$cond", [None])[0] in [{"$isNumber": measure} for measure in measures])
+        if operator == "$sum" and counted:
+            rollup_partial[field_name] = {"$sum": "$record_count"}
+        elif (operator == "$sum" and expression in measures) or (operator in ("$min", "$max") and field_roots(expression) <= keys):
+            rollup_partial[field_name] = accumulator
+        else:
+            return None
+    return pipeline[:index], partial, rollup_partial, merge_stages + pipeline[index + 1:]
+
+def aggregate_hot(collection_name: str, pipeline: List[Dict]) -> List[Dict[str, Any]]:
+    if is_sharded_collection(collection_name):
+        return aggregate_sharded(collection_name, pipeline)
+    return list(db[collection_name].aggregate(pipeline))
+
+def aggregate_with_archive(collection_name: str, pipeline: List[Dict]) -> List[Dict[str, Any]]:
+    """Run a pipeline over the hot collection plus its archived records, without writing to Mongo.
+
+    Pipelines that only group on rollup keys are answered from <collection>_daily, which
+    holds exactly the archived records. Otherwise the per-shard part of the pipeline runs
+    on the hot collection and on streamed batches of archived rows, and the partials are
+    merged like shard results.
+    """
+    rollup_plan = rollup_group_plan(collection_name, pipeline)
+    if rollup_plan:
+        filters, partial, rollup_partial, merge_stages = rollup_plan
+        partials = aggregate_hot(collection_name, filters + [{"$group": partial}])
+        partials += aggregate_hot(rollup_collection_name(collection_name), filters + [{"$group": rollup_partial}])
+        return merge_on_coordinator(partials, merge_stages)
+
+    shard_pipeline, merge_pipeline = split_pipeline_for_shards(pipeline, set())
+    reduces = any(set(stage) & {"$group", "$limit"} for stage in shard_pipeline)
+    archived_partials = []
+    archived_rows = 0
+    for rows in iter_archived_batches(collection_name, pipeline, SHARD_MERGE_DOCUMENTS_LIMIT):
+        archived_rows += len(rows)
+        if not reduces and archived_rows > SHARD_MERGE_DOCUMENTS_LIMIT:
+            raise ValueError(
+                f"Query reads more than {SHARD_MERGE_DOCUMENTS_LIMIT} archived {collection_name} records row by row; "
+                f"narrow the date range or group by {', '.join(ROLLUP_SPECS[collection_name]['dimensions'])} or date"
+            )
+        archived_partials.extend(aggregate_documents(rows, shard_pipeline) if shard_pipeline else rows)
+    if not archived_rows:
+        return aggregate_hot(collection_name, pipeline)
+    if not reduces and not is_sharded_collection(collection_name):
+        # Rows aren't reduced before the merge, so keep the hot side in Mongo and union the archived rows in
+        return list(db[collection_name].aggregate(
+            shard_pipeline + [{"$unionWith": {"pipeline": [{"$documents": archived_partials}]}}] + merge_pipeline
+        ))
+    sources = fact_collections(collection_name, target_plants(pipeline) if is_sharded_collection(collection_name) else None)
+    hot_partials = shard_executor.map(lambda source: list(source.aggregate(shard_pipeline)), sources)
+    return merge_on_coordinator([document for partial in hot_partials for document in partial] + archived_partials, merge_pipeline)
+
+async def retention_scheduler():
+    """Periodically archive raw records that fell out of the retention window"""
+    while True:
+        try:
+            summary = await asyncio.to_thread(run_retention)
+            archived = sum(result["archived_records"] for result in summary.values())
+            if archived:
+                print(f"Retention: archived {archived} records")
+        except Exception as e:
+            print(f"Retention scheduler error: {e}")
+        await asyncio.sleep(RETENTION_INTERVAL_SECONDS)
+
+# Streaming export
+EXPORT_FORMATS = {"csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+
+class ExportBuffer:
+    """Write-only file object whose contents are drained after each batch"""
+
+    def __init__(self):
+        self.chunks: List[bytes] = []
+        self.closed = False
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def export_cell(value: Any) -> Any:
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+def export_batches(documents, batch_size: int):
+    """Group an iterator of documents into lists of batch_size, pausing between batches"""
+    batch = []
+    for document in documents:
+        batch.append(document)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+            if EXPORT_THROTTLE_SECONDS:
+                time.sleep(EXPORT_THROTTLE_SECONDS)
+    if batch:
+        yield batch
+
+def encode_csv(batches):
+    fieldnames = None
+    for batch in batches:
+        buffer = io.StringIO()
+        if fieldnames is None:
+            # Columns come from the first batch; later fields not seen there are dropped
+            fieldnames = list(dict.fromkeys(key for document in batch for key in document))
+            writer = csv.DictWriter(buffer, fieldnames=fieldnames, extrasaction="ignore")
+            writer.writeheader()
+        writer = csv.DictWriter(buffer, fieldnames=fieldnames, extrasaction="ignore")
+        writer.writerows({key: export_cell(value) for key, value in document.items()} for document in batch)
+        yield buffer.getvalue().encode("utf-8")
+
+def encode_parquet(batches):
+    """One Parquet row group per batch, streamed as soon as it is written"""
+    sink = ExportBuffer()
+    writer = None
+    try:
+        for batch in batches:
+            rows = [{key: export_cell(value) for key, value in document.items()} for document in batch]
+            if writer is None:
+                table = pa.Table.from_pylist(rows)
+                writer = pq.ParquetWriter(sink, table.schema, compression="zstd")
+            else:
+                table = pa.Table.from_pylist(rows, schema=writer.schema)
+            writer.write_table(table)
+            yield sink.drain()
+    finally:
+        if writer is not None:
+            writer.close()
+    yield sink.drain()
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: gzip container
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def export_plan(collection_name: str, pipeline: List[Dict]) -> str:
+    """How an export is produced: "cursor" (streamed from the Mongo cursor(s)), "archive" (hot
+    cursors, then archived row groups), or "aggregate" (a grouped or limited result, built in
+    the export thread). Row-level results that would have to be gathered in memory are
+    rejected with a ValueError."""
+    operators = [next(iter(stage)) for stage in pipeline]
+    reduced = any(operator in ("$group", "$limit", "$count") for operator in operators)
+    if collection_name in archive_watermarks and reaches_archive(collection_name, pipeline):
+        if all(operator in SHARD_LOCAL_STAGES for operator in operators):
+            return "archive"
+        if reduced:
+            return "aggregate"
+        raise ValueError("Row-level exports over archived dates can only filter and project; narrow the date range")
+    # $lookup stays on the cursor when the looked-up collection sits next to every source
+    local_collections = set(QUERY_COLLECTIONS) if is_sharded_collection(collection_name) else None
+    row_wise = all(
+        operator in SHARD_LOCAL_STAGES or (operator == "$lookup" and (
+            local_collections is None or stage["$lookup"].get("from") in local_collections))
+        for operator, stage in zip(operators, pipeline)
+    )
+    if not is_sharded_collection(collection_name) or len(target_plants(pipeline)) == 1 or row_wise:
+        return "cursor"
+    if reduced:
+        return "aggregate"
+    raise ValueError("Row-level exports across plant shards can't be sorted or joined; filter by plant_id")
+
+def export_documents(collection_name: str, pipeline: List[Dict], plan: str):
+    """Iterate a pipeline's results for export. A generator, so all database work happens
+    in the export thread as the response is streamed"""
+    if plan == "aggregate":
+        # Grouped results need the shard/archive merge; they are small anyway
+        yield from aggregate_collection(collection_name, pipeline)
+        return
+    if any("$lookup" in stage for stage in pipeline):
+        pipeline = plan_joins(collection_name, pipeline)
+        for stage in pipeline:
+            if "$lookup" in stage and isinstance(stage["$lookup"].get("foreignField"), str):
+                ensure_join_index(stage["$lookup"]["from"], stage["$lookup"]["foreignField"])
+    sources = fact_collections(collection_name, target_plants(pipeline) if is_sharded_collection(collection_name) else None)
+    for source in sources:
+        yield from source.with_options(read_preference=ReadPreference.SECONDARY_PREFERRED).aggregate(
+            pipeline, batchSize=EXPORT_BATCH_SIZE, allowDiskUse=True
+        )
+    if plan == "archive":
+        # Row-wise stages give the same result batch by batch
+        for rows in iter_archived_batches(collection_name, pipeline, EXPORT_BATCH_SIZE):
+            yield from aggregate_documents(rows, pipeline)
+
+class ExportResponse(StreamingResponse):
+    """A StreamingResponse that releases its export slot however the response ends, including
+    a client that disconnects before the first chunk (when the generator never starts)"""
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            export_slots.release()
+
+def export_response(documents, export_format: str, gzip: bool, name: str) -> StreamingResponse:
+    """Stream documents as CSV or Parquet; the sync generator runs in the threadpool"""
+    batches = export_batches(documents, EXPORT_BATCH_SIZE)
+    chunks = encode_csv(batches) if export_format == "csv" else encode_parquet(batches)
+
+    filename = f"{name}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{export_format}" + (".gz" if gzip else "")
+    return ExportResponse(
+        gzip_stream(chunks) if gzip else chunks,
+        media_type="application/gzip" if gzip else EXPORT_FORMATS[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+def start_export(collection_name: str, pipeline: List[Dict], export_format: str, gzip: bool, name: str) -> StreamingResponse:
+    if collection_name in VIRTUAL_COLLECTIONS:
+        # Plan and stream against the backing collection, like aggregate_collection
+        collection_name, prefixer = VIRTUAL_COLLECTIONS[collection_name]
+        pipeline = prefixer(pipeline)
+    try:
+        plan = export_plan(collection_name, pipeline)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    acquire_export_slot(export_format)
+    return export_response(export_documents(collection_name, pipeline, plan), export_format, gzip, name)
+
+def acquire_export_slot(export_format: str):
+    if export_format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(EXPORT_FORMATS)}")
+    if not export_slots.acquire(blocking=False):
+        raise HTTPException(status_code=429, detail="Too many exports running, try again later", headers={"Retry-After": "30"})
+
+def bump_collection_version(*collection_names: str):
+    """Record a write so ETags of responses built from these collections change"""
+    for collection_name in collection_names:
+        collection_versions[collection_name] = collection_versions.get(collection_name, 0) + 1
+
+def versions_etag(collection_names: List[str]) -> str:
+    fingerprint = ";".join(f"{name}={collection_versions.get(name, 0)}" for name in sorted(collection_names))
+    return f'"{BOOT_ID}-{hashlib.sha1(fingerprint.encode()).hexdigest()[:16]}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip().removeprefix("W/") for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+def conditional_response(response: Response, if_none_match: Optional[str], collection_names: List[str]) -> Optional[Response]:
+    """Set ETag/Cache-Control from the collections' versions; return a 304 if the client's copy is current"""
+    headers = {
+        "ETag": versions_etag(collection_names),
+        "Cache-Control": f"public, max-age={HTTP_CACHE_MAX_AGE_SECONDS}, must-revalidate"
+    }
+    if etag_matches(if_none_match, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """Reject admin requests without a valid X-Admin-Token (when ADMIN_TOKEN is configured)"""
+    if ADMIN_TOKEN and x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+async def resolve_tenant(request: Request, x_tenant_id: Optional[str] = Header(None)) -> str:
+    """Identify the calling tenant (X-Tenant-ID, else client address) for fair scheduling"""
+    tenant = (x_tenant_id or "").strip() or (request.client.host if request.client else "anonymous")
+    current_tenant.set(tenant)
+    return tenant
+
+def saved_query_results_collection(saved_query_id: str) -> str:
+    return f"saved_query_results_{saved_query_id}"
+
+def materialize_saved_query(saved_query: Dict[str, Any]) -> Dict[str, Any]:
+    """Execute a saved query's pinned pipeline and swap the results into its result collection"""
+    results = aggregate_collection(saved_query["target_collection"], saved_query["pipeline"])
+    return store_saved_query_results(saved_query, results)
+
+def create_materialized_saved_query(saved_query: Dict[str, Any], collection_name: Optional[str]) -> Dict[str, Any]:
+    """Run a new saved query's pipeline once, pin the collection it ran on, and store its results"""
+    results, target_collection = execute_pipeline(saved_query["pipeline"], collection_name)
+    saved_query["target_collection"] = target_collection
+    db.saved_queries.insert_one(saved_query)
+    return store_saved_query_results(saved_query, results)
+
+def store_saved_query_results(saved_query: Dict[str, Any], results: List[Dict]) -> Dict[str, Any]:
+    """Swap a saved query's results into its result collection and record when it was materialized"""
+    result_collection = saved_query_results_collection(saved_query["_id"])
+
+    if results:
+        # Rows are keyed by rank so reads keep the pipeline's sort order; the
+        # rename swaps the new results in atomically
+        staging_collection = f"{result_collection}_staging"
+        db[staging_collection].drop()
+        db[staging_collection].insert_many([{"_id": rank, "row": row} for rank, row in enumerate(results)])
+        db[staging_collection].rename(result_collection, dropTarget=True)
+    else:
+        db[result_collection].drop()
+
+    now = datetime.now()
+    update = {
+        "materialized_at": now.isoformat(),
+        "result_count": len(results)
+    }
+    if saved_query.get("refresh_interval_minutes"):
+        update["next_materialization_at"] = (
+            now + timedelta(minutes=saved_query["refresh_interval_minutes"])
+        ).isoformat()
+    db.saved_queries.update_one({"_id": saved_query["_id"]}, {"$set": update})
+    return update
+
+async def saved_query_scheduler():
+    """Periodically materialize saved queries whose refresh interval has elapsed"""
+    while True:
+        try:
+            due_queries = list(db.saved_queries.find({
+                "next_materialization_at": {"$lte": datetime.now().isoformat()}
+            }))
+            for saved_query in due_queries:
+                try:
+                    await asyncio.to_thread(materialize_saved_query, saved_query)
+                except Exception as e:
+                    print(f"Saved query materialization error ({saved_query['name']}): {e}")
+        except Exception as e:
+            print(f"Saved query scheduler error: {e}")
+        await asyncio.sleep(SAVED_QUERY_SCHEDULER_INTERVAL_SECONDS)
+
+@app.on_event("startup")
+async def startup_event():
+    """Initialize data on startup"""
+    init_sample_data()
+    rebuild_kpi_partials()
+    load_anomaly_detectors()
+    rebuild_schema_index()
+    ensure_slow_query_log()
+    ensure_profile_store()
+    ensure_query_log()
+    load_archive_watermarks()
+    start_job_workers()
+    asyncio.create_task(saved_query_scheduler())
+    asyncio.create_task(collection_stats_scheduler())
+    asyncio.create_task(retention_scheduler())
+    asyncio.create_task(cache_warmup_scheduler())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Persist state that is still buffered in memory"""
+    flush_layout_updates()
+
+@app.get("/api/health")
+async def health_check():
+    return {"status": "healthy", "timestamp": datetime.now().isoformat()}
+
+@app.get("/api/llm/status")
+async def llm_status():
+    """Get per-backend queue depth, latency and circuit breaker state, and pipeline parse outcomes"""
+    return {
+        "models": {"fast": LLM_FAST_MODEL, "large": LLM_LARGE_MODEL},
+        "backends": [backend.snapshot() for backend in llm_router.backends],
+        "parsing": llm_parse_snapshot()
+    }
+
+@app.get("/api/admin/scheduler", dependencies=[Depends(require_admin)])
+async def scheduler_status():
+    """Get per-tenant queue depth and queue-time metrics for the LLM and database schedulers"""
+    return {
+        "schedulers": [llm_scheduler.snapshot(), db_scheduler.snapshot()],
+        "rate_limit": {
+            "requests_per_minute": TENANT_RATE_LIMIT_PER_MINUTE,
+            "burst": TENANT_RATE_LIMIT_BURST,
+            "tracked_tenants": len(rate_limit_buckets)
+        }
+    }
+
+# Result cache and cache warm-up
+def referenced_collections(node: Any) -> List[str]:
+    """Collections a pipeline reads besides its target ($lookup / $unionWith)"""
+    found = []
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key == "$lookup" and isinstance(value, dict) and isinstance(value.get("from"), str):
+                found.append(value["from"])
+            elif key == "$unionWith":
+                found.append(value if isinstance(value, str) else value.get("coll"))
+            found.extend(referenced_collections(value))
+    elif isinstance(node, list):
+        for item in node:
+            found.extend(referenced_collections(item))
+    return [name for name in found if name]
+
+def result_cache_key(pipeline: List[Dict], collection_name: Optional[str]) -> Tuple[str, str]:
+    """Cache key of a pipeline's results and the ETag of every collection it may read"""
+    collections = ([collection_name] if collection_name else list(QUERY_COLLECTIONS)) + referenced_collections(pipeline)
+    return json.dumps([collection_name, pipeline], sort_keys=True, default=str), versions_etag(collections)
+
+def get_cached_results(cache_key: str, etag: str) -> Optional[Tuple[List[Dict], str]]:
+    entry = result_cache.get(cache_key)
+    if not entry or entry["etag"] != etag or time.time() - entry["cached_at"] > RESULT_CACHE_TTL_SECONDS:
+        return None
+    result_cache.move_to_end(cache_key)
+    return entry["results"], entry["collection"]
+
+def store_cached_results(cache_key: str, etag: str, results: List[Dict], collection_name: str):
+    """Store executed results under the ETag taken before execution, evicting the least recently used"""
+    if len(results) > RESULT_CACHE_MAX_ROWS:
+        return
+    result_cache[cache_key] = {"results": results, "collection": collection_name, "etag": etag, "cached_at": time.time()}
+    result_cache.move_to_end(cache_key)
+    while len(result_cache) > RESULT_CACHE_MAX_ENTRIES:
+        result_cache.popitem(last=False)
+
+def log_nl_queries(query_texts: List[str]):
+    """Count asked NL queries by normalized text, for warm-up ranking"""
+    now = datetime.now().isoformat()
+    db.query_log.bulk_write([
+        UpdateOne(
+            {"_id": normalize_query(query_text)},
+            {"$inc": {"count": 1}, "$set": {"query": query_text, "last_seen": now}, "$setOnInsert": {"first_seen": now}},
+            upsert=True
+        )
+        for query_text in query_texts
+    ], ordered=False)
+
+def record_nl_queries(query_texts: List[str]):
+    async def log_in_background():
+        try:
+            await asyncio.to_thread(log_nl_queries, query_texts)
+        except Exception as e:
+            print(f"Query log error: {e}")
+    if query_texts:
+        asyncio.create_task(log_in_background())
+
+def ensure_query_log():
+    db.query_log.create_index([("last_seen", -1)])
+    db.query_log.create_index([("count", -1)])
+
+def top_logged_queries(limit: int) -> List[Dict[str, Any]]:
+    """Most asked queries, with counts decayed by the time since they were last asked"""
+    now = datetime.now()
+    db.query_log.delete_many({"last_seen": {"$lt": (now - timedelta(days=QUERY_LOG_RETENTION_DAYS)).isoformat()}})
+    candidates = {entry["_id"]: entry for entry in db.query_log.find().sort("count", -1).limit(limit * 5)}
+    candidates.update({entry["_id"]: entry for entry in db.query_log.find().sort("last_seen", -1).limit(limit * 5)})
+    for entry in candidates.values():
+        age_hours = (now - datetime.fromisoformat(entry["last_seen"])).total_seconds() / 3600
+        entry["score"] = round(entry["count"] * 0.5 ** (age_hours / WARMUP_RECENCY_HALF_LIFE_HOURS), 3)
+    return sorted(candidates.values(), key=lambda entry: entry["score"], reverse=True)[:limit]
+
+def has_spare_capacity(scheduler: FairScheduler) -> bool:
+    return not scheduler.waiters and scheduler.active * 2 < scheduler.capacity
+
+async def wait_for_spare_capacity():
+    """Hold warm-up work back while live traffic is using the LLM or the database"""
+    while not (has_spare_capacity(llm_scheduler) and has_spare_capacity(db_scheduler)):
+        await asyncio.sleep(WARMUP_PAUSE_SECONDS)
+
+async def warm_query(query_text: str) -> str:
+    """Translate and execute a logged query so both caches hold it; returns what was done"""
+    await wait_for_spare_capacity()
+    translation = await translate_query(query_text)
+    if translation.get("degraded"):
+        return "degraded"
+    cache_key, etag = result_cache_key(translation["pipeline"], translation.get("collection"))
+    if get_cached_results(cache_key, etag):
+        return "cached"
+    await wait_for_spare_capacity()
+    async with db_scheduler.slot():
+        results, collection_name = await asyncio.to_thread(
+            execute_pipeline, translation["pipeline"], translation.get("collection")
+        )
+    store_cached_results(cache_key, etag, results, collection_name)
+    return "executed"
+
+async def run_cache_warmup() -> Dict[str, Any]:
+    """Warm the dashboard overview and the top logged queries, one at a time"""
+    if warmup_status["running"]:
+        return warmup_status
+    current_tenant.set(WARMUP_TENANT)
+    warmup_status.update({"running": True, "started_at": datetime.now().isoformat(), "queries": []})
+    try:
+        await wait_for_spare_capacity()
+        async with db_scheduler.slot():
+            await asyncio.to_thread(cached_dashboard_overview)
+        warmup_status["dashboard"] = "warm"
+        for entry in await asyncio.to_thread(top_logged_queries, WARMUP_TOP_QUERIES):
+            try:
+                outcome = await warm_query(entry["query"])
+            except Exception as e:
+                outcome = f"error: {e}"
+            warmup_status["queries"].append({"query": entry["query"], "score": entry["score"], "outcome": outcome})
+            await asyncio.sleep(WARMUP_PAUSE_SECONDS)
+    finally:
+        warmup_status["running"] = False
+        warmup_status["finished_at"] = datetime.now().isoformat()
+    return warmup_status
+
+async def cache_warmup_scheduler():
+    """Warm caches shortly after startup (without delaying it) and then periodically"""
+    await asyncio.sleep(WARMUP_STARTUP_DELAY_SECONDS)
+    while True:
+        try:
+            await run_cache_warmup()
+        except Exception as e:
+            print(f"Cache warm-up error: {e}")
+        await asyncio.sleep(WARMUP_INTERVAL_SECONDS)
+
+async def run_nl_query(query: NLQuery) -> Dict[str, Any]:
+    """Translate and execute an NL query, returning the dashboard payload"""
+    # Get MongoDB pipeline from LMStudio (or the translation cache)
+    translation = await translate_query(query.query)
+    pipeline = translation["pipeline"]
+    
+    record_nl_queries([query.query])
+    
+    # Execute pipeline on its target collection, or production_data falling back to the others
+    approximation = None
+    cache_key, etag = result_cache_key(pipeline, translation.get("collection"))
+    cached_results = None if query.approximate or query.explain else get_cached_results(cache_key, etag)
+    if cached_results:
+        results, collection_name = cached_results
+    else:
+        async with db_scheduler.slot():
+            started = time.perf_counter()
+            if query.approximate and translation.get("collection"):
+                collection_name = translation["collection"]
+                results, approximation = await run_in_thread(execute_approximate, pipeline, collection_name)
+            elif query.approximate:
+                approximation = {"fallback_reason": "target collection is unknown"}
+            if approximation is None or "fallback_reason" in approximation:
+                results, collection_name = await run_in_thread(execute_pipeline, pipeline, translation.get("collection"))
+                if not translation.get("degraded"):
+                    store_cached_results(cache_key, etag, results, collection_name)
+            wall_time_ms = (time.perf_counter() - started) * 1000
+    
+    response = {
+        "query": query.query,
+        "pipeline": pipeline,
+        "results": results,
+        "chart_type": recommend_chart_type(results),
+        "total_records": len(results),
+        "llm_response": translation["llm_response"],
+        "source": translation["source"],
+        "results_cached": cached_results is not None
+    }
+    if translation.get("parse_error"):
+        response["parse_error"] = True
+    if approximation is not None:
+        response["approximation"] = {
+            "approximate": "fallback_reason" not in approximation,
+            "path": "exact",
+            **approximation
+        }
+    plan = None
+    if query.explain:
+        plan = await run_in_thread(explain_pipeline, collection_name, pipeline)
+        response["execution"] = {"collection": collection_name, "wall_time_ms": round(wall_time_ms, 2), **plan}
+    if not cached_results:
+        record_query_execution(
+            query.query, pipeline, collection_name, wall_time_ms, len(results), plan, translation["source"]
+        )
+    return response
+
+# Async query jobs
+def job_summary(job: Dict[str, Any]) -> Dict[str, Any]:
+    return {key: value for key, value in job.items() if key != "result"}
+
+def purge_expired_jobs():
+    cutoff = time.time() - JOB_RESULT_TTL_SECONDS
+    for job_id in [job_id for job_id, job in jobs.items() if job.get("finished_ts", time.time()) < cutoff]:
+        jobs.pop(job_id, None)
+
+def enqueue_query_job(query: NLQuery, lane: str, tenant: str) -> Dict[str, Any]:
+    purge_expired_jobs()
+    job = {
+        "job_id": str(uuid.uuid4()),
+        "query": query.query,
+        "request": query.dict(),
+        "lane": lane,
+        "tenant": tenant,
+        "status": "queued",
+        "created_at": datetime.now().isoformat()
+    }
+    job_queues[lane].put_nowait(job["job_id"])  # raises QueueFull when the lane is saturated
+    jobs[job["job_id"]] = job
+    return job
+
+async def job_worker(lane: str):
+    """Run queued jobs of one priority lane, one at a time"""
+    queue = job_queues[lane]
+    while True:
+        job_id = await queue.get()
+        job = jobs.get(job_id)
+        if not job or job["status"] != "queued":
+            continue
+        job["status"] = "running"
+        job["started_at"] = datetime.now().isoformat()
+        current_tenant.set(job["tenant"])  # copied into the task's context below
+        task = asyncio.ensure_future(run_nl_query(NLQuery(**job["request"])))
+        running_job_tasks[job_id] = task
+        try:
+            job["result"] = await task
+            job["status"] = "completed"
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                raise  # the worker itself is shutting down
+            job["status"] = "cancelled"
+        except Exception as e:
+            job["status"] = "failed"
+            job["error"] = str(e)
+        finally:
+            running_job_tasks.pop(job_id, None)
+            job["finished_at"] = datetime.now().isoformat()
+            job["finished_ts"] = time.time()
+
+def start_job_workers():
+    for lane, worker_count in JOB_LANE_WORKERS.items():
+        job_queues[lane] = asyncio.Queue(maxsize=JOB_QUEUE_MAX_SIZE)
+        for _ in range(worker_count):
+            asyncio.create_task(job_worker(lane))
+
+@app.post("/api/query")
+async def process_natural_language_query(
+    query: NLQuery,
+    async_mode: bool = Query(False, alias="async"),
+    priority: str = Query("interactive"),
+    tenant: str = Depends(resolve_tenant)
+):
+    """Process natural language query and return dashboard data (or a job id with ?async=true)"""
+    check_tenant_rate_limit(tenant)
+    if async_mode:
+        if priority not in job_queues:
+            raise HTTPException(status_code=400, detail=f"Unknown priority lane: {priority}")
+        try:
+            job = enqueue_query_job(query, priority, tenant)
+        except asyncio.QueueFull:
+            raise HTTPException(status_code=503, detail=f"Too many queued {priority} jobs, try again later")
+        return JSONResponse(status_code=202, content={
+            "job_id": job["job_id"],
+            "status": job["status"],
+            "status_url": f"/api/jobs/{job['job_id']}",
+            "result_url": f"/api/jobs/{job['job_id']}/result"
+        })
+
+    try:
+        return await run_nl_query(query)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Query processing error: {str(e)}")
+
+@app.get("/api/jobs")
+async def get_jobs():
+    """Get queue depth per priority lane and job counts by status"""
+    status_counts: Dict[str, int] = {}
+    for job in jobs.values():
+        status_counts[job["status"]] = status_counts.get(job["status"], 0) + 1
+    return {
+        "lanes": {
+            lane: {"queued": queue.qsize(), "workers": JOB_LANE_WORKERS[lane]}
+            for lane, queue in job_queues.items()
+        },
+        "jobs": status_counts
+    }
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Get async query job status"""
+    job = jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_summary(job)
+
+@app.get("/api/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    """Get async query job result (202 while still queued or running)"""
+    job = jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["status"] in ("queued", "running"):
+        return JSONResponse(status_code=202, content=job_summary(job))
+    if job["status"] != "completed":
+        raise HTTPException(status_code=409, detail=f"Job {job['status']}: {job.get('error', '')}".strip(": "))
+    return job["result"]
+
+@app.delete("/api/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """Cancel a queued or running async query job"""
+    job = jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["status"] == "queued":
+        job["status"] = "cancelled"
+        job["finished_at"] = datetime.now().isoformat()
+        job["finished_ts"] = time.time()
+    elif job["status"] == "running":
+        running_job_tasks[job_id].cancel()
+    else:
+        raise HTTPException(status_code=409, detail=f"Job already {job['status']}")
+    return {"message": "Job cancelled", "job_id": job_id}
+
+@app.get("/api/query/export")
+async def export_query_results(
+    query: str,
+    format: str = "csv",
+    gzip: bool = False,
+    tenant: str = Depends(resolve_tenant)
+):
+    """Re-execute an NL query and stream its full results as CSV or Parquet (a GET, so
+    browsers download it directly)"""
+    check_tenant_rate_limit(tenant)
+    translation = await translate_query(query)
+    collection_name = translation.get("collection")
+    if not collection_name:
+        # Same fallback order as execute_pipeline, probed with a single document
+        probes = await run_in_thread(execute_pipeline, translation["pipeline"] + [{"$limit": 1}])
+        collection_name = probes[1]
+    return start_export(collection_name, translation["pipeline"], format, gzip, "query-results")
+
+@app.get("/api/export/{collection_name}")
+async def export_collection(
+    collection_name: str,
+    format: str = "csv",
+    gzip: bool = False,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    plant_id: Optional[str] = None,
+    fields: Optional[str] = None,
+    tenant: str = Depends(resolve_tenant)
+):
+    """Stream a raw slice of a fact collection (or its daily rollup) for offline analysis"""
+    exportable = set(QUERY_COLLECTIONS) | {rollup_collection_name(name) for name in ROLLUP_SPECS}
+    if collection_name not in exportable:
+        raise HTTPException(status_code=404, detail="Collection not exportable")
+    check_tenant_rate_limit(tenant)
+
+    match: Dict[str, Any] = {}
+    if date_from or date_to:
+        match["date"] = {**({"$gte": date_from} if date_from else {}), **({"$lte": date_to} if date_to else {})}
+    if plant_id:
+        match["plant_id"] = plant_id
+    pipeline: List[Dict] = [{"$match": match}]
+    if fields:
+        pipeline.append({"$project": {"_id": 0, **{field.strip(): 1 for field in fields.split(",") if field.strip()}}})
+
+    return start_export(collection_name, pipeline, format, gzip, collection_name)
+
+@app.post("/api/query/batch")
+async def process_batch_query(batch: BatchNLQuery, tenant: str = Depends(resolve_tenant)):
+    """Process many NL queries (e.g. dashboard panels) in one request"""
+    if len(batch.queries) > MAX_BATCH_QUERIES:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_QUERIES} queries per batch")
+    check_tenant_rate_limit(tenant, len({normalize_query(query_text) for query_text in batch.queries}) or 1)
+
+    try:
+        # Deduplicate panels asking the same question
+        unique_queries: Dict[str, str] = {}
+        for query_text in batch.queries:
+            unique_queries.setdefault(normalize_query(query_text), query_text)
+
+        # Translate uncached queries concurrently under the shared LLM limit
+        keys = list(unique_queries.keys())
+        translations = await asyncio.gather(
+            *(translate_query(unique_queries[key]) for key in keys),
+            return_exceptions=True
+        )
+        translations_by_key = dict(zip(keys, translations))
+
+        record_nl_queries(list(unique_queries.values()))
+
+        translated = {
+            key: translation for key, translation in translations_by_key.items()
+            if not isinstance(translation, Exception)
+        }
+        cache_keys = {
+            key: result_cache_key(translation["pipeline"], translation.get("collection"))
+            for key, translation in translated.items()
+        }
+        executed = {}
+        for key, (cache_key, etag) in cache_keys.items():
+            cached_results = get_cached_results(cache_key, etag)
+            if cached_results:
+                executed[key] = {"results": cached_results[0], "collection": cached_results[1]}
+        uncached = {key: translation for key, translation in translated.items() if key not in executed}
+        if uncached:
+            async with db_scheduler.slot(cost=len(uncached)):
+                executed.update(await run_in_thread(
+                    execute_pipelines_batched,
+                    {key: translation["pipeline"] for key, translation in uncached.items()},
+                    {key: translation.get("collection") for key, translation in uncached.items()}
+                ))
+            for key, translation in uncached.items():
+                if "results" in executed[key] and not translation.get("degraded"):
+                    store_cached_results(*cache_keys[key], executed[key]["results"], executed[key]["collection"])
+
+        panels = []
+        for index, query_text in enumerate(batch.queries):
+            key = normalize_query(query_text)
+            translation = translations_by_key[key]
+            if isinstance(translation, Exception):
+                panels.append({"index": index, "query": query_text, "error": f"Translation error: {str(translation)}"})
+                continue
+            outcome = executed[key]
+            if "error" in outcome:
+                panels.append({
+                    "index": index,
+                    "query": query_text,
+                    "pipeline": translation["pipeline"],
+                    "error": f"Execution error: {outcome['error']}"
+                })
+                continue
+            results = outcome["results"]
+            panels.append({
+                "index": index,
+                "query": query_text,
+                "pipeline": translation["pipeline"],
+                "results": results,
+                "chart_type": recommend_chart_type(results),
+                "total_records": len(results),
+                "collection": outcome["collection"],
+                "source": translation["source"]
+            })
+
+        return {
+            "results": panels,
+            "total_queries": len(batch.queries),
+            "unique_queries": len(unique_queries)
+        }
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Batch query processing error: {str(e)}")
+
+# Saved Query Endpoints
+@app.post("/api/saved-queries", dependencies=[Depends(require_admin)])
+async def create_saved_query(saved_query: SavedQuery):
+    """Save an NL query with its compiled pipeline pinned, and materialize it"""
+    try:
+        translation = await translate_query(saved_query.query)
+        pipeline = translation["pipeline"]
+
+        saved_query_doc = saved_query.dict()
+        saved_query_doc.update({
+            "_id": str(uuid.uuid4()),
+            "pipeline": pipeline,
+            "created_date": datetime.now().isoformat()
+        })
+        if saved_query.refresh_interval_minutes:
+            saved_query_doc["next_materialization_at"] = datetime.now().isoformat()
+        async with db_scheduler.slot():
+            materialized = await run_in_thread(
+                create_materialized_saved_query, saved_query_doc, translation.get("collection")
+            )
+        return {
+            "message": "Saved query created",
+            "id": saved_query_doc["_id"],
+            "pipeline": pipeline,
+            "target_collection": saved_query_doc["target_collection"],
+            "materialized_at": materialized["materialized_at"]
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error creating saved query: {str(e)}")
+
+@app.get("/api/saved-queries")
+async def get_saved_queries():
+    """Get all saved queries"""
+    try:
+        saved_queries = list(db.saved_queries.find({}))
+        for saved_query in saved_queries:
+            saved_query["id"] = saved_query.pop("_id")
+        return {"saved_queries": saved_queries}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching saved queries: {str(e)}")
+
+@app.get("/api/saved-queries/{saved_query_id}/results")
+async def get_saved_query_results(saved_query_id: str):
+    """Serve the materialized results of a saved query with their freshness"""
+    try:
+        saved_query = db.saved_queries.find_one({"_id": saved_query_id})
+        if not saved_query:
+            raise HTTPException(status_code=404, detail="Saved query not found")
+        if not saved_query.get("materialized_at"):
+            saved_query.update(materialize_saved_query(saved_query))
+
+        rows = db[saved_query_results_collection(saved_query_id)].find({}).sort("_id", 1)
+        results = [row["row"] for row in rows]
+        materialized_at = datetime.fromisoformat(saved_query["materialized_at"])
+        return {
+            "query": saved_query["query"],
+            "pipeline": saved_query["pipeline"],
+            "results": results,
+            "chart_type": recommend_chart_type(results),
+            "total_records": len(results),
+            "materialized_at": saved_query["materialized_at"],
+            "age_seconds": round((datetime.now() - materialized_at).total_seconds(), 1)
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching saved query results: {str(e)}")
+
+@app.post("/api/saved-queries/{saved_query_id}/materialize", dependencies=[Depends(require_admin)])
+async def refresh_saved_query(saved_query_id: str):
+    """Re-materialize a saved query now"""
+    try:
+        saved_query = db.saved_queries.find_one({"_id": saved_query_id})
+        if not saved_query:
+            raise HTTPException(status_code=404, detail="Saved query not found")
+        materialized = await run_in_thread(materialize_saved_query, saved_query)
+        return {"message": "Saved query materialized", **materialized}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error materializing saved query: {str(e)}")
+
+@app.delete("/api/saved-queries/{saved_query_id}", dependencies=[Depends(require_admin)])
+async def delete_saved_query(saved_query_id: str):
+    """Delete a saved query and its materialized results"""
+    try:
+        result = db.saved_queries.delete_one({"_id": saved_query_id})
+        if result.deleted_count == 0:
+            raise HTTPException(status_code=404, detail="Saved query not found")
+        db[saved_query_results_collection(saved_query_id)].drop()
+        return {"message": "Saved query deleted"}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error deleting saved query: {str(e)}")
+
+@app.get("/api/semantic-mappings")
+async def get_semantic_mappings(response: Response, if_none_match: Optional[str] = Header(None)):
+    """Get all semantic mappings"""
+    not_modified = conditional_response(response, if_none_match, ["semantic_mappings"])
+    if not_modified:
+        return not_modified
+    mappings = list(db.semantic_mappings.find({}, {"_id": 0}))
+    return {"mappings": mappings}
+
+@app.post("/api/semantic-mappings")
+async def create_semantic_mapping(mapping: SemanticMapping):
+    """Create new semantic mapping"""
+    mapping_doc = mapping.dict()
+    mapping_doc["_id"] = str(uuid.uuid4())
+    db.semantic_mappings.insert_one(mapping_doc)
+    bump_collection_version("semantic_mappings")
+    invalidate_rule_vocabulary()
+    index_semantic_mapping(mapping_doc)
+    return {"message": "Semantic mapping created", "id": mapping_doc["_id"]}
+
+@app.get("/api/semantic-mappings/search")
+async def search_semantic_mappings(q: str, k: int = RETRIEVAL_TOP_K):
+    """Find the business terms and columns most relevant to a question"""
+    matches = schema_index.search(q, k)
+    return {"matches": [{"key": key, "score": round(score, 3), "context": payload} for score, key, payload in matches]}
+
+@app.get("/api/metrics/{business_term}")
+async def evaluate_metric(business_term: str, group_by: Optional[str] = None, engine: str = "mongo"):
+    """Evaluate a semantic mapping's formula, overall or per group_by value, in Mongo or NumPy"""
+    mapping = db.semantic_mappings.find_one(
+        {"business_term": {"$regex": f"^{re.escape(business_term)}$", "$options": "i"}}, {"_id": 0}
+    )
+    if not mapping:
+        raise HTTPException(status_code=404, detail="Semantic mapping not found")
+    if group_by and not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", group_by):
+        raise HTTPException(status_code=400, detail="group_by must be a field name")
+    if engine not in ("mongo", "numpy"):
+        raise HTTPException(status_code=400, detail="engine must be mongo or numpy")
+    try:
+        compiled = compile_formula(mapping["database_field"])
+    except FormulaError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        if engine == "mongo":
+            accumulators, expression = compiled.group_accumulators()
+            results = await run_in_thread(aggregate_collection, mapping["table_name"], [
+                {"$group": {"_id": f"${group_by}" if group_by else None, **accumulators}},
+                {"$project": {"value": expression}},
+                {"$sort": {"_id": 1}}
+            ])
+        else:
+            columns, groups = await run_in_thread(formula_columns, mapping["table_name"], compiled, group_by)
+            keys, values = compiled.evaluate(columns, groups)
+            results = [
+                {"_id": key.item() if group_by else None, "value": None if np.isnan(value) else float(value)}
+                for key, value in zip(keys, values)
+            ]
+        return {
+            "business_term": mapping["business_term"],
+            "formula": compiled.formula,
+            "table_name": mapping["table_name"],
+            "engine": engine,
+            "results": results
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Metric evaluation error: {str(e)}")
+
+KPI_GROUP_FIELDS = {"production_line", "plant_id", "shift", "date"}
+
+@app.post("/api/ingest/{collection_name}", dependencies=[Depends(require_admin)])
+async def ingest_records(collection_name: str, records: List[Dict[str, Any]]):
+    """Insert production, quality or downtime records and fold them into the KPI partials"""
+    if collection_name not in KPI_SOURCES:
+        raise HTTPException(status_code=404, detail=f"Records can only be ingested into {', '.join(KPI_SOURCES)}")
+    if not records or len(records) > INGEST_MAX_RECORDS:
+        raise HTTPException(status_code=400, detail=f"Send between 1 and {INGEST_MAX_RECORDS} records")
+    invalid = [
+        index for index, record in enumerate(records)
+        if not record.get("production_line") or not re.fullmatch(r"\d{4}-\d{2}-\d{2}", str(record.get("date", "")))
+    ]
+    if invalid:
+        raise HTTPException(status_code=400, detail=f"Records {invalid[:10]} need a production_line and a YYYY-MM-DD date")
+    try:
+        async with db_scheduler.slot(cost=max(len(records) / INGEST_RECORDS_PER_SLOT, 1)):
+            return await run_in_thread(ingest_fact_records, collection_name, records)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ingest error: {str(e)}")
+
+@app.get("/api/kpi")
+async def get_kpis(window_days: int = 7, date_from: Optional[str] = None, date_to: Optional[str] = None,
+                   group_by: Optional[str] = None, plant_id: Optional[str] = None,
+                   production_line: Optional[str] = None, shift: Optional[str] = None):
+    """OEE, availability, performance and quality over the last window_days days (from memory)
+    or a date range (from kpi_partials), overall or per group_by"""
+    if group_by and group_by not in KPI_GROUP_FIELDS:
+        raise HTTPException(status_code=400, detail=f"group_by must be one of {', '.join(sorted(KPI_GROUP_FIELDS))}")
+    filters = {
+        field: value for field, value in
+        (("plant_id", plant_id), ("production_line", production_line), ("shift", shift)) if value
+    }
+    by_shift = group_by == "shift" or "shift" in filters
+    try:
+        if date_from or date_to:
+            buckets = await run_in_thread(kpi_range_buckets, date_from, date_to, filters, by_shift)
+            scope = {"date_from": date_from, "date_to": date_to, "source": "kpi_partials"}
+        else:
+            if not 1 <= window_days <= KPI_WINDOW_DAYS:
+                raise HTTPException(status_code=400, detail=f"window_days must be between 1 and {KPI_WINDOW_DAYS}")
+            buckets = kpi_window_buckets(window_days, filters, by_shift)
+            scope = {"window_days": window_days, "source": "memory"}
+        return {**scope, "group_by": group_by, "kpis": summarize_kpis(buckets, group_by)}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"KPI error: {str(e)}")
+
+@app.post("/api/admin/kpi/rebuild", dependencies=[Depends(require_admin)])
+async def rebuild_kpis():
+    """Recompute the KPI partials from the fact collections and their rollups"""
+    try:
+        async with db_scheduler.slot():
+            partials = await run_in_thread(rebuild_kpi_partials)
+        return {"message": "KPI partials rebuilt", "partials": partials}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"KPI rebuild error: {str(e)}")
+
+@app.get("/api/anomalies")
+async def get_anomalies(response: Response, collection: Optional[str] = None, plant_id: Optional[str] = None,
+                        series: Optional[str] = None, metric: Optional[str] = None, since: Optional[str] = None,
+                        limit: int = 50, if_none_match: Optional[str] = Header(None)):
+    """Most recently detected anomalies, optionally for one collection, plant, line/machine or metric"""
+    not_modified = conditional_response(response, if_none_match, ["anomalies"])
+    if not_modified:
+        return not_modified
+    filters: Dict[str, Any] = {
+        field: value for field, value in
+        (("collection", collection), ("plant_id", plant_id), ("series", series), ("metric", metric)) if value
+    }
+    if since:
+        filters["detected_at"] = {"$gte": since}
+    try:
+        async with db_scheduler.slot():
+            anomalies = await run_in_thread(
+                lambda: list(db.anomalies.find(filters).sort("detected_at", -1).limit(max(1, min(limit, 500))))
+            )
+        return {"anomalies": anomalies, "detectors": len(anomaly_detectors), "z_threshold": ANOMALY_Z_THRESHOLD}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching anomalies: {str(e)}")
+
+@app.get("/api/anomalies/stream")
+async def stream_anomalies(request: Request):
+    """Server-sent events: one "anomaly" event per anomaly detected while connected"""
+    queue: asyncio.Queue = asyncio.Queue(maxsize=ANOMALY_STREAM_QUEUE_SIZE)
+    subscriber = (asyncio.get_running_loop(), queue)
+    anomaly_subscribers.add(subscriber)
+
+    async def events():
+        try:
+            yield "retry: 5000\n\n"
+            while not await request.is_disconnected():
+                try:
+                    anomaly = await asyncio.wait_for(queue.get(), ANOMALY_STREAM_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"id: {anomaly['_id']}\nevent: anomaly\ndata: {json.dumps(anomaly, default=str)}\n\n"
+        finally:
+            anomaly_subscribers.discard(subscriber)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/api/admin/anomalies/rebuild", dependencies=[Depends(require_admin)])
+async def rebuild_anomalies():
+    """Retrain the anomaly detectors from the fact collections"""
+    try:
+        async with db_scheduler.slot():
+            detectors = await run_in_thread(rebuild_anomaly_detectors)
+        return {"message": "Anomaly detectors rebuilt", "detectors": detectors}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Anomaly rebuild error: {str(e)}")
+
+DASHBOARD_COLLECTIONS = ["production_data", "quality_metrics", "equipment_downtime"]
+
+def build_dashboard_overview() -> Dict[str, Any]:
+    """Aggregate the dashboard overview sections"""
+    # Production summary
+    production_summary = aggregate_collection("production_data", [
+        {"$group": {
+            "_id": None,
+            "total_planned": {"$sum": "$planned_production"},
+            "total_actual": {"$sum": "$actual_production"},
+            "total_defects": {"$sum": "$defect_count"},
+            "total_downtime": {"$sum": "$downtime_minutes"}
+        }}
+    ])
+    
+    # Production by line
+    production_by_line = aggregate_collection("production_data", [
+        {"$group": {
+            "_id": "$production_line",
+            "production": {"$sum": "$actual_production"},
+            "defects": {"$sum": "$defect_count"}
+        }},
+        {"$sort": {"production": -1}}
+    ])
+    
+    # Defect trends (last 7 days)
+    defect_trends = aggregate_collection("quality_metrics", [
+        {"$group": {
+            "_id": "$date",
+            "total_defects": {"$sum": "$defect_count"}
+        }},
+        {"$sort": {"_id": -1}},
+        {"$limit": 7}
+    ])
+    
+    # Equipment downtime
+    equipment_downtime = aggregate_collection("equipment_downtime", [
+        {"$group": {
+            "_id": "$equipment_type",
+            "total_downtime": {"$sum": "$downtime_minutes"}
+        }},
+        {"$sort": {"total_downtime": -1}}
+    ])
+    
+    return {
+        "production_summary": production_summary[0] if production_summary else {},
+        "production_by_line": production_by_line,
+        "defect_trends": defect_trends,
+        "equipment_downtime": equipment_downtime
+    }
+
+def cached_dashboard_overview() -> Dict[str, Any]:
+    """Dashboard overview, rebuilt only after its collections change or the cache TTL passes"""
+    etag = versions_etag(DASHBOARD_COLLECTIONS)
+    cached = dashboard_cache.get("overview")
+    if cached and cached["etag"] == etag and time.time() - cached["cached_at"] < RESULT_CACHE_TTL_SECONDS:
+        return cached["payload"]
+    payload = build_dashboard_overview()
+    dashboard_cache["overview"] = {"payload": payload, "etag": etag, "cached_at": time.time()}
+    return payload
+
+@app.get("/api/dashboard/overview")
+async def dashboard_overview(response: Response, if_none_match: Optional[str] = Header(None)):
+    """Get dashboard overview data"""
+    not_modified = conditional_response(response, if_none_match, DASHBOARD_COLLECTIONS)
+    if not_modified:
+        return not_modified
+    try:
+        return cached_dashboard_overview()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Dashboard error: {str(e)}")
+
+# Admin Endpoints
+@app.get("/api/admin/slow-queries", dependencies=[Depends(require_admin)])
+async def get_slow_queries(limit: int = 20, slow_only: bool = False):
+    """Aggregate logged executions by question pattern, worst total wall time first"""
+    try:
+        match = {"slow": True} if slow_only else {}
+        offenders = list(db.slow_queries.aggregate([
+            {"$match": match},
+            {"$sort": {"timestamp": -1}},
+            {"$group": {
+                "_id": {"query": "$normalized_query", "collection": "$collection"},
+                "executions": {"$sum": 1},
+                "slow_executions": {"$sum": {"$cond": ["$slow", 1, 0]}},
+                "total_wall_time_ms": {"$sum": "$wall_time_ms"},
+                "avg_wall_time_ms": {"$avg": "$wall_time_ms"},
+                "max_wall_time_ms": {"$max": "$wall_time_ms"},
+                "avg_docs_examined": {"$avg": "$docs_examined"},
+                "avg_docs_returned": {"$avg": "$docs_returned"},
+                "collection_scans": {"$sum": {"$cond": ["$collection_scan", 1, 0]}},
+                "indexes_used": {"$addToSet": "$indexes_used"},
+                "last_seen": {"$first": "$timestamp"},
+                "pipeline": {"$first": "$pipeline"}
+            }},
+            {"$sort": {"total_wall_time_ms": -1}},
+            {"$limit": limit}
+        ]))
+        for offender in offenders:
+            offender.update(offender.pop("_id"))
+            offender["pipeline"] = json.loads(offender["pipeline"])
+            offender["indexes_used"] = sorted({name for names in offender["indexes_used"] if names for name in names})
+            returned = offender["avg_docs_returned"] or 0
+            offender["examined_per_returned"] = round((offender["avg_docs_examined"] or 0) / max(returned, 1), 1)
+        return {"offenders": offenders}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching slow queries: {str(e)}")
+
+@app.post("/api/admin/pipeline/run", dependencies=[Depends(require_admin)])
+async def run_admin_pipeline(run: PipelineRun):
+    """Run an explicit read-only pipeline, with or without join planning, to compare plans"""
+    pipeline, _ = pipeline_from_document(run.pipeline)
+    if pipeline is None:
+        raise HTTPException(status_code=400, detail=f"Pipeline stages must be among {', '.join(LLM_PIPELINE_STAGES)}")
+    if not is_known_collection(run.collection):
+        raise HTTPException(status_code=404, detail=f"Unknown collection: {run.collection}")
+    try:
+        async with db_scheduler.slot():
+            started = time.perf_counter()
+            results = await run_in_thread(aggregate_collection, run.collection, pipeline, run.plan)
+        return {
+            "results": results,
+            "total_records": len(results),
+            "planned": run.plan,
+            "wall_time_ms": round((time.perf_counter() - started) * 1000, 2)
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Pipeline error: {str(e)}")
+
+@app.get("/api/admin/warmup", dependencies=[Depends(require_admin)])
+async def get_warmup_status(limit: int = WARMUP_TOP_QUERIES):
+    """Get the last cache warm-up run, cache sizes and the queries it would warm next"""
+    try:
+        return {
+            "last_run": warmup_status,
+            "translation_cache_entries": len(query_cache),
+            "result_cache_entries": len(result_cache),
+            "top_queries": await asyncio.to_thread(top_logged_queries, limit)
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching warm-up status: {str(e)}")
+
+@app.post("/api/admin/warmup/run", status_code=202, dependencies=[Depends(require_admin)])
+async def run_warmup_now():
+    """Start a cache warm-up run in the background"""
+    if warmup_status["running"]:
+        raise HTTPException(status_code=409, detail="A cache warm-up is already running")
+    asyncio.create_task(run_cache_warmup())
+    return {"message": "Cache warm-up started", "status_url": "/api/admin/warmup"}
+
+# Profiling Endpoints
+@app.get("/api/admin/profiles", dependencies=[Depends(require_admin)])
+async def list_profiles(limit: int = 20):
+    """List stored request profiles, newest first"""
+    try:
+        profiles = list(db.profiles.find(
+            {}, {"cpu.report": 0, "cpu.top": 0, "memory.top": 0}
+        ).sort("created_at", -1).limit(limit))
+        return {"profiles": profiles}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching profiles: {str(e)}")
+
+@app.get("/api/admin/profiles/{profile_id}", dependencies=[Depends(require_admin)])
+async def get_profile(profile_id: str):
+    """Get a stored request profile with its top functions, pstats report and allocation sites"""
+    try:
+        profile = db.profiles.find_one({"_id": profile_id})
+        if not profile:
+            raise HTTPException(status_code=404, detail="Profile not found")
+        return profile
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching profile: {str(e)}")
+
+@app.post("/api/admin/profiler/sample", status_code=202, dependencies=[Depends(require_admin)])
+async def start_sampling_profiler(seconds: float = 10, interval_ms: float = 10):
+    """Sample the stacks of every thread in the process for N seconds"""
+    if not 0 < seconds <= PROFILE_SAMPLE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be between 0 and {PROFILE_SAMPLE_MAX_SECONDS}")
+    if not 1 <= interval_ms <= 1000:
+        raise HTTPException(status_code=400, detail="interval_ms must be between 1 and 1000")
+    if any(sampling["status"] == "running" for sampling in sampling_profiles.values()):
+        raise HTTPException(status_code=409, detail="The sampling profiler is already running")
+
+    sample_id = str(uuid.uuid4())
+    sampling_profiles[sample_id] = {
+        "status": "running",
+        "started_at": datetime.now().isoformat(),
+        "seconds": seconds,
+        "interval_ms": interval_ms,
+        "samples": 0
+    }
+    while len(sampling_profiles) > PROFILE_SAMPLES_KEPT:
+        sampling_profiles.popitem(last=False)
+    threading.Thread(
+        target=run_sampling_profiler, args=(sample_id, seconds, interval_ms / 1000),
+        name="sampling-profiler", daemon=True
+    ).start()
+    return sampling_summary(sample_id, sampling_profiles[sample_id])
+
+@app.get("/api/admin/profiler/samples", dependencies=[Depends(require_admin)])
+async def list_sampling_profiles():
+    """List recent sampling profiler runs"""
+    return {"samples": [sampling_summary(sample_id, sampling) for sample_id, sampling in reversed(sampling_profiles.items())]}
+
+@app.get("/api/admin/profiler/samples/{sample_id}", dependencies=[Depends(require_admin)])
+async def get_sampling_profile(sample_id: str):
+    """Get a sampling profiler run as folded stacks (flamegraph.pl / speedscope input)"""
+    sampling = sampling_profiles.get(sample_id)
+    if not sampling:
+        raise HTTPException(status_code=404, detail="Sampling profile not found")
+    if sampling["status"] != "completed":
+        return JSONResponse(status_code=202, content=sampling_summary(sample_id, sampling))
+    return Response(content=sampling["folded"] + "\n", media_type="text/plain")
+
+# Schema Discovery Endpoints
+@app.post("/api/schema-discovery/refresh", dependencies=[Depends(require_admin)])
+async def refresh_schema_discovery(force: bool = False, sync_schemas: bool = False):
+    """Re-sample collection statistics (only drifted/stale collections unless force)"""
+    try:
+        return await run_in_thread(refresh_collection_stats, force, sync_schemas)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Schema discovery error: {str(e)}")
+
+@app.get("/api/collection-stats")
+async def get_all_collection_stats():
+    """Get sampled statistics for all collections and candidate relationships"""
+    try:
+        stats = [
+            {key: value for key, value in collection_stats.items() if key != "sample_values"}
+            for collection_stats in db.collection_stats.find({"_id": {"$ne": "_candidate_relationships"}})
+        ]
+        candidates = db.collection_stats.find_one({"_id": "_candidate_relationships"}) or {}
+        return {"collections": stats, "candidate_relationships": candidates.get("candidates", [])}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching collection stats: {str(e)}")
+
+@app.get("/api/admin/retention", dependencies=[Depends(require_admin)])
+async def get_retention_status():
+    """Get archive watermarks, archive file sizes and unfinished archive batches"""
+    try:
+        collections = []
+        for collection_name in ROLLUP_SPECS:
+            directory = archive_directory(collection_name)
+            files = [name for name in os.listdir(directory) if name.endswith(".parquet")] if os.path.isdir(directory) else []
+            collections.append({
+                "collection": collection_name,
+                "archived_before": archive_watermarks.get(collection_name),
+                "archive_files": len(files),
+                "archive_bytes": sum(os.path.getsize(os.path.join(directory, name)) for name in files),
+                "rollup_collection": rollup_collection_name(collection_name)
+            })
+        return {
+            "retention_days": RETENTION_DAYS,
+            "archive_dir": ARCHIVE_DIR,
+            "collections": collections,
+            "unfinished_batches": db.archive_batches.count_documents({"status": {"$ne": "done"}})
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching retention status: {str(e)}")
+
+@app.post("/api/admin/retention/run", dependencies=[Depends(require_admin)])
+async def run_retention_now():
+    """Archive raw records outside the retention window now"""
+    try:
+        return {"collections": await run_in_thread(run_retention)}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Retention error: {str(e)}")
+
+# ERD Management Endpoints
+@app.get("/api/table-schemas")
+async def get_table_schemas(response: Response, if_none_match: Optional[str] = Header(None)):
+    """Get all table schemas for ERD"""
+    not_modified = conditional_response(response, if_none_match, ["table_schemas"])
+    if not_modified:
+        return not_modified
+    try:
+        schemas = list(db.table_schemas.find({}, {"_id": 0}))
+        # Show layout moves that are still waiting to be flushed
+        for schema in schemas:
+            if schema["table_name"] in pending_layout_updates:
+                schema["position"] = pending_layout_updates[schema["table_name"]]
+        return {"schemas": schemas}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching table schemas: {str(e)}")
+
+@app.post("/api/table-schemas")
+async def create_table_schema(schema: TableSchema):
+    """Create new table schema"""
+    try:
+        schema_doc = schema.dict()
+        schema_doc["_id"] = str(uuid.uuid4())
+        schema_doc["version"] = 1
+        db.table_schemas.insert_one(schema_doc)
+        bump_collection_version("table_schemas")
+        invalidate_rule_vocabulary()
+        index_table_schema(schema_doc)
+        return {"message": "Table schema created", "id": schema_doc["_id"]}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error creating table schema: {str(e)}")
+
+def flush_layout_updates() -> int:
+    """Write all pending table positions with a single bulk_write"""
+    if not pending_layout_updates:
+        return 0
+    updates = dict(pending_layout_updates)
+    pending_layout_updates.clear()
+    db.table_schemas.bulk_write([
+        UpdateOne({"table_name": table_name}, {"$set": {"position": position}, "$inc": {"version": 1}})
+        for table_name, position in updates.items()
+    ], ordered=False)
+    bump_collection_version("table_schemas")
+    return len(updates)
+
+async def delayed_layout_flush():
+    global layout_flush_task
+    await asyncio.sleep(LAYOUT_FLUSH_DELAY_SECONDS)
+    layout_flush_task = None
+    try:
+        flush_layout_updates()
+    except Exception as e:
+        print(f"Layout flush error: {e}")
+
+@app.post("/api/table-schemas/layout")
+async def update_table_layout(layout: TableLayoutUpdate, flush: bool = False):
+    """Queue position updates for many tables; rapid successive moves are coalesced"""
+    global layout_flush_task
+    try:
+        for update in layout.positions:
+            pending_layout_updates[update.table_name] = update.position
+        # Table schema reads show queued positions, so they change now
+        bump_collection_version("table_schemas")
+        if flush:
+            written = flush_layout_updates()
+            return {"message": "Table layout saved", "written": written}
+        if layout_flush_task is None:
+            layout_flush_task = asyncio.create_task(delayed_layout_flush())
+        return {"message": "Table layout queued", "pending": len(pending_layout_updates)}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error updating table layout: {str(e)}")
+
+@app.put("/api/table-schemas/{table_name}")
+async def update_table_schema(table_name: str, schema: TableSchema):
+    """Update table schema position and details"""
+    try:
+        schema_doc = schema.dict()
+        result = db.table_schemas.update_one(
+            {"table_name": table_name},
+            {"$set": schema_doc, "$inc": {"version": 1}}
+        )
+        if result.matched_count > 0:
+            bump_collection_version("table_schemas")
+            invalidate_rule_vocabulary()
+            index_table_schema(schema_doc)
+            return {"message": "Table schema updated"}
+        else:
+            raise HTTPException(status_code=404, detail="Table schema not found")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error updating table schema: {str(e)}")
+
+@app.get("/api/table-relationships")
+async def get_table_relationships(response: Response, if_none_match: Optional[str] = Header(None)):
+    """Get all table relationships for ERD"""
+    not_modified = conditional_response(response, if_none_match, ["table_relationships"])
+    if not_modified:
+        return not_modified
+    try:
+        relationships = list(db.table_relationships.find({}, {"_id": 0}))
+        return {"relationships": relationships}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching table relationships: {str(e)}")
+
+@app.post("/api/table-relationships")
+async def create_table_relationship(relationship: TableRelationship):
+    """Create new table relationship"""
     try:
         relationship_doc = relationship.dict()
         relationship_doc["_id"] = str(uuid.uuid4())
+        relationship_doc["version"] = 1
         db.table_relationships.insert_one(relationship_doc)
+        bump_collection_version("table_relationships")
         return {"message": "Table relationship created", "id": relationship_doc["_id"]}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error creating table relationship: {str(e)}")
@@ -588,45 +5363,218 @@ async def delete_table_relationship(relationship_id: str):
     try:
         result = db.table_relationships.delete_one({"_id": relationship_id})
         if result.deleted_count > 0:
+            bump_collection_version("table_relationships", "erd_configurations")
+            db.erd_configurations.update_many(
+                {"relationship_refs.id": relationship_id},
+                {
+                    "$pull": {"relationship_refs": {"id": relationship_id}},
+                    "$inc": {"version": 1},
+                    "$set": {"updated_date": datetime.now().isoformat()}
+                }
+            )
             return {"message": "Table relationship deleted"}
         else:
             raise HTTPException(status_code=404, detail="Table relationship not found")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error deleting table relationship: {str(e)}")
 
+def erd_table_ref(schema: Dict[str, Any]) -> Dict[str, Any]:
+    return {"id": schema["_id"], "table_name": schema["table_name"], "version": schema.get("version", 1)}
+
+def erd_relationship_ref(relationship: Dict[str, Any]) -> Dict[str, Any]:
+    return {"id": relationship["_id"], "version": relationship.get("version", 1)}
+
+def erd_etag(configuration: Dict[str, Any]) -> str:
+    """Strong ETag from the ERD's version and the versions of everything it references"""
+    fingerprint = json.dumps([
+        configuration["_id"],
+        configuration.get("version", 1),
+        sorted((table["_id"], table.get("version", 1)) for table in configuration.get("tables", [])),
+        sorted((rel["_id"], rel.get("version", 1)) for rel in configuration.get("relationships", []))
+    ])
+    return f'"{hashlib.sha1(fingerprint.encode()).hexdigest()}"'
+
 @app.get("/api/erd-configurations")
-async def get_erd_configurations():
-    """Get all ERD configurations"""
+async def get_erd_configurations(response: Response, if_none_match: Optional[str] = Header(None)):
+    """Get lightweight summaries of all ERD configurations"""
+    not_modified = conditional_response(response, if_none_match, ["erd_configurations"])
+    if not_modified:
+        return not_modified
     try:
-        configurations = list(db.erd_configurations.find({}, {"_id": 0}))
+        configurations = list(db.erd_configurations.aggregate([
+            {"$project": {
+                "_id": 0,
+                "id": "$_id",
+                "name": 1,
+                "description": 1,
+                "version": 1,
+                "created_date": 1,
+                "updated_date": 1,
+                "table_names": "$table_refs.table_name",
+                "table_count": {"$size": {"$ifNull": ["$table_refs", []]}},
+                "relationship_count": {"$size": {"$ifNull": ["$relationship_refs", []]}}
+            }}
+        ]))
         return {"configurations": configurations}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching ERD configurations: {str(e)}")
 
 @app.post("/api/erd-configurations")
 async def create_erd_configuration(erd: ERDConfiguration):
-    """Create new ERD configuration"""
+    """Create new ERD configuration referencing (and creating if needed) its schemas and relationships"""
     try:
-        erd_doc = erd.dict()
-        erd_doc["_id"] = str(uuid.uuid4())
-        erd_doc["created_date"] = datetime.now().isoformat()
+        table_refs = []
+        for table in erd.tables:
+            schema_doc = db.table_schemas.find_one({"table_name": table.table_name}, {"table_name": 1, "version": 1})
+            if not schema_doc:
+                schema_doc = {**table.dict(), "_id": str(uuid.uuid4()), "version": 1}
+                db.table_schemas.insert_one(schema_doc)
+                bump_collection_version("table_schemas")
+                invalidate_rule_vocabulary()
+                index_table_schema(schema_doc)
+            table_refs.append(erd_table_ref(schema_doc))
+
+        relationship_refs = []
+        for relationship in erd.relationships:
+            relationship_doc = db.table_relationships.find_one({
+                "from_table": relationship.from_table,
+                "to_table": relationship.to_table,
+                "from_column": relationship.from_column,
+                "to_column": relationship.to_column
+            }, {"version": 1})
+            if not relationship_doc:
+                relationship_doc = {**relationship.dict(), "_id": str(uuid.uuid4()), "version": 1}
+                db.table_relationships.insert_one(relationship_doc)
+                bump_collection_version("table_relationships")
+            relationship_refs.append(erd_relationship_ref(relationship_doc))
+
+        erd_doc = {
+            "_id": str(uuid.uuid4()),
+            "name": erd.name,
+            "description": erd.description,
+            "table_refs": table_refs,
+            "relationship_refs": relationship_refs,
+            "version": 1,
+            "created_date": datetime.now().isoformat()
+        }
         db.erd_configurations.insert_one(erd_doc)
-        return {"message": "ERD configuration created", "id": erd_doc["_id"]}
+        bump_collection_version("erd_configurations")
+        return {"message": "ERD configuration created", "id": erd_doc["_id"], "version": 1}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error creating ERD configuration: {str(e)}")
 
 @app.get("/api/erd-configurations/{erd_name}")
-async def get_erd_configuration(erd_name: str):
-    """Get specific ERD configuration by name"""
+async def get_erd_configuration(erd_name: str, response: Response, if_none_match: Optional[str] = Header(None)):
+    """Get specific ERD configuration by name with its tables and relationships resolved"""
     try:
-        configuration = db.erd_configurations.find_one({"name": erd_name}, {"_id": 0})
-        if configuration:
-            return {"configuration": configuration}
-        else:
+        # Resolve all references in a single aggregation round trip
+        resolved = list(db.erd_configurations.aggregate([
+            {"$match": {"name": erd_name}},
+            {"$limit": 1},
+            {"$lookup": {
+                "from": "table_schemas",
+                "localField": "table_refs.id",
+                "foreignField": "_id",
+                "as": "tables"
+            }},
+            {"$lookup": {
+                "from": "table_relationships",
+                "localField": "relationship_refs.id",
+                "foreignField": "_id",
+                "as": "relationships"
+            }}
+        ]))
+        if not resolved:
             raise HTTPException(status_code=404, detail="ERD configuration not found")
+
+        configuration = resolved[0]
+        etag = erd_etag(configuration)
+        if if_none_match == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+
+        # Flag tables changed since they were added to the diagram
+        pinned_versions = {ref["id"]: ref["version"] for ref in configuration.get("table_refs", [])}
+        configuration["changed_tables"] = [
+            table["table_name"] for table in configuration["tables"]
+            if table.get("version", 1) > pinned_versions.get(table["_id"], 1)
+        ]
+        configuration["id"] = configuration.pop("_id")
+        response.headers["ETag"] = etag
+        return {"configuration": configuration}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching ERD configuration: {str(e)}")
 
+@app.patch("/api/erd-configurations/{erd_name}")
+async def update_erd_configuration(erd_name: str, update: ERDConfigurationUpdate):
+    """Apply a delta (tables/relationships added or removed) to an ERD configuration"""
+    try:
+        configuration = db.erd_configurations.find_one(
+            {"name": erd_name}, {"version": 1, "table_refs": 1, "relationship_refs": 1}
+        )
+        if not configuration:
+            raise HTTPException(status_code=404, detail="ERD configuration not found")
+        if update.expected_version is not None and update.expected_version != configuration.get("version", 1):
+            raise HTTPException(status_code=409, detail="ERD configuration was modified by someone else")
+
+        new_tables = [
+            erd_table_ref(schema) for schema in
+            db.table_schemas.find({"table_name": {"$in": update.add_tables}}, {"table_name": 1, "version": 1})
+        ]
+        new_relationships = [
+            erd_relationship_ref(relationship) for relationship in
+            db.table_relationships.find({"_id": {"$in": update.add_relationships}}, {"version": 1})
+        ]
+        missing_tables = set(update.add_tables) - {ref["table_name"] for ref in new_tables}
+        missing_relationships = set(update.add_relationships) - {ref["id"] for ref in new_relationships}
+        if missing_tables or missing_relationships:
+            raise HTTPException(status_code=404, detail=f"Unknown tables {sorted(missing_tables)} or relationships {sorted(missing_relationships)}")
+
+        # Skip references the diagram already has (unless they are being removed in this update)
+        kept_tables = {
+            ref["table_name"] for ref in configuration.get("table_refs", [])
+            if ref["table_name"] not in update.remove_tables
+        }
+        kept_relationships = {
+            ref["id"] for ref in configuration.get("relationship_refs", [])
+            if ref["id"] not in update.remove_relationships
+        }
+        new_tables = [ref for ref in new_tables if ref["table_name"] not in kept_tables]
+        new_relationships = [ref for ref in new_relationships if ref["id"] not in kept_relationships]
+
+        set_fields: Dict[str, Any] = {"updated_date": {"$literal": datetime.now().isoformat()}}
+        if update.description is not None:
+            set_fields["description"] = {"$literal": update.description}
+
+        # Removals and additions touch the same arrays, so both happen in one pipeline update
+        def apply_refs(field_name: str, key: str, removed: List[str], added: List[Dict[str, Any]]) -> Dict[str, Any]:
+            return {"$concatArrays": [
+                {"$filter": {
+                    "input": {"$ifNull": [f"${field_name}", []]},
+                    "as": "ref",
+                    "cond": {"$not": {"$in": [f"$$ref.{key}", removed]}}
+                }},
+                {"$literal": added}
+            ]}
+        result = db.erd_configurations.update_one(
+            {"_id": configuration["_id"], "version": configuration.get("version", 1)},
+            [{"$set": {
+                "table_refs": apply_refs("table_refs", "table_name", update.remove_tables, new_tables),
+                "relationship_refs": apply_refs("relationship_refs", "id", update.remove_relationships, new_relationships),
+                **set_fields,
+                "version": {"$add": [{"$ifNull": ["$version", 1]}, 1]}
+            }}]
+        )
+        if result.matched_count == 0:
+            raise HTTPException(status_code=409, detail="ERD configuration was modified by someone else")
+        bump_collection_version("erd_configurations")
+        return {"message": "ERD configuration updated", "version": configuration.get("version", 1) + 1}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error updating ERD configuration: {str(e)}")
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
@@ -1,7 +1,9 @@
 import requests
 import unittest
 import json
+import os
 import sys
+import time
 from datetime import datetime
 import uuid
 
@@ -10,11 +12,16 @@ class GenBIAPITester:
         self.base_url = base_url
         self.tests_run = 0
         self.tests_passed = 0
+        self.last_headers = {}
+        # Sent to admin endpoints; without ADMIN_TOKEN the server leaves them open (except profiling)
+        self.admin_headers = {"X-Admin-Token": os.environ["ADMIN_TOKEN"]} if os.environ.get("ADMIN_TOKEN") else {}
 
-    def run_test(self, name, method, endpoint, expected_status, data=None):
+    def run_test(self, name, method, endpoint, expected_status, data=None, extra_headers=None):
         """Run a single API test"""
         url = f"{self.base_url}/{endpoint}"
         headers = {'Content-Type': 'application/json'}
+        if extra_headers:
+            headers.update(extra_headers)
         
         self.tests_run += 1
         print(f"\n🔍 Testing {name}...")
@@ -26,6 +33,8 @@ class GenBIAPITester:
                 response = requests.post(url, json=data, headers=headers)
             elif method == 'PUT':
                 response = requests.put(url, json=data, headers=headers)
+            elif method == 'PATCH':
+                response = requests.patch(url, json=data, headers=headers)
             elif method == 'DELETE':
                 response = requests.delete(url, headers=headers)
 
@@ -33,6 +42,7 @@ class GenBIAPITester:
             if success:
                 self.tests_passed += 1
                 print(f"✅ Passed - Status: {response.status_code}")
+                self.last_headers = response.headers
                 try:
                     return success, response.json()
                 except:
@@ -62,6 +72,29 @@ class GenBIAPITester:
             print(f"Timestamp: {response.get('timestamp')}")
         return success
 
+    def test_llm_status(self):
+        """Test the LLM backend status endpoint"""
+        success, response = self.run_test(
+            "LLM Status",
+            "GET",
+            "api/llm/status",
+            200
+        )
+        if success:
+            print(f"Models: {response.get('models')}")
+            for backend in response.get('backends', []):
+                breaker = backend.get('circuit_breaker', {})
+                print(f"- {backend.get('url')}: {backend.get('outstanding_requests')} outstanding, "
+                      f"breaker {breaker.get('state')}, p95 {breaker.get('p95_latency_seconds')}s")
+            parsing = response.get('parsing', {})
+            print(f"Pipeline parsing: {parsing.get('responses')} responses, {parsing.get('repaired')} repaired, "
+                  f"{parsing.get('failed')} failed (failure rate {parsing.get('failure_rate')}), "
+                  f"max_tokens {parsing.get('max_tokens')}")
+            if 'parsing' not in response:
+                print("❌ Missing pipeline parsing metrics")
+                return False
+        return success
+
     def test_dashboard_overview(self):
         """Test the dashboard overview endpoint"""
         success, response = self.run_test(
@@ -118,6 +151,77 @@ class GenBIAPITester:
             print(f"Created mapping with ID: {response.get('id')}")
         return success
 
+    def test_semantic_search(self, query_text):
+        """Test searching semantic mappings and columns relevant to a question"""
+        success, response = self.run_test(
+            f"Semantic Search: '{query_text}'",
+            "GET",
+            f"api/semantic-mappings/search?q={requests.utils.quote(query_text)}",
+            200
+        )
+        if success:
+            for match in response.get('matches', [])[:3]:
+                print(f"- {match.get('score')}: {match.get('context')}")
+        return success
+
+    def test_metric_evaluation(self, business_term, group_by):
+        """Test compiled semantic mapping formulas on both engines"""
+        results = {}
+        for engine in ("mongo", "numpy"):
+            success, response = self.run_test(
+                f"Metric '{business_term}' by {group_by} ({engine})",
+                "GET",
+                f"api/metrics/{business_term}?group_by={group_by}&engine={engine}",
+                200
+            )
+            if not success:
+                return False
+            results[engine] = {row['_id']: row['value'] for row in response.get('results', [])}
+            print(f"{engine}: {results[engine]}")
+        return all(
+            abs((results['mongo'][key] or 0) - (results['numpy'].get(key) or 0)) < 1e-9
+            for key in results['mongo']
+        )
+    
+    def test_scaled_metric(self, group_by, base_term, formula, factor, description):
+        """Test that a formula scaling base_term's formula by a constant aggregates to factor x
+        base_term per group (a percentage stays a ratio of sums, a unit conversion stays a sum)"""
+        business_term = f"{description.lower()} {datetime.now().strftime('%H%M%S')}"
+        success, _ = self.run_test(
+            f"Create Mapping '{formula}'",
+            "POST",
+            "api/semantic-mappings",
+            200,
+            data={
+                "business_term": business_term,
+                "database_field": formula,
+                "description": description,
+                "table_name": "production_data"
+            }
+        )
+        if not success:
+            return False
+        for engine in ("mongo", "numpy"):
+            values = {}
+            for term in (base_term, business_term):
+                success, response = self.run_test(
+                    f"Metric '{term}' by {group_by} ({engine})",
+                    "GET",
+                    f"api/metrics/{requests.utils.quote(term)}?group_by={group_by}&engine={engine}",
+                    200
+                )
+                if not success:
+                    return False
+                values[term] = {row['_id']: row['value'] for row in response.get('results', [])}
+            print(f"{engine}: {values[business_term]}")
+            if not all(
+                abs((values[business_term].get(key) or 0) - factor * (base or 0)) < 1e-9 * max(1, abs(factor * (base or 0)))
+                for key, base in values[base_term].items()
+            ):
+                print(f"❌ '{formula}' is not {factor} x {base_term} on {engine}")
+                return False
+        return True
+    
     def test_natural_language_query(self, query_text):
         """Test the natural language query endpoint"""
         success, response = self.run_test(
@@ -131,6 +235,7 @@ class GenBIAPITester:
             print(f"Query: {response.get('query')}")
             print(f"Results: {response.get('total_records')} records")
             print(f"Chart Type: {response.get('chart_type')}")
+            print(f"Translated by: {response.get('source')}")
             
             # Print first few results
             results = response.get('results', [])
@@ -141,6 +246,437 @@ class GenBIAPITester:
                 print(f"Pipeline: {json.dumps(response['pipeline'][:2])}...")
         return success
     
+    def test_batch_query(self, queries):
+        """Test the batch natural language query endpoint"""
+        success, response = self.run_test(
+            f"Batch Query ({len(queries)} panels)",
+            "POST",
+            "api/query/batch",
+            200,
+            data={"queries": queries}
+        )
+        if success:
+            panels = response.get('results', [])
+            print(f"Panels: {len(panels)}, unique queries: {response.get('unique_queries')}")
+            for panel in panels:
+                if 'error' in panel:
+                    print(f"- Panel {panel.get('index')}: error {panel['error']}")
+                else:
+                    print(f"- Panel {panel.get('index')}: {panel.get('total_records')} records from {panel.get('collection')}")
+            success = len(panels) == len(queries)
+        return success
+    
+    def test_async_query_job(self, query_text):
+        """Test async query jobs: enqueue, poll for the result, then cancel a batch job"""
+        success, response = self.run_test(
+            "Async Query Job",
+            "POST",
+            "api/query?async=true",
+            202,
+            data={"query": query_text}
+        )
+        if not success:
+            return False
+        job_id = response.get('job_id')
+        print(f"Job: {job_id}")
+        
+        status = 'queued'
+        for _ in range(30):
+            response = requests.get(f"{self.base_url}/api/jobs/{job_id}").json()
+            status = response.get('status')
+            if status not in ('queued', 'running'):
+                break
+            time.sleep(1)
+        print(f"Final status: {status}")
+        
+        success, response = self.run_test(
+            "Async Query Job Result",
+            "GET",
+            f"api/jobs/{job_id}/result",
+            200
+        )
+        if success:
+            print(f"Results: {response.get('total_records')} records")
+        
+        _, response = self.run_test(
+            "Async Batch Job",
+            "POST",
+            "api/query?async=true&priority=batch",
+            202,
+            data={"query": query_text}
+        )
+        if response.get('job_id'):
+            # The job may already have finished, in which case cancel answers 409
+            cancel = requests.delete(f"{self.base_url}/api/jobs/{response['job_id']}")
+            print(f"Cancel: {cancel.status_code}")
+        return success
+    
+    def test_saved_query_lifecycle(self, query_text):
+        """Test creating, reading and deleting a saved query"""
+        success, response = self.run_test(
+            "Create Saved Query",
+            "POST",
+            "api/saved-queries",
+            200,
+            extra_headers=self.admin_headers,
+            data={
+                "name": f"test_saved_{datetime.now().strftime('%H%M%S')}",
+                "query": query_text,
+                "refresh_interval_minutes": 60
+            }
+        )
+        if not success:
+            return False
+        saved_query_id = response.get('id')
+        print(f"Created saved query {saved_query_id} on {response.get('target_collection')}")
+        
+        success, response = self.run_test(
+            "Get Saved Query Results",
+            "GET",
+            f"api/saved-queries/{saved_query_id}/results",
+            200
+        )
+        if success:
+            print(f"Materialized {response.get('total_records')} records at {response.get('materialized_at')}")
+        
+        deleted, _ = self.run_test(
+            "Delete Saved Query",
+            "DELETE",
+            f"api/saved-queries/{saved_query_id}",
+            200,
+            extra_headers=self.admin_headers
+        )
+        return success and deleted
+    
+    def test_query_explain(self, query_text):
+        """Test running a query with its execution plan summary"""
+        success, response = self.run_test(
+            f"Explained Query: '{query_text}'",
+            "POST",
+            "api/query",
+            200,
+            data={"query": query_text, "explain": True}
+        )
+        if success:
+            execution = response.get('execution', {})
+            print(f"{execution.get('collection')}: {execution.get('wall_time_ms')} ms, "
+                  f"{execution.get('docs_examined')} examined, indexes {execution.get('indexes_used')}")
+            success = 'execution' in response
+        return success
+    
+    def test_approximate_query(self, query_text):
+        """Test approximate mode (small collections fall back to exact execution)"""
+        success, response = self.run_test(
+            f"Approximate Query - '{query_text}'",
+            "POST",
+            "api/query",
+            200,
+            data={"query": query_text, "approximate": True}
+        )
+        if success:
+            approximation = response.get('approximation', {})
+            if approximation.get('approximate'):
+                print(f"Estimated from {approximation.get('sample_size')} of {approximation.get('population')} documents")
+                for interval in approximation.get('intervals', [])[:3]:
+                    print(f"- {interval}")
+            else:
+                print(f"Exact fallback: {approximation.get('fallback_reason')}")
+            success = 'approximation' in response
+        return success
+    
+    def test_export(self, query_text):
+        """Test streaming CSV export of a query and a gzipped raw collection slice"""
+        url = f"{self.base_url}/api/query/export"
+        self.tests_run += 1
+        print(f"\n🔍 Testing Query Export...")
+        response = requests.get(url, params={"query": query_text, "format": "csv"}, stream=True)
+        lines = response.text.splitlines() if response.status_code == 200 else []
+        if response.status_code == 200 and lines:
+            self.tests_passed += 1
+            print(f"✅ Passed - {len(lines) - 1} rows, columns: {lines[0]}")
+        else:
+            print(f"❌ Failed - Status: {response.status_code}")
+            return False
+        
+        self.tests_run += 1
+        print(f"\n🔍 Testing kpi_oee Query Export...")
+        response = requests.get(url, params={"query": "OEE by production line last 7 days", "format": "csv"}, stream=True)
+        lines = response.text.splitlines() if response.status_code == 200 else []
+        if response.status_code == 200 and len(lines) > 1:
+            self.tests_passed += 1
+            print(f"✅ Passed - {len(lines) - 1} rows, columns: {lines[0]}")
+        else:
+            print(f"❌ Failed - Status: {response.status_code}, {len(lines)} lines")
+            return False
+        
+        self.tests_run += 1
+        print(f"\n🔍 Testing Raw Collection Export...")
+        response = requests.get(f"{self.base_url}/api/export/production_data?format=csv&gzip=true&fields=date,defect_count")
+        if response.status_code == 200 and response.content[:2] == b'\x1f\x8b':
+            self.tests_passed += 1
+            print(f"✅ Passed - {len(response.content)} gzipped bytes")
+            return True
+        print(f"❌ Failed - Status: {response.status_code}")
+        return False
+    
+    def test_slow_queries(self):
+        """Test the slow query report"""
+        success, response = self.run_test(
+            "Slow Query Report",
+            "GET",
+            "api/admin/slow-queries",
+            200,
+            extra_headers=self.admin_headers
+        )
+        if success:
+            for offender in response.get('offenders', [])[:5]:
+                print(f"- '{offender.get('query')}' on {offender.get('collection')}: "
+                      f"{offender.get('executions')} runs, max {offender.get('max_wall_time_ms')} ms")
+        return success
+    
+    def test_scheduler_status(self):
+        """Test per-tenant scheduler metrics"""
+        success, response = self.run_test(
+            "Scheduler Status",
+            "GET",
+            "api/admin/scheduler",
+            200,
+            extra_headers=self.admin_headers
+        )
+        if success:
+            for scheduler in response.get('schedulers', []):
+                print(f"- {scheduler.get('name')}: {scheduler.get('active')}/{scheduler.get('capacity')} active, "
+                      f"{scheduler.get('queued')} queued, {len(scheduler.get('tenants', {}))} tenants")
+        return success
+    
+    def test_retention_status(self):
+        """Test the retention and archive status report"""
+        success, response = self.run_test(
+            "Retention Status",
+            "GET",
+            "api/admin/retention",
+            200,
+            extra_headers=self.admin_headers
+        )
+        if success:
+            print(f"Retention: {response.get('retention_days')} days, "
+                  f"{response.get('unfinished_batches')} unfinished batches")
+            for collection in response.get('collections', []):
+                print(f"- {collection.get('collection')}: archived before {collection.get('archived_before')}, "
+                      f"{collection.get('archive_files')} files")
+        return success
+    
+    def test_profiling(self, query_text):
+        """Test profiling a single query and a short sampling profiler run"""
+        self.tests_run += 1
+        print(f"\n🔍 Testing Request Profiling...")
+        response = requests.post(f"{self.base_url}/api/query", json={"query": query_text},
+                                 headers={"X-Profile": "cpu,memory", **self.admin_headers})
+        profile_id = response.headers.get('X-Profile-Id')
+        if not self.admin_headers:
+            # Without a configured token the server must refuse to profile
+            if response.status_code != 403:
+                print(f"❌ Failed - Expected 403 without ADMIN_TOKEN, got {response.status_code}")
+                return False
+            self.tests_passed += 1
+            print(f"✅ Passed - Profiling refused without ADMIN_TOKEN")
+        elif response.status_code == 200 and profile_id:
+            self.tests_passed += 1
+            print(f"✅ Passed - Profile {profile_id}")
+        else:
+            print(f"❌ Failed - Status: {response.status_code}")
+            return False
+        
+        if profile_id:
+            success, profile = self.run_test(
+                "Stored Profile",
+                "GET",
+                f"api/admin/profiles/{profile_id}",
+                200,
+                extra_headers=self.admin_headers
+            )
+            if success:
+                print(f"Wall time {profile.get('wall_time_ms')} ms, peak {profile.get('memory', {}).get('peak_bytes')} bytes")
+                for function in profile.get('cpu', {}).get('top', [])[:5]:
+                    print(f"- {function.get('function')}: {function.get('cumulative_seconds')} s")
+        
+        success, sampling = self.run_test(
+            "Sampling Profiler",
+            "POST",
+            "api/admin/profiler/sample?seconds=1",
+            202,
+            extra_headers=self.admin_headers
+        )
+        if not success:
+            return False
+        time.sleep(1.5)
+        self.tests_run += 1
+        print(f"\n🔍 Testing Folded Stack Output...")
+        response = requests.get(f"{self.base_url}{sampling.get('result_url')}", headers=self.admin_headers)
+        if response.status_code == 200 and response.text.strip():
+            self.tests_passed += 1
+            print(f"✅ Passed - {len(response.text.splitlines())} distinct stacks")
+            return True
+        print(f"❌ Failed - Status: {response.status_code}")
+        return False
+    
+    def test_cache_warmup(self):
+        """Test a cache warm-up run over the query log"""
+        success, _ = self.run_test(
+            "Start Cache Warm-up",
+            "POST",
+            "api/admin/warmup/run",
+            202,
+            extra_headers=self.admin_headers
+        )
+        if not success:
+            return False
+        for _ in range(30):
+            if not requests.get(f"{self.base_url}/api/admin/warmup", headers=self.admin_headers).json().get('last_run', {}).get('running'):
+                break
+            time.sleep(2)
+        
+        success, response = self.run_test(
+            "Cache Warm-up Status",
+            "GET",
+            "api/admin/warmup",
+            200,
+            extra_headers=self.admin_headers
+        )
+        if success:
+            print(f"Result cache: {response.get('result_cache_entries')} entries, "
+                  f"translation cache: {response.get('translation_cache_entries')} entries")
+            for warmed in response.get('last_run', {}).get('queries', [])[:5]:
+                print(f"- '{warmed.get('query')}' (score {warmed.get('score')}): {warmed.get('outcome')}")
+        return success
+    
+    def test_kpi_engine(self):
+        """Test ingesting a production record and reading windowed OEE per line"""
+        success, response = self.run_test(
+            "Ingest Production Record",
+            "POST",
+            "api/ingest/production_data",
+            200,
+            extra_headers=self.admin_headers,
+            data=[{
+                "date": datetime.now().strftime("%Y-%m-%d"),
+                "plant_id": "plant-1",
+                "production_line": "Line-A-Radial",
+                "shift": "Day",
+                "tyre_type": "205/55R16",
+                "planned_production": 1000,
+                "actual_production": 950,
+                "defect_count": 12,
+                "downtime_minutes": 30
+            }]
+        )
+        if success:
+            print(f"Inserted {response.get('inserted')}, updated {response.get('kpi_partials_updated')} KPI partials")
+        
+        success, response = self.run_test(
+            "OEE by Line (last 7 days)",
+            "GET",
+            "api/kpi?window_days=7&group_by=production_line",
+            200
+        )
+        if success:
+            for kpi in response.get('kpis', []):
+                print(f"- {kpi.get('_id')}: OEE {kpi.get('oee')} (A {kpi.get('availability')}, "
+                      f"P {kpi.get('performance')}, Q {kpi.get('quality')})")
+        return success
+    
+    def test_anomaly_detection(self):
+        """Test that a defect spike ingested for a line is flagged and listed"""
+        success, response = self.run_test(
+            "Ingest Defect Spike",
+            "POST",
+            "api/ingest/production_data",
+            200,
+            extra_headers=self.admin_headers,
+            data=[{
+                "date": datetime.now().strftime("%Y-%m-%d"),
+                "plant_id": "plant-1",
+                "production_line": "Line-B-Bias",
+                "shift": "Night",
+                "tyre_type": "185/65R15",
+                "planned_production": 1000,
+                "actual_production": 900,
+                "defect_count": 900,
+                "downtime_minutes": 30
+            }]
+        )
+        if success:
+            print(f"Anomalies flagged at ingest: {response.get('anomalies')}")
+
+        success, response = self.run_test(
+            "Recent Anomalies",
+            "GET",
+            "api/anomalies?plant_id=plant-1&series=Line-B-Bias&metric=defect_count",
+            200
+        )
+        if success:
+            anomalies = response.get('anomalies', [])
+            print(f"Detectors: {response.get('detectors')}, anomalies for Line-B-Bias: {len(anomalies)}")
+            for anomaly in anomalies[:3]:
+                print(f"- {anomaly.get('date')}: {anomaly.get('value')} (expected ~{anomaly.get('expected')}, "
+                      f"robust z {anomaly.get('robust_z')}, {anomaly.get('severity')})")
+            if not any(anomaly.get('value') == 900 for anomaly in anomalies):
+                print("❌ Defect spike was not flagged")
+                return False
+        return success
+
+    def test_hash_join_matches_lookup(self):
+        """Test that a hash-joined $lookup on a dimension table returns what Mongo's $lookup returns"""
+        pipeline = [
+            {"$match": {"production_line": "Line-A-Radial"}},
+            {"$lookup": {"from": "operators", "localField": "operator_id", "foreignField": "operator_id", "as": "operator"}},
+            {"$unwind": "$operator"},
+            {"$group": {"_id": "$operator.skill_level", "production": {"$sum": "$actual_production"}, "records": {"$sum": 1}}},
+            {"$sort": {"_id": 1}}
+        ]
+        results = {}
+        for plan in (True, False):
+            success, response = self.run_test(
+                f"Operator Join ({'hash join' if plan else 'Mongo $lookup'})",
+                "POST",
+                "api/admin/pipeline/run",
+                200,
+                extra_headers=self.admin_headers,
+                data={"collection": "production_data", "pipeline": pipeline, "plan": plan}
+            )
+            if not success:
+                return False
+            results[plan] = response.get('results', [])
+            print(f"{len(results[plan])} groups in {response.get('wall_time_ms')} ms")
+        if results[True] != results[False]:
+            print(f"❌ Hash join results differ: {results[True]} vs {results[False]}")
+            return False
+        return True
+
+    def test_schema_discovery(self):
+        """Test refreshing and reading sampled collection statistics"""
+        refreshed, response = self.run_test(
+            "Refresh Schema Discovery",
+            "POST",
+            "api/schema-discovery/refresh?force=true",
+            200,
+            extra_headers=self.admin_headers
+        )
+        if refreshed:
+            print(f"Refreshed: {response.get('refreshed')}, skipped: {response.get('skipped')}")
+        
+        success, response = self.run_test(
+            "Get Collection Stats",
+            "GET",
+            "api/collection-stats",
+            200
+        )
+        if success:
+            for stats in response.get('collections', []):
+                print(f"- {stats.get('_id')}: {stats.get('document_count')} docs, {len(stats.get('fields', {}))} fields")
+            print(f"Candidate relationships: {len(response.get('candidate_relationships', []))}")
+        return refreshed and success
+    
     # ERD Builder API Tests
     def test_table_schemas_get(self):
         """Test getting table schemas for ERD"""
@@ -187,7 +723,52 @@ class GenBIAPITester:
             configs = response.get('configurations', [])
             print(f"Retrieved {len(configs)} ERD configurations")
             for config in configs:
-                print(f"- {config.get('name')}: {len(config.get('tables', []))} tables, {len(config.get('relationships', []))} relationships")
+                print(f"- {config.get('name')} v{config.get('version')}: {config.get('table_count')} tables, {config.get('relationship_count')} relationships")
+        return success
+    
+    def test_erd_configuration_etag(self, erd_name):
+        """Test that an unchanged ERD configuration is not downloaded again"""
+        success, response = self.run_test(
+            f"Get ERD Configuration '{erd_name}'",
+            "GET",
+            f"api/erd-configurations/{erd_name}",
+            200
+        )
+        if not success:
+            return False
+        configuration = response.get('configuration', {})
+        print(f"Resolved {len(configuration.get('tables', []))} tables, {len(configuration.get('relationships', []))} relationships")
+        etag = self.last_headers.get('ETag')
+        
+        success, _ = self.run_test(
+            f"Get Unchanged ERD Configuration '{erd_name}'",
+            "GET",
+            f"api/erd-configurations/{erd_name}",
+            304,
+            extra_headers={'If-None-Match': etag}
+        )
+        return success
+    
+    def test_conditional_get(self, endpoint):
+        """Test that an unchanged read endpoint answers If-None-Match with 304"""
+        success, _ = self.run_test(
+            f"Get {endpoint}",
+            "GET",
+            endpoint,
+            200
+        )
+        if not success:
+            return False
+        etag = self.last_headers.get('ETag')
+        print(f"ETag {etag}, Cache-Control: {self.last_headers.get('Cache-Control')}")
+        
+        success, _ = self.run_test(
+            f"Get Unchanged {endpoint}",
+            "GET",
+            endpoint,
+            304,
+            extra_headers={'If-None-Match': etag}
+        )
         return success
     
     def test_table_schema_update(self, table_name):
@@ -230,6 +811,23 @@ class GenBIAPITester:
         
         return success
     
+    def test_table_layout_batch(self, table_names):
+        """Test saving many table positions in one request"""
+        positions = [
+            {"table_name": name, "position": {"x": 100 + 150 * i, "y": 300}}
+            for i, name in enumerate(table_names)
+        ]
+        success, response = self.run_test(
+            f"Batch Layout Update ({len(positions)} tables)",
+            "POST",
+            "api/table-schemas/layout?flush=true",
+            200,
+            data={"positions": positions}
+        )
+        if success:
+            print(f"Wrote {response.get('written')} table positions")
+        return success
+    
     def test_table_relationship_create(self):
         """Test creating a new table relationship"""
         # Create a test relationship
@@ -296,23 +894,59 @@ def main():
         print("❌ Health check failed, stopping tests")
         return 1
     
+    # Test LLM circuit breaker status
+    tester.test_llm_status()
+    
     # Test dashboard overview
     tester.test_dashboard_overview()
     
     # Test semantic mappings
     tester.test_semantic_mappings_get()
     tester.test_semantic_mappings_post()
+    tester.test_semantic_search("which line has the worst defect rate")
+    tester.test_metric_evaluation("production efficiency", "production_line")
+    tester.test_scaled_metric("production_line", "defect rate", "defect_count / actual_production * 100", 100,
+                              "Defect percentage")
+    tester.test_scaled_metric("production_line", "downtime", "downtime_minutes / 60", 1 / 60, "Downtime hours")
     
     # Test natural language queries
     test_queries = [
         "Show me production efficiency by production line",
         "What are the defect rates for each line?",
-        "Display equipment downtime by type"
+        "Display equipment downtime by type",
+        "Downtime by shift last 14 days",
+        "Total defects by plant",
+        "OEE by production line last 7 days"
     ]
     
     for query in test_queries:
         tester.test_natural_language_query(query)
     
+    # Test batch queries (includes a duplicate panel)
+    tester.test_batch_query(test_queries + [test_queries[0]])
+    
+    # Test query plan inspection
+    tester.test_query_explain(test_queries[0])
+    tester.test_approximate_query("Total actual production by line")
+    tester.test_export(test_queries[1])
+    tester.test_slow_queries()
+    tester.test_scheduler_status()
+    tester.test_retention_status()
+    tester.test_profiling(test_queries[0])
+    tester.test_cache_warmup()
+    tester.test_kpi_engine()
+    tester.test_hash_join_matches_lookup()
+    tester.test_anomaly_detection()
+    
+    # Test saved queries
+    tester.test_saved_query_lifecycle(test_queries[0])
+    
+    # Test async query jobs
+    tester.test_async_query_job(test_queries[1])
+    
+    # Test schema discovery
+    tester.test_schema_discovery()
+    
     # Test ERD Builder APIs
     print("\n===== ERD Builder API Testing =====\n")
     
@@ -324,10 +958,19 @@ def main():
     
     # Test ERD configurations endpoint
     tester.test_erd_configurations_get()
+    tester.test_erd_configuration_etag("Tyre Manufacturing ERD")
+    
+    # Test conditional GETs on the frequently re-fetched read endpoints
+    for endpoint in ["api/dashboard/overview", "api/semantic-mappings", "api/table-schemas",
+                     "api/table-relationships", "api/erd-configurations"]:
+        tester.test_conditional_get(endpoint)
     
     # Test updating a table schema position
     tester.test_table_schema_update("production_data")
     
+    # Test batched layout updates
+    tester.test_table_layout_batch(["operators", "tyre_specifications"])
+    
     # Test creating a new relationship
     tester.test_table_relationship_create()
     
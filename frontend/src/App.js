@@ -1,13 +1,16 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import './App.css';
 
 const API_BASE_URL = process.env.REACT_APP_BACKEND_URL || 'http://localhost:8001';
+const LAYOUT_SAVE_DELAY_MS = 400;
+const MAX_ANOMALIES_SHOWN = 20;
 
 function App() {
   const [naturalQuery, setNaturalQuery] = useState('');
   const [queryResults, setQueryResults] = useState(null);
   const [loading, setLoading] = useState(false);
   const [dashboardData, setDashboardData] = useState(null);
+  const [anomalies, setAnomalies] = useState([]);
   const [semanticMappings, setSemanticMappings] = useState([]);
   const [activeTab, setActiveTab] = useState('query');
   const [newMapping, setNewMapping] = useState({
@@ -26,6 +29,8 @@ function App() {
   const [connectionStart, setConnectionStart] = useState(null);
   const [draggedTable, setDraggedTable] = useState(null);
   const [mousePosition, setMousePosition] = useState({ x: 0, y: 0 });
+  const pendingPositions = useRef({});
+  const layoutSaveTimer = useRef(null);
 
   useEffect(() => {
     loadDashboardData();
@@ -35,6 +40,17 @@ function App() {
     loadERDConfigurations();
   }, []);
 
+  // Anomalies detected at ingest are pushed over server-sent events
+  useEffect(() => {
+    loadAnomalies();
+    const source = new EventSource(`${API_BASE_URL}/api/anomalies/stream`);
+    source.addEventListener('anomaly', (event) => {
+      const anomaly = JSON.parse(event.data);
+      setAnomalies((current) => [anomaly, ...current.filter((a) => a._id !== anomaly._id)].slice(0, MAX_ANOMALIES_SHOWN));
+    });
+    return () => source.close();
+  }, []);
+
   const loadDashboardData = async () => {
     try {
       const response = await fetch(`${API_BASE_URL}/api/dashboard/overview`);
@@ -45,6 +61,16 @@ function App() {
     }
   };
 
+  const loadAnomalies = async () => {
+    try {
+      const response = await fetch(`${API_BASE_URL}/api/anomalies?limit=${MAX_ANOMALIES_SHOWN}`);
+      const data = await response.json();
+      setAnomalies(data.anomalies || []);
+    } catch (error) {
+      console.error('Error loading anomalies:', error);
+    }
+  };
+
   const loadSemanticMappings = async () => {
     try {
       const response = await fetch(`${API_BASE_URL}/api/semantic-mappings`);
@@ -109,6 +135,14 @@ function App() {
     }
   };
 
+  // A plain link, so the browser streams the download to disk instead of buffering it
+  const exportQueryResults = (format) => {
+    const link = document.createElement('a');
+    link.href = `${API_BASE_URL}/api/query/export?format=${format}&query=${encodeURIComponent(queryResults.query)}`;
+    link.download = `query-results.${format}`;
+    link.click();
+  };
+
   const addSemanticMapping = async (e) => {
     e.preventDefault();
     try {
@@ -159,34 +193,44 @@ function App() {
     const x = e.clientX - rect.left;
     const y = e.clientY - rect.top;
 
-    // Update table position
-    const updatedTable = {
-      ...draggedTable,
-      position: { x, y }
-    };
+    // Update table position locally and save moves in one batched request
+    setTableSchemas(prev => 
+      prev.map(table => 
+        table.table_name === draggedTable.table_name 
+          ? { ...table, position: { x, y } }
+          : table
+      )
+    );
+    queueTablePosition(draggedTable.table_name, { x, y });
+
+    setDraggedTable(null);
+  };
+
+  const queueTablePosition = (tableName, position) => {
+    pendingPositions.current[tableName] = position;
+    clearTimeout(layoutSaveTimer.current);
+    layoutSaveTimer.current = setTimeout(saveTableLayout, LAYOUT_SAVE_DELAY_MS);
+  };
+
+  const saveTableLayout = async () => {
+    const positions = Object.entries(pendingPositions.current).map(([table_name, position]) => ({
+      table_name,
+      position
+    }));
+    pendingPositions.current = {};
+    if (positions.length === 0) return;
 
     try {
-      await fetch(`${API_BASE_URL}/api/table-schemas/${draggedTable.table_name}`, {
-        method: 'PUT',
+      await fetch(`${API_BASE_URL}/api/table-schemas/layout`, {
+        method: 'POST',
         headers: {
           'Content-Type': 'application/json',
         },
-        body: JSON.stringify(updatedTable),
+        body: JSON.stringify({ positions }),
       });
-
-      // Update local state
-      setTableSchemas(prev => 
-        prev.map(table => 
-          table.table_name === draggedTable.table_name 
-            ? updatedTable 
-            : table
-        )
-      );
     } catch (error) {
-      console.error('Error updating table position:', error);
+      console.error('Error updating table positions:', error);
     }
-
-    setDraggedTable(null);
   };
 
   const handleTableClick = (table) => {
@@ -324,6 +368,32 @@ function App() {
     );
   };
 
+  const renderAnomalies = () => {
+    if (!anomalies.length) return null;
+
+    return (
+      <div className="bg-white rounded-lg shadow-md p-6">
+        <h2 className="text-xl font-semibold mb-4">Live Anomalies</h2>
+        <div className="space-y-2">
+          {anomalies.map((anomaly) => (
+            <div
+              key={anomaly._id}
+              className={`flex justify-between items-center text-sm p-2 rounded border-l-4 ${
+                anomaly.severity === 'high' ? 'border-red-500 bg-red-50' : 'border-yellow-500 bg-yellow-50'
+              }`}
+            >
+              <span>
+                <span className="font-semibold">{anomaly.plant_id} {anomaly.series}</span> {anomaly.metric.replace('_', ' ')}: {anomaly.value}
+                <span className="text-gray-500"> (expected ~{anomaly.expected})</span>
+              </span>
+              <span className="text-gray-500">{anomaly.date}</span>
+            </div>
+          ))}
+        </div>
+      </div>
+    );
+  };
+
   const sampleQueries = [
     "Show me production efficiency by production line",
     "What are the defect rates for each line last week?",
@@ -614,6 +684,9 @@ function App() {
             {/* Dashboard Overview */}
             {renderDashboardOverview()}
 
+            {/* Anomalies pushed from the ingest path */}
+            {renderAnomalies()}
+
             {/* Natural Language Query Interface */}
             <div className="bg-white rounded-lg shadow-md p-6">
               <h2 className="text-xl font-semibold mb-6">Ask Questions About Your Manufacturing Data</h2>
@@ -664,10 +737,28 @@ function App() {
                   ) : (
                     <>
                       <div className="bg-blue-50 border border-blue-200 p-4 rounded-lg">
-                        <h4 className="font-medium text-blue-900">Query: "{queryResults.query}"</h4>
-                        <p className="text-sm text-blue-700 mt-1">
-                          Found {queryResults.total_records} results
-                        </p>
+                        <div className="flex justify-between items-start">
+                          <div>
+                            <h4 className="font-medium text-blue-900">Query: "{queryResults.query}"</h4>
+                            <p className="text-sm text-blue-700 mt-1">
+                              Found {queryResults.total_records} results
+                            </p>
+                          </div>
+                          <div className="flex space-x-2">
+                            <button
+                              onClick={() => exportQueryResults('csv')}
+                              className="px-3 py-1 text-sm bg-white border border-blue-300 text-blue-700 rounded hover:bg-blue-100"
+                            >
+                              Export CSV
+                            </button>
+                            <button
+                              onClick={() => exportQueryResults('parquet')}
+                              className="px-3 py-1 text-sm bg-white border border-blue-300 text-blue-700 rounded hover:bg-blue-100"
+                            >
+                              Export Parquet
+                            </button>
+                          </div>
+                        </div>
                       </div>
                       
                       {renderChart(queryResults.results, queryResults.chart_type)}